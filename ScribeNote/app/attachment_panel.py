@@ -0,0 +1,125 @@
+from PyQt5.QtWidgets import QListWidget, QListWidgetItem, QListView, QFileDialog, QInputDialog, QLineEdit, QMessageBox
+from PyQt5.QtCore import Qt, QSize, pyqtSignal
+from PyQt5.QtGui import QIcon, QPixmap, QPixmapCache
+
+from .thumbnails import ThumbnailCache, is_image, DEFAULT_SIZE
+from .instrumentation import traced
+
+# Budget for decoded thumbnails kept in memory (QPixmapCache is in KiB)
+PIXMAP_CACHE_KIB = 64 * 1024
+
+ATTACHMENT_ID_ROLE = Qt.UserRole
+
+
+class AttachmentPanel(QListWidget):
+    """
+    Icon strip of the current note's attachments
+
+    Image previews come from the ThumbnailCache, rendered on its worker pool;
+    decoded pixmaps are kept in QPixmapCache so revisiting a note shows them
+    without touching the disk.
+    """
+
+    # Emitted from worker threads; delivered on the UI thread
+    thumbnail_ready = pyqtSignal(str, str, str, str)
+
+    def __init__(self, file_handler, cache_dir, parent=None):
+        super().__init__(parent)
+        self.file_handler = file_handler
+        self.thumbnails = ThumbnailCache(cache_dir)
+        self.note_id = None
+        self.thumbnail_size = DEFAULT_SIZE
+
+        QPixmapCache.setCacheLimit(max(QPixmapCache.cacheLimit(), PIXMAP_CACHE_KIB))
+
+        self.setViewMode(QListView.IconMode)
+        self.setFlow(QListView.LeftToRight)
+        self.setWrapping(False)
+        self.setResizeMode(QListView.Adjust)
+        self.setMovement(QListView.Static)
+        self.setIconSize(QSize(self.thumbnail_size, self.thumbnail_size))
+        self.setFixedHeight(self.thumbnail_size + 48)
+        self.setUniformItemSizes(True)
+        self.itemDoubleClicked.connect(self.save_attachment_as)
+
+        self.thumbnail_ready.connect(self._apply_thumbnail)
+
+    def _pixmap_key(self, content_hash):
+        return f"thumbnail:{content_hash}:{self.thumbnail_size}"
+
+    @traced("ui.attachments", "ui")
+    def show_note(self, note_id, attachments):
+        """Show the given attachments of a note, or hide the panel if note_id is None"""
+        self.note_id = note_id
+        self.clear()
+        self.setVisible(note_id is not None and bool(attachments))
+        if note_id is None:
+            return
+
+        generic_icon = self.style().standardIcon(self.style().SP_FileIcon)
+        for attachment in attachments:
+            item = QListWidgetItem(generic_icon, attachment['filename'])
+            item.setData(ATTACHMENT_ID_ROLE, attachment['id'])
+            item.setToolTip(attachment['filename'])
+            self.addItem(item)
+
+            if not is_image(attachment):
+                continue
+
+            pixmap = QPixmapCache.find(self._pixmap_key(attachment['content_hash'])) if attachment.get('content_hash') else None
+            if pixmap is not None and not pixmap.isNull():
+                item.setIcon(QIcon(pixmap))
+                continue
+
+            future = self.thumbnails.request(attachment, self.thumbnail_size)
+            future.add_done_callback(
+                lambda f, note_id=note_id, attachment=attachment: self._thumbnail_done(f, note_id, attachment)
+            )
+
+    def _thumbnail_done(self, future, note_id, attachment):
+        # Worker thread: hand the result over to the UI thread
+        if future.cancelled() or future.exception() is not None:
+            return
+        self.thumbnail_ready.emit(note_id, attachment['id'], attachment.get('content_hash') or "", future.result())
+
+    def _apply_thumbnail(self, note_id, attachment_id, content_hash, path):
+        if note_id != self.note_id:
+            return
+
+        pixmap = QPixmap(path)
+        if pixmap.isNull():
+            return
+
+        if content_hash:
+            QPixmapCache.insert(self._pixmap_key(content_hash), pixmap)
+
+        for row in range(self.count()):
+            item = self.item(row)
+            if item.data(ATTACHMENT_ID_ROLE) == attachment_id:
+                item.setIcon(QIcon(pixmap))
+                break
+
+    def save_attachment_as(self, item):
+        attachment = self.file_handler.get_attachment(item.data(ATTACHMENT_ID_ROLE))
+        if not attachment:
+            return
+
+        destination, _ = QFileDialog.getSaveFileName(self, "Save Attachment", attachment['filename'])
+        if not destination:
+            return
+
+        password = None
+        if attachment.get('encrypted'):
+            password, ok = QInputDialog.getText(
+                self, "Decryption Password", "Enter the note's password:", QLineEdit.Password
+            )
+            if not ok or not password:
+                return
+
+        try:
+            self.file_handler.export_attachment(attachment['id'], destination, password=password)
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Could not save attachment: {str(e)}")
+
+    def shutdown(self):
+        self.thumbnails.shutdown()
@@ -0,0 +1,373 @@
+import codecs
+import datetime
+import os
+from html.parser import HTMLParser
+
+from .compression import DEFLATE, deflate
+from .database import split_statements
+from .instrumentation import traced
+
+READ_SIZE = 1024 * 1024
+# Extracted text is indexed in chunks of about this many characters, cut at
+# line breaks, so memory use does not depend on the file size
+CHUNK_CHARS = 1024 * 1024
+# Only the first this many characters of an attachment are indexed: enough for
+# a large log file, while a runaway one cannot fill the disk
+MAX_INDEXED_CHARS = 256 * 1024 * 1024
+# Extraction is mostly reading files, so a few threads keep the disk busy
+DEFAULT_WORKERS = min(4, (os.cpu_count() or 1) + 2)
+
+PLAIN_EXTENSIONS = (".txt", ".text", ".md", ".markdown", ".rst", ".csv", ".tsv", ".log",
+                    ".json", ".jsonl", ".xml", ".yaml", ".yml", ".ini", ".cfg", ".toml")
+HTML_EXTENSIONS = (".html", ".htm", ".xhtml")
+PDF_EXTENSIONS = (".pdf",)
+
+# Extracted text is stored once per distinct file content (compressed, in
+# chunks) and indexed once per attachment. The index reads chunks back through
+# attachments_fts_source with note_text(), like the notes index does; the
+# triggers pass old values in to remove them. Extraction results without text
+# (images, unreadable files) are kept too, as attachment_texts rows with no
+# chunks, so no file is read twice.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS attachment_texts (
+    content_hash TEXT PRIMARY KEY,
+    extractor TEXT,
+    chunks INTEGER NOT NULL,
+    chars INTEGER NOT NULL,
+    truncated INTEGER NOT NULL DEFAULT 0,
+    extracted_date TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS attachment_text_chunks (
+    content_hash TEXT NOT NULL,
+    chunk INTEGER NOT NULL,
+    text BLOB NOT NULL,
+    PRIMARY KEY (content_hash, chunk)
+);
+
+CREATE TABLE IF NOT EXISTS attachments_fts_ids (
+    id INTEGER PRIMARY KEY,
+    attachment_id TEXT NOT NULL,
+    chunk INTEGER NOT NULL,
+    UNIQUE (attachment_id, chunk)
+);
+
+CREATE VIEW IF NOT EXISTS attachments_fts_source AS
+SELECT m.id AS fts_id, note_text(c.text) AS content
+FROM attachments_fts_ids m
+JOIN attachments a ON a.id = m.attachment_id
+JOIN attachment_text_chunks c ON c.content_hash = a.content_hash AND c.chunk = m.chunk;
+
+CREATE VIRTUAL TABLE IF NOT EXISTS attachments_fts USING fts5 (
+    content,
+    content = 'attachments_fts_source',
+    content_rowid = 'fts_id',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS attachments_fts_after_delete AFTER DELETE ON attachments BEGIN
+    INSERT INTO attachments_fts (attachments_fts, rowid, content)
+    SELECT 'delete', m.id, note_text(c.text)
+    FROM attachments_fts_ids m
+    JOIN attachment_text_chunks c ON c.content_hash = old.content_hash AND c.chunk = m.chunk
+    WHERE m.attachment_id = old.id;
+    DELETE FROM attachments_fts_ids WHERE attachment_id = old.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS attachments_fts_after_update
+AFTER UPDATE OF content_hash ON attachments WHEN old.content_hash IS NOT new.content_hash BEGIN
+    INSERT INTO attachments_fts (attachments_fts, rowid, content)
+    SELECT 'delete', m.id, note_text(c.text)
+    FROM attachments_fts_ids m
+    JOIN attachment_text_chunks c ON c.content_hash = old.content_hash AND c.chunk = m.chunk
+    WHERE m.attachment_id = old.id;
+    DELETE FROM attachments_fts_ids WHERE attachment_id = old.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS attachment_texts_after_blob_delete AFTER DELETE ON blobs BEGIN
+    DELETE FROM attachment_text_chunks WHERE content_hash = old.hash;
+    DELETE FROM attachment_texts WHERE content_hash = old.hash;
+END;
+'''
+
+
+def _decoded(path):
+    """Text of a UTF-8 file, READ_SIZE bytes at a time; None for binary files"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    with open(path, "rb") as f:
+        first = True
+        while True:
+            data = f.read(READ_SIZE)
+            if first and b"\0" in data[:8192]:
+                # Not text, whatever the extension says
+                return
+            first = False
+            if not data:
+                break
+            yield decoder.decode(data)
+        yield decoder.decode(b"", final=True)
+
+
+def plain_text(path):
+    yield from _decoded(path)
+
+
+class _HTMLText(HTMLParser):
+    """Collects the text of an HTML document, leaving out scripts and styles"""
+
+    SKIPPED = ("script", "style", "noscript", "template")
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED:
+            self._skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED and self._skipping:
+            self._skipping -= 1
+        elif tag in ("p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6"):
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+
+    def take(self):
+        text = "".join(self.parts)
+        self.parts = []
+        return text
+
+
+def html_text(path):
+    parser = _HTMLText()
+    for text in _decoded(path):
+        parser.feed(text)
+        yield parser.take()
+    parser.close()
+    yield parser.take()
+
+
+def pdf_text(path):
+    """Text of a PDF, page by page (needs pypdf; without it PDFs are not indexed)"""
+    from pypdf import PdfReader
+
+    for page in PdfReader(path).pages:
+        yield (page.extract_text() or "") + "\n"
+
+
+def _pdf_available():
+    try:
+        import pypdf  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def extractor_for(filename, file_type=None):
+    """(name, function) extracting an attachment's text, or None if it has none we can read"""
+    extension = os.path.splitext(filename or "")[1].lower()
+    if extension in HTML_EXTENSIONS or file_type == "text/html":
+        return "html", html_text
+    if extension in PDF_EXTENSIONS or file_type == "application/pdf":
+        return ("pdf", pdf_text) if _pdf_available() else None
+    if extension in PLAIN_EXTENSIONS or (file_type or "").startswith("text/"):
+        return "text", plain_text
+    return None
+
+
+def text_chunks(pieces, max_chars=MAX_INDEXED_CHARS, chunk_chars=CHUNK_CHARS):
+    """
+    Regroup extracted text into chunks of about chunk_chars, cut at line breaks
+
+    Yields (chunk, truncated); truncated is True on the last chunk when the
+    text went on past max_chars.
+    """
+    buffer = ""
+    remaining = max_chars
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) >= chunk_chars or len(buffer) >= remaining:
+            size = min(chunk_chars, remaining)
+            cut = buffer.rfind("\n", 0, size) + 1 or size
+            chunk, buffer = buffer[:cut], buffer[cut:]
+            remaining -= len(chunk)
+            if remaining <= 0:
+                yield chunk, True
+                return
+            yield chunk, False
+    if buffer:
+        yield buffer, False
+
+
+def extract_text(path, extract, max_chars=MAX_INDEXED_CHARS):
+    """An attachment's text as compressed chunks; yields (chunk, characters, truncated)"""
+    for chunk, truncated in text_chunks(extract(path), max_chars):
+        if chunk.strip():
+            # Plain deflate: dictionaries belong to note bodies and may be dropped
+            yield bytes((DEFLATE,)) + deflate(chunk.encode("utf-8")), len(chunk), truncated
+
+
+class AttachmentTextIndex:
+    """
+    Full-text index over the contents of text-like attachments
+
+    Text, HTML and (with pypdf installed) PDF attachments are read in the
+    background by index_pending(), on a pool of threads, streamed in chunks
+    and capped at max_chars. The text is stored per file content, so the same
+    file attached twice, or attached again later, is not extracted again.
+    Encrypted attachments are never indexed.
+
+    Matches are found with one query on attachments_fts (see
+    SearchIndex.search), which maps back to attachments.id.
+    """
+
+    def __init__(self, db, max_chars=MAX_INDEXED_CHARS, workers=DEFAULT_WORKERS):
+        self.db = db
+        self.max_chars = max_chars
+        self.workers = workers
+
+    def initialize(self, conn):
+        """Create the tables and triggers (attachments and blobs must exist)"""
+        for statement in split_statements(SCHEMA):
+            conn.execute(statement)
+
+    def pending(self):
+        """Attachments whose text has not been extracted, or not indexed for them"""
+        rows = self.db.fetchall(
+            "SELECT a.id, a.filename, a.file_type, a.file_path, a.content_hash, t.chunks FROM attachments a "
+            "LEFT JOIN attachment_texts t ON t.content_hash = a.content_hash "
+            "WHERE a.encrypted = 0 AND a.content_hash IS NOT NULL AND (t.content_hash IS NULL "
+            "OR (t.chunks > 0 AND NOT EXISTS (SELECT 1 FROM attachments_fts_ids m WHERE m.attachment_id = a.id)))"
+        )
+        return [dict(row) for row in rows]
+
+    def index_pending(self, progress=None, cancelled=None):
+        """
+        Extract and index the text of every pending attachment
+
+        Args:
+            progress: Called with (files done, files total) after each file
+            cancelled: Called between files; stops when it returns True
+
+        Returns:
+            Number of attachments added to the index
+        """
+        rows = self.pending()
+        stop = cancelled or (lambda: False)
+
+        # Text already extracted for another attachment with the same content
+        ready = [row['id'] for row in rows if row['chunks']]
+        indexed = self._index_attachments(ready)
+
+        by_hash = {}
+        for row in rows:
+            if not row['chunks']:
+                by_hash.setdefault(row['content_hash'], []).append(row)
+        total = len(by_hash)
+        if not total:
+            return indexed
+
+        def extract(content_hash):
+            # Extraction thread
+            if stop():
+                return content_hash, None
+            row = by_hash[content_hash][0]
+            extractor = extractor_for(row['filename'], row['file_type'])
+            if extractor is None:
+                return content_hash, (None, 0, 0, False)
+            name, function = extractor
+            try:
+                return content_hash, (name,) + self._extract(content_hash, row['file_path'], function)
+            except Exception:
+                # Missing or unreadable; the same content will not read better next time
+                return content_hash, ("error", 0, 0, False)
+
+        # Imported here so opening the app does not load it
+        from concurrent.futures import ThreadPoolExecutor
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="extract") as pool:
+            for content_hash, extracted in pool.map(extract, list(by_hash)):
+                if extracted is None:
+                    continue
+                indexed += self._store(content_hash, *extracted,
+                                       attachment_ids=[row['id'] for row in by_hash[content_hash]])
+                done += 1
+                if progress:
+                    progress(done, total)
+        return indexed
+
+    @traced("file.extract_text", "file")
+    def _extract(self, content_hash, path, extract):
+        """
+        Write a file's text chunks as they are extracted
+
+        Chunks without an attachment_texts row are not used yet (see _store),
+        so an interrupted extraction is simply done again.
+
+        Returns:
+            (number of chunks, number of characters, truncated)
+        """
+        chunks = 0
+        chars = 0
+        truncated = False
+        for chunk, size, truncated in extract_text(path, extract, self.max_chars):
+            self.db.execute(
+                "INSERT OR REPLACE INTO attachment_text_chunks (content_hash, chunk, text) VALUES (?, ?, ?)",
+                (content_hash, chunks, chunk)
+            )
+            chunks += 1
+            chars += size
+        return chunks, chars, truncated
+
+    def _store(self, content_hash, extractor, chunks, chars, truncated, attachment_ids):
+        with self.db.transaction() as conn:
+            if conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (content_hash,)).fetchone() is None:
+                # The file went away while it was being read
+                conn.execute("DELETE FROM attachment_text_chunks WHERE content_hash = ?", (content_hash,))
+                return 0
+            # Left over from an earlier, longer or failed extraction
+            conn.execute(
+                "DELETE FROM attachment_text_chunks WHERE content_hash = ? AND chunk >= ?",
+                (content_hash, chunks)
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO attachment_texts (content_hash, extractor, chunks, chars, truncated, extracted_date) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (content_hash, extractor, chunks, chars, 1 if truncated else 0, datetime.datetime.now().isoformat())
+            )
+            return self._index_attachments(attachment_ids) if chunks else 0
+
+    def _index_attachments(self, attachment_ids):
+        """Index the stored text of attachments; runs in the caller's transaction when there is one"""
+        indexed = 0
+        with self.db.transaction() as conn:
+            for attachment_id in attachment_ids:
+                # Nothing is added for attachments deleted or encrypted since
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO attachments_fts_ids (attachment_id, chunk) "
+                    "SELECT a.id, c.chunk FROM attachments a "
+                    "JOIN attachment_text_chunks c ON c.content_hash = a.content_hash "
+                    "WHERE a.id = ? AND a.encrypted = 0",
+                    (attachment_id,)
+                )
+                if cursor.rowcount <= 0:
+                    continue
+                conn.execute(
+                    "INSERT INTO attachments_fts (rowid, content) SELECT fts_id, content "
+                    "FROM attachments_fts_source WHERE fts_id IN (SELECT id FROM attachments_fts_ids WHERE attachment_id = ?)",
+                    (attachment_id,)
+                )
+                indexed += 1
+        return indexed
+
+    def stats(self):
+        """Number of attachments indexed and characters of text stored"""
+        row = self.db.fetchone(
+            "SELECT (SELECT COUNT(DISTINCT attachment_id) FROM attachments_fts_ids) AS attachments, "
+            "COALESCE(SUM(chars), 0) AS chars, COALESCE(SUM(truncated), 0) AS truncated FROM attachment_texts"
+        )
+        return dict(row)
@@ -0,0 +1,142 @@
+import hashlib
+import time
+
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+from .tasks import WRITE
+
+# Quiet period after the last edit before a note is written
+AUTOSAVE_DELAY_MS = 1000
+# Longest an edited note stays unsaved while the user keeps typing
+AUTOSAVE_MAX_DELAY_MS = 10000
+
+
+def content_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).digest()
+
+
+class AutosaveController(QObject):
+    """
+    Debounced autosave of plaintext notes
+
+    Edits only mark the note dirty and restart a timer; nothing is read from
+    the editor per keystroke. When the timer fires, the editor state is
+    compared with what was last saved (the title directly, the body by hash)
+    and only the fields that changed are written, on the executor's write
+    lane. A newer write of the same note replaces one that is still queued.
+
+    Args:
+        note_manager: NoteManager to write through
+        executor: TaskExecutor running the writes
+        snapshot: Callable returning (note_id, title, content) of the note
+            being edited, or None if it must not be autosaved (encrypted)
+    """
+
+    # note_id, summary of the saved note
+    saved = pyqtSignal(str, object)
+    # note_id, exception
+    failed = pyqtSignal(str, object)
+
+    def __init__(self, note_manager, executor, snapshot, delay=AUTOSAVE_DELAY_MS,
+                 max_delay=AUTOSAVE_MAX_DELAY_MS, parent=None):
+        super().__init__(parent)
+        self.note_manager = note_manager
+        self.executor = executor
+        self.snapshot = snapshot
+        self.max_delay = max_delay / 1000.0
+        # note_id -> (title, content hash) as last written or loaded
+        self._saved = {}
+        self._dirty_since = None
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.flush)
+
+    @property
+    def dirty(self):
+        return self._dirty_since is not None
+
+    def track(self, note_id, title, content):
+        """Start tracking a note as loaded into the editor (clean)"""
+        self.cancel()
+        self._saved[note_id] = (title, content_hash(content))
+
+    def forget(self, note_id):
+        """Stop tracking a note, e.g. because it was deleted or encrypted"""
+        self._saved.pop(note_id, None)
+        self.executor.cancel(("autosave", note_id))
+
+    def note_changed(self):
+        """Mark the edited note dirty; called on every keystroke"""
+        now = time.monotonic()
+        if self._dirty_since is None:
+            self._dirty_since = now
+        elif now - self._dirty_since >= self.max_delay:
+            # Typing without pause; save now instead of postponing again
+            self.flush()
+            return
+        self.timer.start()
+
+    def cancel(self):
+        """Drop the dirty state without saving"""
+        self.timer.stop()
+        self._dirty_since = None
+
+    def mark_saved(self, note_id, title, content):
+        """Record a save made outside autosave"""
+        self.track(note_id, title, content)
+
+    def is_saved(self, note_id, title, content):
+        """Whether title and content are what was last written or loaded for the note"""
+        return self._saved.get(note_id) == (title, content_hash(content))
+
+    def flush(self):
+        """
+        Write the edited note now if it changed since it was last saved
+
+        Returns:
+            True if a write was submitted
+        """
+        self.timer.stop()
+        if self._dirty_since is None:
+            return False
+        self._dirty_since = None
+
+        state = self.snapshot()
+        if state is None:
+            return False
+        note_id, title, content = state
+        if note_id not in self._saved:
+            return False
+
+        saved_title, saved_hash = self._saved[note_id]
+        new_hash = content_hash(content)
+        changed_title = title if title != saved_title else None
+        changed_content = content if new_hash != saved_hash else None
+        if changed_title is None and changed_content is None:
+            return False
+
+        self.executor.submit(
+            self._write, note_id, changed_title, changed_content,
+            on_result=lambda summary: self._written(note_id, title, new_hash, summary),
+            on_error=lambda error: self.failed.emit(note_id, error),
+            key=("autosave", note_id),
+            lane=WRITE
+        )
+        return True
+
+    def _write(self, note_id, title, content):
+        # Worker thread
+        if not self.note_manager.update_note_fields(note_id, title=title, content=content):
+            return None
+        return self.note_manager.get_note_summary(note_id)
+
+    def _written(self, note_id, title, new_hash, summary):
+        if summary is None:
+            # Deleted or encrypted in the meantime
+            self._saved.pop(note_id, None)
+            return
+        if note_id in self._saved:
+            self._saved[note_id] = (title, new_hash)
+        self.saved.emit(note_id, summary)
@@ -0,0 +1,219 @@
+import datetime
+import hashlib
+import hmac
+import re
+import threading
+import unicodedata
+
+from .compression import BODY_CHANGED
+from .database import split_statements
+
+# Tokens are truncated HMAC-SHA256 values: 8 bytes keep the table small and
+# make a false match between two words about as likely as a random guess
+TOKEN_SIZE = 8
+INDEX_KEY_INFO = b"scribenote blind index"
+
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+# Tokens of an encrypted note's body, keyed by the note's id in the search
+# index (notes_fts_ids), so they go when the note leaves the index. Any
+# change to the body, or decrypting the note, drops them; whoever holds the
+# password writes the new ones (see BlindIndex.index_note).
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS blind_index_keys (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    salt BLOB NOT NULL,
+    created_date TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS blind_index (
+    token BLOB NOT NULL,
+    fts_id INTEGER NOT NULL,
+    PRIMARY KEY (token, fts_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_blind_index_fts_id ON blind_index (fts_id);
+
+CREATE TRIGGER IF NOT EXISTS blind_index_after_update AFTER UPDATE OF content, encrypted ON notes
+WHEN old.encrypted IS NOT new.encrypted OR {BODY_CHANGED}
+BEGIN
+    DELETE FROM blind_index WHERE fts_id = (SELECT id FROM notes_fts_ids WHERE note_id = new.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS blind_index_after_delete AFTER DELETE ON notes_fts_ids BEGIN
+    DELETE FROM blind_index WHERE fts_id = old.id;
+END;
+'''
+
+
+def normalize_term(term):
+    """Fold case and diacritics like the full-text index does"""
+    term = unicodedata.normalize("NFKD", term.casefold())
+    return "".join(char for char in term if not unicodedata.combining(char))
+
+
+def index_key(encryption_handler, password, salt):
+    """HMAC key of the blind index for a password"""
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    key = encryption_handler.derive_key_bytes(password, salt)
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=INDEX_KEY_INFO).derive(key)
+
+
+def _token(key, term):
+    return hmac.new(key, term.encode("utf-8"), hashlib.sha256).digest()[:TOKEN_SIZE]
+
+
+def blind_tokens(text, key):
+    """Set of tokens of the distinct words of text under an index key"""
+    return {_token(key, normalize_term(term)) for term in set(_TERM_RE.findall(text or ""))}
+
+
+class BlindIndex:
+    """
+    Optional search index over the bodies of encrypted notes
+
+    Every distinct word of an encrypted note is stored as a keyed HMAC token
+    (a "blind index"). The key is derived from the note's password and a
+    salt kept with the index, so without the password the tokens give away
+    neither the words nor which notes share a password; with it, a search
+    is one lookup per word and no note has to be decrypted. Words are matched
+    whole, not as prefixes.
+
+    Tokens do show how many distinct words a note has and which notes under
+    the same password share words, which is why the index is off until
+    enable() is called.
+
+    Passwords given to unlock() make searches include encrypted notes until
+    lock(); only the derived keys are kept.
+    """
+
+    def __init__(self, db, encryption_handler=None):
+        self.db = db
+        self._encryption_handler = encryption_handler
+        self._salt = None
+        self._keys = []
+        self._lock = threading.Lock()
+
+    @property
+    def encryption_handler(self):
+        if self._encryption_handler is None:
+            from .encryption import EncryptionHandler
+            self._encryption_handler = EncryptionHandler()
+        return self._encryption_handler
+
+    def initialize(self, conn):
+        for statement in split_statements(SCHEMA):
+            conn.execute(statement)
+        row = conn.execute("SELECT salt FROM blind_index_keys WHERE id = 1").fetchone()
+        self._salt = bytes(row['salt']) if row else None
+
+    @property
+    def enabled(self):
+        return self._salt is not None
+
+    @property
+    def salt(self):
+        """Salt index keys are derived with, or None while the index is off"""
+        return self._salt
+
+    @property
+    def unlocked(self):
+        return bool(self._keys)
+
+    def key_for(self, password):
+        return index_key(self.encryption_handler, password, self._salt)
+
+    def enable(self):
+        """Turn the index on; notes are indexed when saved with their password, or in bulk by BulkCrypto"""
+        if self.enabled:
+            return
+        salt = self.encryption_handler.new_salt()
+        with self.db.transaction():
+            self.db.execute(
+                "INSERT OR IGNORE INTO blind_index_keys (id, salt, created_date) VALUES (1, ?, ?)",
+                (salt, datetime.datetime.now().isoformat())
+            )
+            self._salt = bytes(self.db.fetchone("SELECT salt FROM blind_index_keys WHERE id = 1")['salt'])
+
+    def disable(self):
+        """Turn the index off and delete every token"""
+        with self.db.transaction():
+            self.db.execute("DELETE FROM blind_index")
+            self.db.execute("DELETE FROM blind_index_keys")
+        self._salt = None
+        self.lock()
+
+    def unlock(self, password):
+        """Include notes encrypted with this password in searches; returns whether the index is on"""
+        if not self.enabled:
+            return False
+        key = self.key_for(password)
+        with self._lock:
+            if key not in self._keys:
+                self._keys.append(key)
+        return True
+
+    def lock(self):
+        """Forget the unlocked keys"""
+        with self._lock:
+            self._keys = []
+
+    # Writing
+
+    def add_tokens(self, note_tokens):
+        """
+        Store tokens computed by blind_tokens(), replacing the notes' old ones
+
+        Runs in the caller's transaction when there is one.
+
+        Args:
+            note_tokens: Iterable of (note_id, set of tokens) pairs
+        """
+        with self.db.transaction() as conn:
+            for note_id, tokens in note_tokens:
+                row = conn.execute("SELECT id FROM notes_fts_ids WHERE note_id = ?", (note_id,)).fetchone()
+                if row is None:
+                    continue
+                conn.execute("DELETE FROM blind_index WHERE fts_id = ?", (row['id'],))
+                conn.executemany(
+                    "INSERT OR IGNORE INTO blind_index (token, fts_id) VALUES (?, ?)",
+                    [(token, row['id']) for token in tokens]
+                )
+
+    def index_note(self, note_id, text, password):
+        """Index the plaintext of an encrypted note under its password (if the index is on)"""
+        if not self.enabled:
+            return
+        self.add_tokens([(note_id, blind_tokens(text, self.key_for(password)))])
+
+    # Searching
+
+    def search(self, search_text, keys=None):
+        """
+        Search-index ids (notes_fts_ids.id) of encrypted notes containing every word
+
+        Args:
+            search_text: Text typed by the user
+            keys: Index keys to search with; the unlocked ones by default
+
+        Returns:
+            Set of ids, empty when nothing is unlocked
+        """
+        terms = {normalize_term(term) for term in _TERM_RE.findall(search_text or "")}
+        with self._lock:
+            keys = list(self._keys if keys is None else keys)
+        if not terms or not keys or not self.enabled:
+            return set()
+
+        ids = set()
+        for key in keys:
+            tokens = [_token(key, term) for term in terms]
+            rows = self.db.fetchall(
+                f"SELECT fts_id FROM blind_index WHERE token IN ({', '.join('?' * len(tokens))}) "
+                "GROUP BY fts_id HAVING COUNT(*) = ?",
+                tokens + [len(tokens)]
+            )
+            ids.update(row['fts_id'] for row in rows)
+        return ids
@@ -0,0 +1,289 @@
+import os
+import errno
+import shutil
+import hashlib
+import tempfile
+import datetime
+
+from .instrumentation import traced
+
+HASH_ALGORITHM = "sha256"
+READ_SIZE = 1024 * 1024
+
+# FICLONE ioctl: share the source file's extents (btrfs, XFS, bcachefs ...)
+FICLONE = 0x40049409
+
+SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS blobs (
+        hash TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        ref_count INTEGER NOT NULL DEFAULT 0,
+        created_date TEXT NOT NULL
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON blobs (hash) WHERE ref_count <= 0",
+    "CREATE INDEX IF NOT EXISTS idx_attachments_content_hash ON attachments (content_hash)",
+    # Reference counts follow the attachments table, whichever code path
+    # inserts or deletes rows (including NoteManager.delete_note)
+    '''
+    CREATE TRIGGER IF NOT EXISTS blobs_ref_after_insert
+    AFTER INSERT ON attachments WHEN new.content_hash IS NOT NULL BEGIN
+        UPDATE blobs SET ref_count = ref_count + 1 WHERE hash = new.content_hash;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS blobs_ref_after_delete
+    AFTER DELETE ON attachments WHEN old.content_hash IS NOT NULL BEGIN
+        UPDATE blobs SET ref_count = ref_count - 1 WHERE hash = old.content_hash;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS blobs_ref_after_update
+    AFTER UPDATE OF content_hash ON attachments
+    WHEN old.content_hash IS NOT new.content_hash BEGIN
+        UPDATE blobs SET ref_count = ref_count - 1 WHERE hash = old.content_hash;
+        UPDATE blobs SET ref_count = ref_count + 1 WHERE hash = new.content_hash;
+    END
+    ''',
+)
+
+
+def initialize_db(conn):
+    """Create the blob table and reference-counting triggers (attachments must exist)"""
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+@traced("file.hash", "file")
+def hash_file(path):
+    """Streamed content hash of a file"""
+    digest = hashlib.new(HASH_ALGORITHM)
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _reflink(src, dst):
+    import fcntl
+    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _copy_file_range(src, dst, size):
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+        if n == 0:
+            break
+        copied += n
+    return copied == size
+
+
+def _sendfile(src, dst, size):
+    copied = 0
+    while copied < size:
+        n = os.sendfile(dst.fileno(), src.fileno(), copied, size - copied)
+        if n == 0:
+            break
+        copied += n
+    return copied == size
+
+
+# errno values meaning "this fast path is not available here, try the next"
+_UNSUPPORTED = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY,
+                errno.EBADF, errno.EPERM}
+
+
+@traced("file.copy", "file")
+def fast_copy(src_path, dst_path):
+    """
+    Copy a file using the cheapest mechanism the platform offers
+
+    Tries a reflink (copy-on-write clone), then an in-kernel copy with
+    copy_file_range or sendfile, and finally a buffered userspace copy.
+    Returns the name of the method that was used.
+    """
+    size = os.path.getsize(src_path)
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        if os.name == "posix":
+            try:
+                _reflink(src, dst)
+                return "reflink"
+            except (OSError, ImportError) as e:
+                if isinstance(e, OSError) and e.errno not in _UNSUPPORTED:
+                    raise
+
+        for name, method in (("copy_file_range", getattr(os, "copy_file_range", None)),
+                             ("sendfile", getattr(os, "sendfile", None))):
+            if method is None:
+                continue
+            try:
+                dst.seek(0)
+                dst.truncate()
+                src.seek(0)
+                if (_copy_file_range if name == "copy_file_range" else _sendfile)(src, dst, size):
+                    return name
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+
+        dst.seek(0)
+        dst.truncate()
+        src.seek(0)
+        shutil.copyfileobj(src, dst, READ_SIZE)
+        return "copy"
+
+
+class PreparedBlob:
+    """A file hashed (and, if new, staged) for the store but not yet committed"""
+
+    def __init__(self, content_hash, size, source_path, staged_path=None, owned=False, move=False):
+        self.content_hash = content_hash
+        self.size = size
+        self.source_path = source_path
+        self.staged_path = staged_path
+        self.owned = owned
+        self.move = move
+
+
+class BlobStore:
+    """
+    Content-addressed storage for attachment files
+
+    Each distinct file content is stored once, under its hash. The blobs
+    table counts how many attachment rows refer to each blob; blobs that
+    drop to zero references are removed by collect_garbage().
+
+    Storing is split in two so the expensive part runs without holding the
+    database write lock:
+
+        prepared = store.prepare(path)      # hash, copy if new
+        with db.transaction():
+            store.commit(prepared)          # rename into place, add row
+            ...insert the attachment row...
+        store.discard(prepared)             # drop an unused staged copy
+    """
+
+    def __init__(self, root_dir, db):
+        self.root_dir = root_dir
+        self.db = db
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def path_for(self, content_hash):
+        return os.path.join(self.root_dir, content_hash[:2], content_hash)
+
+    def contains(self, content_hash):
+        return os.path.exists(self.path_for(content_hash))
+
+    def new_temporary_path(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root_dir, prefix=".tmp-")
+        os.close(fd)
+        return tmp_path
+
+    def prepare(self, file_path, owned=False, move=False):
+        """
+        Hash a file and stage a copy of it if its content is not stored yet
+
+        Args:
+            file_path: File to store
+            owned: True if the file belongs to ScribeNote and will not be
+                modified afterwards, so it may be hard-linked instead of copied
+            move: True if the file is a temporary file that may be moved
+                into the store (it is gone afterwards)
+        """
+        prepared = PreparedBlob(hash_file(file_path), os.path.getsize(file_path),
+                                file_path, owned=owned, move=move)
+        if not self.contains(prepared.content_hash):
+            prepared.staged_path = self._stage(prepared)
+        return prepared
+
+    def commit(self, prepared):
+        """
+        Make sure the blob exists and has a row; returns the blob path
+
+        Must run inside a transaction that also inserts the attachment row
+        referencing it; because collect_garbage() deletes under the same
+        write lock, the blob cannot disappear in between.
+        """
+        blob_path = self.path_for(prepared.content_hash)
+        if not os.path.exists(blob_path):
+            if prepared.staged_path is None:
+                # Collected since prepare() found it
+                prepared.staged_path = self._stage(prepared)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(prepared.staged_path, blob_path)
+            prepared.staged_path = None
+
+        self.db.execute(
+            "INSERT OR IGNORE INTO blobs (hash, size, ref_count, created_date) VALUES (?, ?, 0, ?)",
+            (prepared.content_hash, prepared.size, datetime.datetime.now().isoformat())
+        )
+        return blob_path
+
+    def discard(self, prepared):
+        """Remove a staged copy (or moved temporary file) that commit() did not need"""
+        if prepared.staged_path is not None and os.path.exists(prepared.staged_path):
+            os.remove(prepared.staged_path)
+        prepared.staged_path = None
+        if prepared.move and os.path.exists(prepared.source_path):
+            os.remove(prepared.source_path)
+
+    def _stage(self, prepared):
+        """Put the file's bytes in a temporary file inside the store"""
+        tmp_path = self.new_temporary_path()
+        if prepared.move:
+            os.replace(prepared.source_path, tmp_path)
+            return tmp_path
+        if prepared.owned:
+            try:
+                os.remove(tmp_path)
+                os.link(prepared.source_path, tmp_path)
+                return tmp_path
+            except OSError:
+                pass
+        try:
+            fast_copy(prepared.source_path, tmp_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return tmp_path
+
+    def collect_garbage(self):
+        """
+        Delete blobs no attachment refers to; returns (count, bytes freed)
+
+        The rows are deleted in the caller's transaction, if there is one,
+        and the files only once it commits, so a rollback leaves both.
+        """
+        with self.db.transaction() as conn:
+            rows = conn.execute("SELECT hash, size FROM blobs WHERE ref_count <= 0").fetchall()
+            hashes = [row['hash'] for row in rows]
+            conn.executemany("DELETE FROM blobs WHERE hash = ?", [(content_hash,) for content_hash in hashes])
+            if hashes:
+                self.db.after_commit(lambda: self._remove_files(hashes))
+        return len(rows), sum(row['size'] for row in rows)
+
+    def _remove_files(self, hashes):
+        # Under the write lock, so commit() cannot store the same content
+        # again meanwhile. A row that is back (e.g. a rolled back savepoint)
+        # keeps its file.
+        with self.db.transaction() as conn:
+            for content_hash in hashes:
+                if conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (content_hash,)).fetchone() is not None:
+                    continue
+                try:
+                    os.remove(self.path_for(content_hash))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        """Physical vs logical (per-reference) size of the store"""
+        row = self.db.fetchone(
+            "SELECT COUNT(*) AS blobs, COALESCE(SUM(size), 0) AS bytes, "
+            "COALESCE(SUM(size * ref_count), 0) AS logical_bytes FROM blobs"
+        )
+        return dict(row)
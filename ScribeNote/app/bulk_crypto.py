@@ -0,0 +1,365 @@
+import os
+import uuid
+import datetime
+
+from .encryption import EncryptionHandler
+from .blind_index import blind_tokens, index_key
+
+ENCRYPT = "encrypt"
+DECRYPT = "decrypt"
+REKEY = "rekey"
+# Add encrypted notes to the blind index without changing them
+INDEX = "index"
+OPERATIONS = (ENCRYPT, DECRYPT, REKEY, INDEX)
+
+# Item states in the job journal
+PENDING = "pending"
+DONE = "done"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+# Notes handed to a worker process at a time; each batch is also written
+# back to the database in a single transaction
+BATCH_SIZE = 64
+
+# Below this many notes the process pool costs more than it saves
+MIN_NOTES_FOR_POOL = 32
+
+SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS bulk_crypto_jobs (
+        id TEXT PRIMARY KEY,
+        operation TEXT NOT NULL,
+        status TEXT NOT NULL,
+        created_date TEXT NOT NULL,
+        finished_date TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS bulk_crypto_items (
+        job_id TEXT NOT NULL,
+        note_id TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        error TEXT,
+        PRIMARY KEY (job_id, note_id)
+    ) WITHOUT ROWID
+    ''',
+)
+
+
+# Worker process state, set once per process by _init_worker so passwords are
+# not pickled with every batch
+_worker_handler = None
+_worker_passwords = None
+_worker_index_salt = None
+
+
+def _init_worker(password, new_password, index_salt=None):
+    global _worker_handler, _worker_passwords, _worker_index_salt
+    _worker_handler = EncryptionHandler()
+    _worker_passwords = (password, new_password)
+    _worker_index_salt = index_salt
+
+
+def _transform(handler, operation, content, encrypted, password, new_password):
+    """Return (status, content, encrypted, plaintext) for one note; content is None if unchanged"""
+    if operation == ENCRYPT:
+        if encrypted:
+            return SKIPPED, None, None, None
+        return DONE, handler.encrypt(content or "", password), True, content or ""
+
+    if not encrypted:
+        return SKIPPED, None, None, None
+
+    plaintext = handler.decrypt(content, password)
+    if operation == DECRYPT:
+        return DONE, plaintext, False, plaintext
+    if operation == INDEX:
+        return DONE, None, True, plaintext
+    return DONE, handler.encrypt(plaintext, new_password), True, plaintext
+
+
+def _process_batch(operation, notes):
+    """Entry point for a worker process; see _process_notes"""
+    password, new_password = _worker_passwords
+    return _process_notes(_worker_handler, operation, notes, password, new_password, _worker_index_salt)
+
+
+def _process_notes(handler, operation, notes, password, new_password, index_salt=None):
+    """
+    Run a batch of (note_id, content, encrypted) tuples through the cipher
+
+    Returns a list of (note_id, status, content, encrypted, tokens, error)
+    tuples, with the blind index tokens of notes left encrypted when the
+    index is on (index_salt given); a note that fails (e.g. wrong password)
+    does not fail the batch.
+    """
+    key = None
+    if index_salt is not None and operation != DECRYPT:
+        key = index_key(handler, new_password if operation == REKEY else password, index_salt)
+
+    results = []
+    for note_id, content, encrypted in notes:
+        try:
+            status, new_content, new_encrypted, plaintext = _transform(
+                handler, operation, content, encrypted, password, new_password
+            )
+            tokens = blind_tokens(plaintext, key) if key is not None and status == DONE else None
+            results.append((note_id, status, new_content, new_encrypted, tokens, None))
+        except Exception as e:
+            error = str(e) or "Incorrect password or corrupted data"
+            results.append((note_id, FAILED, None, None, None, error))
+    return results
+
+
+class BulkCrypto:
+    """
+    Encrypt, decrypt, re-key or blind-index many notes at once
+
+    Key derivation and cipher work is spread across a process pool. Every
+    run is recorded in a journal (bulk_crypto_jobs/bulk_crypto_items) and each
+    batch updates the notes and marks its journal items in one transaction,
+    so an interrupted job can be resumed without touching a note twice.
+    """
+
+    def __init__(self, note_manager, workers=None, batch_size=BATCH_SIZE):
+        self.note_manager = note_manager
+        self.db = note_manager.db
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.initialize_db()
+
+    def initialize_db(self):
+        with self.db.transaction() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def select_notes(self, tag=None, note_ids=None):
+        """Note ids for a filter: explicit ids, a tag, or all notes"""
+        if note_ids is not None:
+            return list(note_ids)
+        return self.note_manager.get_note_ids(tag=tag)
+
+    def create_job(self, operation, note_ids):
+        """Record a new job and its pending notes; returns the job id"""
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown operation: {operation}")
+
+        job_id = str(uuid.uuid4())
+        now = datetime.datetime.now().isoformat()
+        with self.db.transaction() as conn:
+            conn.execute(
+                "INSERT INTO bulk_crypto_jobs (id, operation, status, created_date) VALUES (?, ?, ?, ?)",
+                (job_id, operation, "running", now)
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO bulk_crypto_items (job_id, note_id) VALUES (?, ?)",
+                ((job_id, note_id) for note_id in note_ids)
+            )
+        return job_id
+
+    def get_job(self, job_id):
+        job = self.db.fetchone("SELECT * FROM bulk_crypto_jobs WHERE id = ?", (job_id,))
+        if job is None:
+            return None
+        job = dict(job)
+        job.update(self._counts(job_id))
+        return job
+
+    def get_unfinished_jobs(self):
+        jobs = self.db.fetchall(
+            "SELECT id FROM bulk_crypto_jobs WHERE status != 'finished' ORDER BY created_date"
+        )
+        return [self.get_job(job['id']) for job in jobs]
+
+    def _counts(self, job_id):
+        counts = {PENDING: 0, DONE: 0, SKIPPED: 0, FAILED: 0}
+        for row in self.db.fetchall(
+            "SELECT status, COUNT(*) AS count FROM bulk_crypto_items WHERE job_id = ? GROUP BY status",
+            (job_id,)
+        ):
+            counts[row['status']] = row['count']
+        counts['total'] = sum(counts.values())
+        return counts
+
+    def run(self, operation, password, new_password=None, tag=None, note_ids=None,
+            progress=None, cancelled=None):
+        """
+        Start a job over the notes matching the filter and run it to completion
+
+        Args:
+            operation: ENCRYPT, DECRYPT, REKEY (which drops the notes'
+                encrypted history) or INDEX (which turns the blind index on
+                first)
+            password: Password to encrypt with, or the current password
+            new_password: Replacement password for REKEY
+            tag: Only notes with this tag
+            note_ids: Only these notes (takes precedence over tag)
+            progress: Optional callable(processed, total)
+            cancelled: Optional callable returning True to stop after the
+                batches already in flight; the job can then be resumed
+
+        Returns:
+            Job dictionary with per-status counts
+        """
+        if operation == REKEY and not new_password:
+            raise ValueError("A new password is required to re-key notes")
+        if operation == INDEX:
+            self.note_manager.blind_index.enable()
+
+        job_id = self.create_job(operation, self.select_notes(tag=tag, note_ids=note_ids))
+        return self.resume(job_id, password, new_password, progress=progress, cancelled=cancelled)
+
+    def resume(self, job_id, password, new_password=None, progress=None, cancelled=None,
+               retry_failed=False):
+        """Process the pending (and optionally failed) notes of a job"""
+        job = self.get_job(job_id)
+        if job is None:
+            raise ValueError(f"Unknown job: {job_id}")
+        operation = job['operation']
+
+        statuses = (PENDING, FAILED) if retry_failed else (PENDING,)
+        pending = [
+            row['note_id'] for row in self.db.fetchall(
+                f"SELECT note_id FROM bulk_crypto_items WHERE job_id = ? AND status IN ({', '.join('?' * len(statuses))})",
+                (job_id,) + statuses
+            )
+        ]
+
+        total = job['total']
+        processed = total - len(pending)
+        if progress:
+            progress(processed, total)
+
+        batches = (pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size))
+        index_salt = self.note_manager.blind_index.salt
+
+        if self.workers <= 1 or len(pending) < MIN_NOTES_FOR_POOL:
+            handler = EncryptionHandler()
+            for batch_ids in batches:
+                if cancelled and cancelled():
+                    break
+                notes, stored = self._load_batch(batch_ids)
+                results = _process_notes(handler, operation, notes, password, new_password, index_salt)
+                processed += self._write_results(job_id, operation, batch_ids, results, stored)
+                if progress:
+                    progress(processed, total)
+        else:
+            processed = self._run_pool(job_id, operation, batches, password, new_password, index_salt,
+                                       processed, total, progress, cancelled)
+
+        if not self._counts(job_id)[PENDING]:
+            self.db.execute(
+                "UPDATE bulk_crypto_jobs SET status = 'finished', finished_date = ? WHERE id = ?",
+                (datetime.datetime.now().isoformat(), job_id)
+            )
+        return self.get_job(job_id)
+
+    def _run_pool(self, job_id, operation, batches, password, new_password, index_salt,
+                  processed, total, progress, cancelled):
+        # Imported here: the UI imports this module, but only a bulk job
+        # needs worker processes
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+        # spawn rather than fork: the caller may be a Qt application
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                 initializer=_init_worker,
+                                 initargs=(password, new_password, index_salt)) as pool:
+            in_flight = {}
+            # Keep a bounded number of batches in flight so memory use does
+            # not grow with the number of notes
+            max_in_flight = self.workers * 2
+            exhausted = False
+            while in_flight or not exhausted:
+                while not exhausted and len(in_flight) < max_in_flight:
+                    if cancelled and cancelled():
+                        exhausted = True
+                        break
+                    batch_ids = next(batches, None)
+                    if batch_ids is None:
+                        exhausted = True
+                        break
+                    notes, stored = self._load_batch(batch_ids)
+                    future = pool.submit(_process_batch, operation, notes)
+                    in_flight[future] = (batch_ids, stored)
+
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch_ids, stored = in_flight.pop(future)
+                    processed += self._write_results(job_id, operation, batch_ids, future.result(), stored)
+                    if progress:
+                        progress(processed, total)
+        return processed
+
+    def _load_batch(self, note_ids):
+        """(note_id, content, encrypted) of each note, and the stored contents by id"""
+        placeholders = ", ".join("?" * len(note_ids))
+        rows = self.db.fetchall(f"SELECT id, content, encrypted FROM notes WHERE id IN ({placeholders})", note_ids)
+        codec = self.note_manager.codec
+        notes = [(row['id'], codec.decode(row['content']), bool(row['encrypted'])) for row in rows]
+        return notes, {row['id']: row['content'] for row in rows}
+
+    def _write_results(self, job_id, operation, batch_ids, results, stored):
+        """
+        Write one batch of results and its journal entries in one transaction
+
+        A note edited since the batch was loaded (stored holds the contents
+        read then) keeps the edit: its result is marked failed, so resuming
+        with retry_failed processes it again.
+        """
+        seen = set()
+        with self.db.transaction():
+            written = [
+                (note_id, content, encrypted)
+                for note_id, status, content, encrypted, tokens, error in results
+                if status == DONE and content is not None
+            ]
+            updated = set(self.note_manager.update_note_contents(written, expected=stored))
+            stale = {note_id for note_id, content, encrypted in written if note_id not in updated}
+            # Results that leave the body as it was (tokens only, skipped)
+            # hold only if it has not changed either
+            others = [
+                note_id for note_id, status, content, encrypted, tokens, error in results
+                if status != FAILED and note_id not in updated and note_id not in stale
+            ]
+            if others:
+                rows = self.db.fetchall(
+                    f"SELECT id, content FROM notes WHERE id IN ({', '.join('?' * len(others))})", others
+                )
+                current = {row['id']: row['content'] for row in rows}
+                stale.update(note_id for note_id in others if current.get(note_id) != stored.get(note_id))
+            if stale:
+                results = [
+                    (note_id, FAILED, None, None, None, "Note changed while the job ran")
+                    if note_id in stale else (note_id, status, content, encrypted, tokens, error)
+                    for note_id, status, content, encrypted, tokens, error in results
+                ]
+
+            if operation == REKEY:
+                # Their history is sealed with the old password
+                self.note_manager.revisions.drop_encrypted(
+                    [note_id for note_id, status, content, encrypted, tokens, error in results if status == DONE]
+                )
+            # After the new contents, whose triggers drop the old tokens
+            self.note_manager.blind_index.add_tokens(
+                (note_id, tokens)
+                for note_id, status, content, encrypted, tokens, error in results
+                if tokens is not None
+            )
+            self.db.executemany(
+                "UPDATE bulk_crypto_items SET status = ?, error = ? WHERE job_id = ? AND note_id = ?",
+                [(status, error, job_id, note_id) for note_id, status, content, encrypted, tokens, error in results]
+            )
+            seen.update(result[0] for result in results)
+
+            # Notes deleted since the job was created
+            missing = [note_id for note_id in batch_ids if note_id not in seen]
+            self.db.executemany(
+                "UPDATE bulk_crypto_items SET status = ?, error = ? WHERE job_id = ? AND note_id = ?",
+                [(SKIPPED, "Note no longer exists", job_id, note_id) for note_id in missing]
+            )
+        return len(batch_ids)
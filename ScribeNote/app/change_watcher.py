@@ -0,0 +1,110 @@
+import sqlite3
+
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+from .database import retry_busy
+
+# How often PRAGMA data_version is checked
+POLL_INTERVAL_MS = 500
+
+# Above this many changed notes, reloading the list is cheaper than
+# applying them one by one
+MAX_CHANGES = 500
+
+
+class ChangeWatcher(QObject):
+    """
+    Picks up changes other connections (windows, processes) made to the notes
+
+    Every POLL_INTERVAL_MS the UI thread's connection is asked for PRAGMA
+    data_version, which only changes after another connection commits. Only
+    then are the new change_log entries and the summaries of the notes they
+    name read, on the executor, so the work depends on the number of
+    changes, not on the number of notes. Busy or locked errors are retried
+    and otherwise left for the next poll.
+
+    Changes made by this process are reported too; applying a summary the
+    list already shows does nothing.
+    """
+
+    # {note_id: summary, or None for notes that are gone}
+    notes_changed = pyqtSignal(object)
+    # set of ids of notes whose attachments changed
+    attachments_changed = pyqtSignal(object)
+    # Too much changed (or the log was pruned past what was seen): reload
+    reset = pyqtSignal()
+
+    def __init__(self, note_manager, executor, interval=POLL_INTERVAL_MS, parent=None):
+        super().__init__(parent)
+        self.note_manager = note_manager
+        self.executor = executor
+        self._seq = None
+        self._data_version = None
+        self._reading = False
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.poll)
+
+    def start(self):
+        """Watch for changes made from now on"""
+        self._seq = retry_busy(self.note_manager.changes.latest_seq)
+        self._data_version = retry_busy(self.note_manager.db.data_version)
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def poll(self):
+        """Read new changes if another connection committed since the last poll"""
+        if self._reading or self._seq is None:
+            return
+        try:
+            version = retry_busy(self.note_manager.db.data_version)
+        except sqlite3.OperationalError:
+            return
+        if version == self._data_version:
+            return
+        self._data_version = version
+        self._reading = True
+        self.executor.submit(
+            self._read, self._seq,
+            on_result=self._apply,
+            on_error=self._failed,
+            key="change-watcher"
+        )
+
+    def _read(self, seq):
+        # Worker thread
+        return retry_busy(lambda: self._read_changes(seq))
+
+    def _read_changes(self, seq):
+        feed = self.note_manager.changes
+        changes = feed.changes_since(seq, limit=MAX_CHANGES + 1)
+        if changes is None or len(changes) > MAX_CHANGES:
+            return feed.latest_seq(), None, None
+        if not changes:
+            return seq, {}, set()
+
+        note_ids, attachment_note_ids = feed.changed_notes(changes)
+        summaries = dict.fromkeys(note_ids)
+        for summary in self.note_manager.get_note_summaries_by_ids(note_ids):
+            summaries[summary['id']] = summary
+        return changes[-1]['seq'], summaries, attachment_note_ids
+
+    def _apply(self, result):
+        self._reading = False
+        seq, summaries, attachment_note_ids = result
+        self._seq = seq
+        if summaries is None:
+            self.reset.emit()
+            return
+        if summaries:
+            self.notes_changed.emit(summaries)
+        if attachment_note_ids:
+            self.attachments_changed.emit(attachment_note_ids)
+
+    def _failed(self, error):
+        # Still busy after the retries; data_version is read again next time
+        self._reading = False
+        self._data_version = None
@@ -0,0 +1,119 @@
+from .compression import BODY_CHANGED
+from .database import split_statements
+
+# What a change_log entry is about
+NOTE = "note"
+ATTACHMENT = "attachment"
+
+# Entries kept; every CHANGE_LOG_PRUNE_EVERY entries the older ones are
+# deleted. A reader that falls further behind reloads everything instead.
+CHANGE_LOG_SIZE = 10000
+CHANGE_LOG_PRUNE_EVERY = 1000
+
+# Every insert, update and delete of a note or attachment, in commit order,
+# written by triggers so changes made by any process are seen. Updates that
+# only change how a body is stored (see BodyCodec) are not changes.
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS change_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    object_id TEXT NOT NULL,
+    note_id TEXT NOT NULL,
+    operation TEXT NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS change_log_after_insert AFTER INSERT ON change_log
+WHEN new.seq % {CHANGE_LOG_PRUNE_EVERY} = 0 BEGIN
+    DELETE FROM change_log WHERE seq <= new.seq - {CHANGE_LOG_SIZE};
+END;
+
+CREATE TRIGGER IF NOT EXISTS change_log_note_insert AFTER INSERT ON notes BEGIN
+    INSERT INTO change_log (kind, object_id, note_id, operation) VALUES ('note', new.id, new.id, 'insert');
+END;
+
+CREATE TRIGGER IF NOT EXISTS change_log_note_update AFTER UPDATE ON notes
+WHEN old.title IS NOT new.title OR old.modified_date IS NOT new.modified_date
+    OR old.metadata IS NOT new.metadata OR old.encrypted IS NOT new.encrypted
+    OR old.position IS NOT new.position OR {BODY_CHANGED}
+BEGIN
+    INSERT INTO change_log (kind, object_id, note_id, operation) VALUES ('note', new.id, new.id, 'update');
+END;
+
+CREATE TRIGGER IF NOT EXISTS change_log_note_delete AFTER DELETE ON notes BEGIN
+    INSERT INTO change_log (kind, object_id, note_id, operation) VALUES ('note', old.id, old.id, 'delete');
+END;
+
+CREATE TRIGGER IF NOT EXISTS change_log_attachment_insert AFTER INSERT ON attachments BEGIN
+    INSERT INTO change_log (kind, object_id, note_id, operation) VALUES ('attachment', new.id, new.note_id, 'insert');
+END;
+
+CREATE TRIGGER IF NOT EXISTS change_log_attachment_update AFTER UPDATE ON attachments BEGIN
+    INSERT INTO change_log (kind, object_id, note_id, operation) VALUES ('attachment', new.id, new.note_id, 'update');
+END;
+
+CREATE TRIGGER IF NOT EXISTS change_log_attachment_delete AFTER DELETE ON attachments BEGIN
+    INSERT INTO change_log (kind, object_id, note_id, operation) VALUES ('attachment', old.id, old.note_id, 'delete');
+END;
+'''
+
+
+class ChangeFeed:
+    """
+    Reads the change log: what changed since a sequence number
+
+    Sequence numbers only grow (the log uses AUTOINCREMENT), so a reader
+    keeps the last one it has seen and asks for what came after it.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def initialize(self, conn):
+        for statement in split_statements(SCHEMA):
+            conn.execute(statement)
+
+    def latest_seq(self):
+        """Sequence number of the newest change, 0 if there is none yet"""
+        row = self.db.fetchone("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'")
+        return row['seq'] if row else 0
+
+    def changes_since(self, seq, limit=None):
+        """
+        Changes after a sequence number, oldest first
+
+        Args:
+            seq: Last sequence number already seen
+            limit: Maximum number of changes to return
+
+        Returns:
+            List of dictionaries with seq, kind, object_id, note_id and
+            operation, or None if the log no longer reaches back to seq
+            (older entries were pruned) and the reader has to reload
+        """
+        rows = self.db.fetchall(
+            "SELECT seq, kind, object_id, note_id, operation FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?",
+            (seq, -1 if limit is None else limit)
+        )
+        if rows and rows[0]['seq'] != seq + 1:
+            return None
+        if not rows and self.latest_seq() > seq:
+            return None
+        return [dict(row) for row in rows]
+
+    @staticmethod
+    def changed_notes(changes):
+        """
+        Summarize changes by note
+
+        Returns:
+            (ids of notes inserted, updated or deleted, ids of notes whose
+            attachments changed)
+        """
+        notes = set()
+        attachments = set()
+        for change in changes:
+            if change['kind'] == NOTE:
+                notes.add(change['note_id'])
+            else:
+                attachments.add(change['note_id'])
+        return notes, attachments
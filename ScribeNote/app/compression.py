@@ -0,0 +1,293 @@
+import datetime
+import re
+import struct
+import threading
+import zlib
+from collections import Counter
+
+from .database import split_statements
+from .encryption import pack_envelope, unpack_envelope, PACKED_LEGACY, PACKED_TYPES
+
+# A stored body is either TEXT, kept as it is (short or incompressible
+# bodies, and rows written before compression), or a BLOB whose first byte
+# says how the rest is encoded
+DEFLATE = 0x01      # Raw deflate of the UTF-8 text
+DICTIONARY = 0x02   # Raw deflate with a preset dictionary; a 4-byte dictionary id follows the type
+# 0x10 and up: packed encrypted envelopes (see encryption.pack_envelope)
+
+COMPRESSION_LEVEL = 6
+# Bodies shorter than this (in bytes) are not worth compressing
+MIN_COMPRESS_SIZE = 64
+
+# Deflate only looks back 32 KiB, so a larger dictionary would not be used
+MAX_DICTIONARY_SIZE = 32 * 1024
+# Dictionaries are trained on a sample of plaintext bodies...
+TRAINING_SAMPLE = 2000
+MIN_TRAINING_NOTES = 50
+# ...and only kept if they shrink the sample by at least this fraction
+MIN_DICTIONARY_GAIN = 0.03
+# Dictionaries no body uses any more are retired, and deleted only this long
+# after: another process may still have one loaded as its current dictionary
+DICTIONARY_GRACE_PERIOD = datetime.timedelta(days=7)
+# Words and word pairs are dictionary candidates; longer runs rarely repeat
+_SEGMENT_RE = re.compile(r"\S+\s+(?:\S+\s+)?")
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS compression_dictionaries (
+    id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL,
+    sample_notes INTEGER NOT NULL,
+    created_date TEXT NOT NULL,
+    retired_date TEXT
+);
+
+-- Has a row only inside compact_storage()'s transactions: the bodies it
+-- re-encodes keep their text, so the note triggers leave them alone
+CREATE TABLE IF NOT EXISTS body_reencoding (active INTEGER NOT NULL);
+'''
+
+# WHEN condition of the note update triggers for a changed body. The stored
+# bytes are compared, so writing a note does not need note_text()
+BODY_CHANGED = "(old.content IS NOT new.content AND NOT EXISTS (SELECT 1 FROM body_reencoding))"
+
+_DICTIONARY_ID = struct.Struct(">I")
+
+
+def deflate(data, dictionary=None):
+    if dictionary:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def inflate(data, dictionary=None):
+    if dictionary:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def train_dictionary(bodies, max_size=MAX_DICTIONARY_SIZE):
+    """
+    Build a preset dictionary from sample note bodies
+
+    Words and word pairs that occur in many bodies are scored by the bytes
+    they would save and packed up to max_size, the most valuable last:
+    deflate encodes nearer matches more cheaply, and the end of the
+    dictionary is nearest to the body.
+    """
+    counts = Counter()
+    for body in bodies:
+        # Counted once per body: what matters is how many bodies share it
+        counts.update(set(_SEGMENT_RE.findall(body)))
+
+    scored = sorted(
+        ((count - 1) * len(segment.encode("utf-8")), segment)
+        for segment, count in counts.items() if count > 1 and len(segment) > 3
+    )
+    chosen = []
+    size = 0
+    for score, segment in reversed(scored):
+        encoded = segment.encode("utf-8")
+        if size + len(encoded) > max_size:
+            continue
+        chosen.append(encoded)
+        size += len(encoded)
+    return b"".join(reversed(chosen))
+
+
+class BodyCodec:
+    """
+    Compressed storage of note bodies
+
+    Plaintext bodies are stored deflated, with a dictionary trained on the
+    notes when one has been trained (see train()), so short notes compress
+    well too. Encrypted bodies are compressed before encryption (see
+    EncryptionHandler.encrypt) and stored here as packed binary envelopes
+    instead of base64 text. decode() reads every stored form, including
+    plain TEXT from before compression.
+
+    Dictionaries are kept in memory once loaded; decode() is also the
+    note_text() SQL function used by the full-text index. Writers call
+    refresh() in their transaction, so a dictionary another process trained
+    or retired since is picked up before a body is encoded.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._dictionaries = {}
+        self._current = None
+        self._lock = threading.Lock()
+
+    def initialize(self, conn):
+        for statement in split_statements(SCHEMA):
+            conn.execute(statement)
+        # Added after the first release
+        columns = [row['name'] for row in conn.execute("PRAGMA table_info(compression_dictionaries)")]
+        if 'retired_date' not in columns:
+            conn.execute("ALTER TABLE compression_dictionaries ADD COLUMN retired_date TEXT")
+        self._load(conn)
+
+    def _load(self, conn):
+        rows = conn.execute("SELECT id, data, retired_date FROM compression_dictionaries ORDER BY id").fetchall()
+        active = [row['id'] for row in rows if row['retired_date'] is None]
+        with self._lock:
+            self._dictionaries = {row['id']: bytes(row['data']) for row in rows}
+            self._current = active[-1] if active else None
+
+    def refresh(self, conn):
+        """
+        Reload the dictionaries if the current one changed in the database
+
+        Call in the write transaction that stores the encoded bodies: another
+        process may have trained a new dictionary or retired this one.
+        """
+        row = conn.execute("SELECT MAX(id) FROM compression_dictionaries WHERE retired_date IS NULL").fetchone()
+        if row[0] != self._current:
+            self._load(conn)
+
+    @property
+    def dictionary_id(self):
+        """Id of the dictionary new bodies are compressed with, or None"""
+        return self._current
+
+    def _dictionary(self, dictionary_id):
+        dictionary = self._dictionaries.get(dictionary_id)
+        if dictionary is None:
+            # Trained by another process since this one loaded them
+            self._load(self.db.connection)
+            dictionary = self._dictionaries.get(dictionary_id)
+            if dictionary is None:
+                raise ValueError(f"Unknown compression dictionary: {dictionary_id}")
+        return dictionary
+
+    def encode(self, content, encrypted=False):
+        """Stored form of a note body (content as NoteManager callers pass it)"""
+        if not content:
+            return content
+        if encrypted:
+            packed = pack_envelope(content)
+            return packed if packed is not None else content
+
+        data = content.encode("utf-8")
+        if len(data) < MIN_COMPRESS_SIZE:
+            return content
+        dictionary_id = self._current
+        if dictionary_id is not None:
+            encoded = bytes((DICTIONARY,)) + _DICTIONARY_ID.pack(dictionary_id) + deflate(
+                data, self._dictionaries[dictionary_id]
+            )
+        else:
+            encoded = bytes((DEFLATE,)) + deflate(data)
+        return encoded if len(encoded) < len(data) else content
+
+    def decode(self, stored):
+        """Note body from its stored form"""
+        if stored is None or isinstance(stored, str):
+            return stored
+        stored = bytes(stored)
+        if not stored:
+            return ""
+        kind = stored[0]
+        if kind == DEFLATE:
+            return inflate(stored[1:]).decode("utf-8")
+        if kind == DICTIONARY:
+            (dictionary_id,) = _DICTIONARY_ID.unpack_from(stored, 1)
+            return inflate(stored[1 + _DICTIONARY_ID.size:], self._dictionary(dictionary_id)).decode("utf-8")
+        if kind == PACKED_LEGACY or kind in PACKED_TYPES:
+            return unpack_envelope(stored)
+        raise ValueError(f"Unknown stored body type: {kind:#x}")
+
+    def is_current(self, stored, encrypted):
+        """Whether a stored body is already in the form encode() would write"""
+        if stored is None or (isinstance(stored, str) and not stored):
+            return True
+        if encrypted:
+            return not isinstance(stored, str) or pack_envelope(stored) is None
+        if isinstance(stored, str):
+            return len(stored.encode("utf-8")) < MIN_COMPRESS_SIZE
+        if stored[0] == DICTIONARY:
+            return _DICTIONARY_ID.unpack_from(stored, 1)[0] == self._current
+        return self._current is None
+
+    def train(self, conn, sample_size=TRAINING_SAMPLE):
+        """
+        Train a dictionary on a sample of plaintext bodies and make it current
+
+        Runs in the caller's transaction. Returns the new dictionary's id, or
+        None if there are too few notes or the dictionary would not help.
+        """
+        rows = conn.execute(
+            "SELECT content FROM notes WHERE encrypted = 0 AND content IS NOT NULL "
+            "ORDER BY random() LIMIT ?",
+            (sample_size,)
+        ).fetchall()
+        bodies = [body for body in (self.decode(row['content']) for row in rows) if body]
+        if len(bodies) < MIN_TRAINING_NOTES:
+            return None
+
+        # Train on one half and judge on the other, so the gain is not just
+        # the dictionary remembering its own sample
+        training, validation = bodies[::2], bodies[1::2]
+        dictionary = train_dictionary(training)
+        if not dictionary:
+            return None
+        current = self._dictionaries.get(self._current) if self._current is not None else None
+        encoded = [body.encode("utf-8") for body in validation]
+        baseline = sum(len(deflate(data, current)) for data in encoded)
+        trained = sum(len(deflate(data, dictionary)) for data in encoded)
+        if trained > baseline * (1 - MIN_DICTIONARY_GAIN):
+            return None
+
+        cursor = conn.execute(
+            "INSERT INTO compression_dictionaries (data, sample_notes, created_date) VALUES (?, ?, ?)",
+            (dictionary, len(bodies), datetime.datetime.now().isoformat())
+        )
+        with self._lock:
+            self._dictionaries[cursor.lastrowid] = dictionary
+            self._current = cursor.lastrowid
+        return cursor.lastrowid
+
+    def retire_unused_dictionaries(self, conn):
+        """
+        Retire dictionaries, other than the current one, that no body uses any more
+
+        Retired dictionaries are still read but no longer written with; they
+        are deleted once they have been retired for DICTIONARY_GRACE_PERIOD
+        and are still unused, so a process that loaded one before it was
+        retired can still read (or, until its next refresh(), write) with it.
+        Returns the number of dictionaries retired.
+        """
+        self.refresh(conn)
+        used = {self._current}
+        rows = conn.execute(
+            "SELECT DISTINCT substr(content, 2, 4) AS id FROM notes "
+            "WHERE typeof(content) = 'blob' AND substr(content, 1, 1) = ?",
+            (bytes((DICTIONARY,)),)
+        )
+        used.update(_DICTIONARY_ID.unpack(bytes(row['id']))[0] for row in rows)
+        now = datetime.datetime.now()
+        unused = [
+            row for row in conn.execute("SELECT id, retired_date FROM compression_dictionaries").fetchall()
+            if row['id'] not in used
+        ]
+        retired = [row['id'] for row in unused if row['retired_date'] is None]
+        expired = [
+            row['id'] for row in unused
+            if row['retired_date'] is not None
+            and datetime.datetime.fromisoformat(row['retired_date']) < now - DICTIONARY_GRACE_PERIOD
+        ]
+        conn.executemany(
+            "UPDATE compression_dictionaries SET retired_date = ? WHERE id = ?",
+            [(now.isoformat(), dictionary_id) for dictionary_id in retired]
+        )
+        conn.executemany(
+            "DELETE FROM compression_dictionaries WHERE id = ?",
+            [(dictionary_id,) for dictionary_id in expired]
+        )
+        with self._lock:
+            for dictionary_id in expired:
+                self._dictionaries.pop(dictionary_id, None)
+        return len(retired)
@@ -0,0 +1,355 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from .instrumentation import instrumentation, statement_name, EXPLAINABLE
+
+# Pragmas applied to every connection when it is opened. WAL lets readers and
+# a writer work concurrently, and with synchronous=NORMAL a commit no longer
+# needs an fsync (only checkpoints do).
+CONNECTION_PRAGMAS = (
+    # Must come before anything creates a table: new databases can then hand
+    # free pages back with PRAGMA incremental_vacuum (existing ones switch
+    # at their next VACUUM, see NoteManager.compact_storage)
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -65536",  # 64 MiB page cache
+    "PRAGMA mmap_size = 268435456",  # 256 MiB memory-mapped I/O
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# Number of prepared statements sqlite3 keeps per connection
+STATEMENT_CACHE_SIZE = 256
+
+# Deletes give space back to the filesystem once this many pages (4 MiB at
+# the default page size) are free, rather than after every delete
+RECLAIM_FREE_PAGES = 1024
+
+# Another process can hold the write lock for longer than busy_timeout (a
+# large import batch, VACUUM); operations that are safe to repeat are then
+# retried this many times, waiting twice as long each time
+BUSY_RETRIES = 5
+BUSY_RETRY_DELAY = 0.05
+
+# Primary result codes of "database is busy/locked" errors
+_SQLITE_BUSY = 5
+_SQLITE_LOCKED = 6
+
+
+def split_statements(script):
+    """
+    Split an SQL script into individual statements
+
+    Used instead of executescript(), which commits any open transaction
+    before running. Trigger bodies are kept intact.
+    """
+    statements = []
+    current = ""
+    for line in script.splitlines(keepends=True):
+        current += line
+        if sqlite3.complete_statement(current):
+            statements.append(current.strip())
+            current = ""
+    if current.strip():
+        statements.append(current.strip())
+    return statements
+
+
+def drop_triggers_containing(conn, text):
+    """Drop the triggers whose SQL contains text, so an updated definition can replace them"""
+    rows = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND instr(sql, ?) > 0", (text,)
+    ).fetchall()
+    for row in rows:
+        conn.execute(f"DROP TRIGGER {row['name']}")
+
+
+def is_busy_error(error):
+    """Whether an exception is SQLite reporting that another connection holds a lock"""
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xff in (_SQLITE_BUSY, _SQLITE_LOCKED)
+    message = str(error)
+    return "locked" in message or "busy" in message
+
+
+def retry_busy(fn, attempts=BUSY_RETRIES, delay=BUSY_RETRY_DELAY):
+    """
+    Call fn, retrying with backoff while the database is busy or locked
+
+    Only for work that has no effect when it fails, such as reads or a
+    whole transaction. The last error is raised if every attempt fails.
+    """
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except sqlite3.OperationalError as e:
+            if not is_busy_error(e) or attempt == attempts - 1:
+                raise
+            instrumentation.count("db.busy_retry")
+            time.sleep(delay * 2 ** attempt)
+
+
+class TracedConnection(sqlite3.Connection):
+    """
+    Connection that times its statements while instrumentation is enabled
+
+    Only execute() itself is timed, which includes stepping to the first
+    row; rows fetched later are not. Slow statements are logged with their
+    EXPLAIN QUERY PLAN.
+    """
+
+    def execute(self, sql, parameters=()):
+        if not instrumentation.enabled:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(sql, parameters, start, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not instrumentation.enabled:
+            return super().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # The parameters are consumed, so there is no plan to capture
+            self._record(sql, None, start, time.perf_counter() - start)
+
+    def _record(self, sql, parameters, start, duration):
+        text = " ".join(sql.split())
+        detail = None
+        if instrumentation.is_slow(duration):
+            detail = {'sql': text[:2000], 'query_plan': self.query_plan(sql, parameters)}
+        instrumentation.record(statement_name(sql), "db", start, duration, {'sql': text[:200]}, detail)
+
+    def query_plan(self, sql, parameters=()):
+        """EXPLAIN QUERY PLAN of a statement as indented lines, or None"""
+        if parameters is None or not sql.lstrip().upper().startswith(EXPLAINABLE):
+            return None
+        try:
+            rows = super().execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+        except sqlite3.Error:
+            return None
+        depth = {0: 0}
+        lines = []
+        for node_id, parent, _, detail in rows:
+            depth[node_id] = depth.get(parent, 0) + 1
+            lines.append("  " * (depth[node_id] - 1) + detail)
+        return lines
+
+
+class ConnectionManager:
+    """
+    Persistent, per-thread SQLite connections shared by every component
+
+    Connections are kept by thread id. Those of threads that have ended are
+    closed whenever another thread connects (and by close_finished()), so
+    short-lived threads do not leave connections and file descriptors
+    behind. Threads Python does not know about, such as QThreadPool's, count
+    as alive for as long as the process runs, so those pools keep their
+    threads (see TaskExecutor).
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def for_path(cls, db_path):
+        """Return the shared manager for a database file, creating it if needed"""
+        key = os.path.abspath(db_path)
+        with cls._instances_lock:
+            manager = cls._instances.get(key)
+            if manager is None:
+                manager = cls(key)
+                cls._instances[key] = manager
+            return manager
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        # Thread id -> (thread, connection)
+        self._connections = {}
+        self._connections_lock = threading.Lock()
+        # SQL functions defined on every connection: name -> (arguments, function)
+        self._functions = {}
+
+    def _connect(self):
+        # isolation_level=None puts sqlite3 in autocommit mode; grouping
+        # statements is done explicitly through transaction()
+        conn = sqlite3.connect(
+            self.db_path,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            factory=TracedConnection,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+
+        with self._connections_lock:
+            for name, (num_params, function) in self._functions.items():
+                conn.create_function(name, num_params, function, deterministic=True)
+            self._connections[threading.get_ident()] = (threading.current_thread(), conn)
+        return conn
+
+    def close_finished(self):
+        """Close the connections of threads that have ended; returns how many"""
+        with self._connections_lock:
+            finished = [ident for ident, (thread, _) in self._connections.items() if not thread.is_alive()]
+            connections = [self._connections.pop(ident)[1] for ident in finished]
+        for conn in connections:
+            conn.close()
+        return len(connections)
+
+    def create_function(self, name, num_params, function):
+        """
+        Make a deterministic Python function callable from SQL
+
+        It is defined on every connection, open or opened later. Schema
+        objects that use it (triggers, views) only work on connections that
+        have it, so other tools such as the sqlite3 shell cannot write notes.
+        """
+        with self._connections_lock:
+            self._functions[name] = (num_params, function)
+            for _, conn in self._connections.values():
+                conn.create_function(name, num_params, function, deterministic=True)
+
+    @property
+    def connection(self):
+        """The connection owned by the calling thread"""
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            # Qt runs each pool task with fresh thread-local storage, so a
+            # thread seen before is found by its id
+            ident = threading.get_ident()
+            thread = threading.current_thread()
+            with self._connections_lock:
+                entry = self._connections.get(ident)
+                if entry is not None:
+                    # The id of a thread that ended may have been reused
+                    conn = entry[1]
+                    self._connections[ident] = (thread, conn)
+            if conn is None:
+                self.close_finished()
+                conn = self._connect()
+            self._local.connection = conn
+            self._local.depth = 0
+            self._local.after_commit = []
+        return conn
+
+    def execute(self, sql, params=()):
+        return self.connection.execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.connection.executemany(sql, seq_of_params)
+
+    def executescript(self, script):
+        return self.connection.executescript(script)
+
+    def fetchone(self, sql, params=()):
+        return self.connection.execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()):
+        return self.connection.execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group several statements into a single commit
+
+        Transactions nest: only the outermost block issues BEGIN/COMMIT, so
+        methods that use transaction() internally can be combined by callers.
+        Any exception rolls back the whole outermost transaction.
+        """
+        conn = self.connection
+        if self._local.depth == 0:
+            # Nothing has happened yet if taking the write lock fails
+            retry_busy(lambda: conn.execute("BEGIN IMMEDIATE"))
+        self._local.depth += 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                self._local.after_commit = []
+                conn.execute("ROLLBACK")
+            raise
+        else:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.execute("COMMIT")
+                callbacks, self._local.after_commit = self._local.after_commit, []
+                for callback in callbacks:
+                    callback()
+
+    def after_commit(self, callback):
+        """
+        Call callback() once the calling thread's outermost transaction commits
+
+        For work that cannot be rolled back, such as deleting files. It is
+        called at once outside a transaction and dropped if the transaction
+        rolls back.
+        """
+        if getattr(self._local, "depth", 0) == 0:
+            callback()
+        else:
+            self._local.after_commit.append(callback)
+
+    def data_version(self):
+        """
+        PRAGMA data_version of the calling thread's connection
+
+        Changes whenever another connection, in this process or another one,
+        commits; a cheap way to find out whether anything needs re-reading.
+        """
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def reclaim_space(self, min_free_pages=0, max_pages=None):
+        """
+        Hand free pages at the end of the file back to the file system
+
+        Does nothing unless at least min_free_pages pages are free, inside a
+        transaction, or for a database not (yet) in auto_vacuum=INCREMENTAL
+        mode.
+
+        Returns:
+            Number of pages released
+        """
+        conn = self.connection
+        if conn.in_transaction or conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not free_pages or free_pages < min_free_pages:
+            return 0
+        # Each step of the pragma releases one page, and execute() only takes
+        # the first step; executescript() runs it to the end
+        conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages or 0)})")
+        return free_pages - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def close(self):
+        """Close the calling thread's connection"""
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            return
+        self._local.connection = None
+        with self._connections_lock:
+            self._connections.pop(threading.get_ident(), None)
+        conn.close()
+
+    def close_all(self):
+        """Close every connection opened by this manager"""
+        with self._connections_lock:
+            connections, self._connections = self._connections, {}
+        for _, conn in connections.values():
+            conn.close()
+        self._local = threading.local()
@@ -0,0 +1,326 @@
+from PyQt5.QtWidgets import (QDialog, QFormLayout, QComboBox, QLineEdit,
+                             QDialogButtonBox, QMessageBox, QVBoxLayout, QHBoxLayout, QSplitter,
+                             QListWidget, QListWidgetItem, QTextEdit, QCheckBox, QLabel,
+                             QTableWidget, QTableWidgetItem, QHeaderView, QFileDialog)
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtGui import QFontDatabase
+
+from .bulk_crypto import ENCRYPT, DECRYPT, REKEY, INDEX
+from .revisions import unified_diff
+from .instrumentation import instrumentation
+from .tasks import WRITE
+
+
+class BulkCryptoDialog(QDialog):
+    """Collects the operation, note filter and passwords for a bulk crypto job"""
+
+    SCOPE_ALL = 0
+    SCOPE_TAG = 1
+    SCOPE_CURRENT = 2
+
+    def __init__(self, parent=None, has_current_note=False):
+        super().__init__(parent)
+        self.setWindowTitle("Bulk Encryption")
+
+        layout = QFormLayout(self)
+
+        self.operation_combo = QComboBox()
+        self.operation_combo.addItem("Encrypt notes", ENCRYPT)
+        self.operation_combo.addItem("Decrypt notes", DECRYPT)
+        self.operation_combo.addItem("Change password", REKEY)
+        self.operation_combo.addItem("Make searchable", INDEX)
+        self.operation_combo.setItemData(
+            3, "Index the words of encrypted notes so a search finds them once their password is given",
+            Qt.ToolTipRole
+        )
+        self.operation_combo.currentIndexChanged.connect(self.update_fields)
+        layout.addRow("Operation:", self.operation_combo)
+
+        self.scope_combo = QComboBox()
+        self.scope_combo.addItems(["All notes", "Notes with tag", "Selected note"])
+        if not has_current_note:
+            self.scope_combo.model().item(self.SCOPE_CURRENT).setEnabled(False)
+        self.scope_combo.currentIndexChanged.connect(self.update_fields)
+        layout.addRow("Notes:", self.scope_combo)
+
+        self.tag_edit = QLineEdit()
+        layout.addRow("Tag:", self.tag_edit)
+
+        self.password_edit = QLineEdit()
+        self.password_edit.setEchoMode(QLineEdit.Password)
+        layout.addRow("Password:", self.password_edit)
+
+        self.new_password_edit = QLineEdit()
+        self.new_password_edit.setEchoMode(QLineEdit.Password)
+        layout.addRow("New password:", self.new_password_edit)
+
+        self.buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        self.buttons.accepted.connect(self.validate)
+        self.buttons.rejected.connect(self.reject)
+        layout.addRow(self.buttons)
+
+        self.update_fields()
+
+    def update_fields(self):
+        self.tag_edit.setEnabled(self.scope_combo.currentIndex() == self.SCOPE_TAG)
+        self.new_password_edit.setEnabled(self.operation() == REKEY)
+
+    def validate(self):
+        if not self.password_edit.text():
+            QMessageBox.warning(self, "Bulk Encryption", "Enter a password.")
+            return
+        if self.operation() == REKEY and not self.new_password_edit.text():
+            QMessageBox.warning(self, "Bulk Encryption", "Enter the new password.")
+            return
+        if self.scope_combo.currentIndex() == self.SCOPE_TAG and not self.tag_edit.text().strip():
+            QMessageBox.warning(self, "Bulk Encryption", "Enter a tag.")
+            return
+        self.accept()
+
+    def operation(self):
+        return self.operation_combo.currentData()
+
+    def scope(self):
+        return self.scope_combo.currentIndex()
+
+    def tag(self):
+        return self.tag_edit.text().strip()
+
+    def passwords(self):
+        new_password = self.new_password_edit.text() if self.operation() == REKEY else None
+        return self.password_edit.text(), new_password
+
+
+class RevisionHistoryDialog(QDialog):
+    """
+    Lists a note's revisions and shows what each one changed
+
+    Revisions are rebuilt on the executor. Accepting the dialog restores the
+    selected revision (see restored_revision).
+    """
+
+    def __init__(self, revision_store, note_id, executor, password=None, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Note History")
+        self.resize(800, 500)
+        self.revision_store = revision_store
+        self.note_id = note_id
+        self.executor = executor
+        self.password = password
+        self._revision = None
+
+        layout = QVBoxLayout(self)
+        splitter = QSplitter(Qt.Horizontal)
+        layout.addWidget(splitter)
+
+        self.revision_list = QListWidget()
+        self.revision_list.currentRowChanged.connect(self.show_revision)
+        splitter.addWidget(self.revision_list)
+
+        self.diff_view = QTextEdit()
+        self.diff_view.setReadOnly(True)
+        self.diff_view.setLineWrapMode(QTextEdit.NoWrap)
+        self.diff_view.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        splitter.addWidget(self.diff_view)
+        splitter.setSizes([250, 550])
+
+        self.buttons = QDialogButtonBox(QDialogButtonBox.Close)
+        self.restore_button = self.buttons.addButton("Restore", QDialogButtonBox.AcceptRole)
+        self.restore_button.setEnabled(False)
+        self.buttons.accepted.connect(self.accept)
+        self.buttons.rejected.connect(self.reject)
+        layout.addWidget(self.buttons)
+
+        # Listed on the write lane, so saves still queued there are included
+        self.revisions = []
+        self.executor.submit(
+            revision_store.list_revisions, note_id,
+            on_result=self._revisions_loaded,
+            on_error=lambda error: self.diff_view.setPlainText(f"Could not load history: {str(error)}"),
+            lane=WRITE
+        )
+
+    def _revisions_loaded(self, revisions):
+        self.revisions = revisions
+        for revision in revisions:
+            item = QListWidgetItem(f"#{revision['revision']}  {revision['created_date'][:19].replace('T', ' ')}")
+            item.setToolTip(f"{revision['title']}\n{revision['size']} characters")
+            self.revision_list.addItem(item)
+        if revisions:
+            self.revision_list.setCurrentRow(0)
+        else:
+            self.diff_view.setPlainText("No history yet")
+
+    def show_revision(self, row):
+        self._revision = None
+        self.restore_button.setEnabled(False)
+        if row < 0:
+            self.diff_view.clear()
+            return
+
+        revision = self.revisions[row]['revision']
+        # The list is newest first, so the row below is the previous revision
+        previous = self.revisions[row + 1]['revision'] if row + 1 < len(self.revisions) else None
+        self.diff_view.setPlainText("Loading...")
+        self.executor.submit(
+            self._load_revision, revision, previous,
+            on_result=self._revision_loaded,
+            on_error=lambda error: self.diff_view.setPlainText(f"Could not load revision: {str(error)}"),
+            key=("revision-diff", id(self))
+        )
+
+    def _load_revision(self, revision, previous):
+        # Worker thread
+        current = self.revision_store.get_revision(self.note_id, revision, self.password)
+        before = self.revision_store.get_revision(self.note_id, previous, self.password) if previous else None
+        diff = unified_diff(
+            before['content'] if before else "", current['content'],
+            f"revision {previous}" if before else "empty", f"revision {revision}"
+        )
+        if before and before['title'] != current['title']:
+            diff = f"Title: {before['title']} -> {current['title']}\n\n" + diff
+        return current, diff
+
+    def _revision_loaded(self, loaded):
+        self._revision, diff = loaded
+        self.diff_view.setPlainText(diff or "No changes to the content")
+        self.restore_button.setEnabled(True)
+
+    def restored_revision(self):
+        """The revision to restore (dict with title and content), or None"""
+        return self._revision
+
+
+class InstrumentationDialog(QDialog):
+    """Debug panel: live timings, slow operations and trace/profile capture"""
+
+    COLUMNS = ("Operation", "Count", "Total ms", "Mean ms", "p50 ms", "p90 ms", "p99 ms", "Max ms")
+    REFRESH_MS = 1000
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Performance")
+        self.resize(900, 600)
+
+        layout = QVBoxLayout(self)
+        toggles = QHBoxLayout()
+        self.enabled_check = QCheckBox("Record timings")
+        self.enabled_check.setChecked(instrumentation.enabled)
+        self.enabled_check.toggled.connect(instrumentation.set_enabled)
+        self.profile_check = QCheckBox("Capture profile (cProfile)")
+        self.profile_check.setChecked(instrumentation.profiling)
+        self.profile_check.toggled.connect(self.toggle_profile)
+        self.counters_label = QLabel()
+        toggles.addWidget(self.enabled_check)
+        toggles.addWidget(self.profile_check)
+        toggles.addStretch()
+        toggles.addWidget(self.counters_label)
+        layout.addLayout(toggles)
+
+        splitter = QSplitter(Qt.Vertical)
+        layout.addWidget(splitter)
+
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.table.verticalHeader().hide()
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        splitter.addWidget(self.table)
+
+        self.slow_list = QListWidget()
+        self.slow_list.currentRowChanged.connect(self.show_slow_operation)
+        splitter.addWidget(self.slow_list)
+
+        self.detail_view = QTextEdit()
+        self.detail_view.setReadOnly(True)
+        self.detail_view.setLineWrapMode(QTextEdit.NoWrap)
+        self.detail_view.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        splitter.addWidget(self.detail_view)
+        splitter.setSizes([300, 150, 150])
+
+        self.buttons = QDialogButtonBox(QDialogButtonBox.Close)
+        reset_button = self.buttons.addButton("Reset", QDialogButtonBox.ResetRole)
+        reset_button.clicked.connect(self.reset)
+        save_button = self.buttons.addButton("Save Trace...", QDialogButtonBox.ActionRole)
+        save_button.clicked.connect(self.save_trace)
+        self.buttons.rejected.connect(self.reject)
+        layout.addWidget(self.buttons)
+
+        self.slow_operations = []
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(self.REFRESH_MS)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.refresh_timer.start()
+        self.refresh()
+
+    def refresh(self):
+        snapshot = instrumentation.snapshot()
+        histograms = snapshot['histograms']
+
+        self.table.setSortingEnabled(False)
+        self.table.setRowCount(len(histograms))
+        for row, (name, histogram) in enumerate(histograms.items()):
+            values = (name, histogram['count'], histogram['total_ms'], histogram['mean_ms'],
+                      histogram['p50_ms'], histogram['p90_ms'], histogram['p99_ms'], histogram['max_ms'])
+            for column, value in enumerate(values):
+                item = QTableWidgetItem()
+                # Numbers as data so sorting by a column is numeric
+                item.setData(Qt.DisplayRole, value)
+                self.table.setItem(row, column, item)
+        self.table.setSortingEnabled(True)
+
+        counters = snapshot['counters']
+        self.counters_label.setText("  ".join(f"{name}: {value}" for name, value in sorted(counters.items())))
+
+        if len(snapshot['slow_operations']) != len(self.slow_operations) or (
+                self.slow_operations and snapshot['slow_operations'][-1] is not self.slow_operations[-1]):
+            self.slow_operations = snapshot['slow_operations']
+            self.slow_list.clear()
+            # Newest first
+            for entry in reversed(self.slow_operations):
+                summary = entry.get('sql') or entry.get('args', {}).get('sql') or ""
+                self.slow_list.addItem(f"{entry['duration_ms']:>9.1f} ms  {entry['name']}  {summary[:120]}")
+
+    def show_slow_operation(self, row):
+        if row < 0:
+            self.detail_view.clear()
+            return
+        entry = self.slow_operations[len(self.slow_operations) - 1 - row]
+        lines = [f"{entry['name']} took {entry['duration_ms']} ms on {entry['thread']}"]
+        if entry.get('sql'):
+            lines += ["", entry['sql']]
+        if entry.get('query_plan'):
+            lines += ["", "Query plan:"] + entry['query_plan']
+        for name, value in entry.get('args', {}).items():
+            if name != 'sql':
+                lines.append(f"{name}: {value}")
+        self.detail_view.setPlainText("\n".join(lines))
+
+    def reset(self):
+        instrumentation.reset()
+        self.slow_operations = []
+        self.slow_list.clear()
+        self.refresh()
+
+    def save_trace(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Save Trace", "scribenote-trace.json", "Trace files (*.json)")
+        if not path:
+            return
+        try:
+            instrumentation.dump(path)
+        except OSError as e:
+            QMessageBox.critical(self, "Error", f"Could not save trace: {str(e)}")
+
+    def toggle_profile(self, enabled):
+        if enabled:
+            instrumentation.start_profile()
+            return
+        path, _ = QFileDialog.getSaveFileName(self, "Save Profile", "scribenote.prof", "Profiles (*.prof)")
+        try:
+            instrumentation.stop_profile(path or None)
+        except OSError as e:
+            QMessageBox.critical(self, "Error", f"Could not save profile: {str(e)}")
+
+    def done(self, result):
+        self.refresh_timer.stop()
+        super().done(result)
@@ -1,43 +1,301 @@
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from collections import OrderedDict
 import base64
+import hashlib
+import io
+import hmac
 import os
+import threading
+import time
+import zlib
+
+from .instrumentation import instrumentation
+
+# Salt used by notes encrypted before per-note salts were introduced
+LEGACY_SALT = b'secure_notes_salt_value'
+
+KDF_ITERATIONS = 100000
+SALT_SIZE = 16
+
+# Versioned envelope: "sn2$<urlsafe base64 salt>$<Fernet token>". Content
+# without the prefix is a legacy Fernet token derived with LEGACY_SALT.
+ENVELOPE_V2 = "sn2"
+ENVELOPE_SEPARATOR = "$"
+
+# Bodies above this size use the chunked AES-GCM stream format instead of a
+# single Fernet token: "sn3$<urlsafe base64 stream>" (the salt is in the
+# stream header)
+ENVELOPE_V3 = "sn3"
+LARGE_CONTENT_THRESHOLD = 1024 * 1024
+
+# "sn4" and "sn5" are "sn2" and "sn3" with the text deflated before it is
+# encrypted; used whenever that makes it smaller (ciphertext does not
+# compress, so this is the only place compression can happen)
+ENVELOPE_V4 = "sn4"
+ENVELOPE_V5 = "sn5"
+SALTED_ENVELOPES = (ENVELOPE_V2, ENVELOPE_V4)
+STREAM_ENVELOPES = (ENVELOPE_V3, ENVELOPE_V5)
+COMPRESSED_ENVELOPES = (ENVELOPE_V4, ENVELOPE_V5)
+COMPRESSION_LEVEL = 6
+
+# Binary form of the envelopes for storage (see pack_envelope): a type byte,
+# then the envelope's fields without their base64
+PACKED_LEGACY = 0x10
+PACKED_ENVELOPES = {ENVELOPE_V2: 0x12, ENVELOPE_V3: 0x13, ENVELOPE_V4: 0x14, ENVELOPE_V5: 0x15}
+PACKED_TYPES = {code: version for version, code in PACKED_ENVELOPES.items()}
+
+# Derived keys are kept for a while so a note is not re-derived on every click
+KEY_CACHE_SIZE = 64
+KEY_CACHE_TTL = 15 * 60
+
+
+def _deflate(data):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def envelope_version(encrypted_content):
+    """Version prefix of an envelope ("sn2", ...), or None for legacy tokens"""
+    prefix, separator, _ = encrypted_content[:4].partition(ENVELOPE_SEPARATOR)
+    return prefix if separator and prefix in PACKED_ENVELOPES else None
+
+
+def pack_envelope(encrypted_content):
+    """
+    Binary form of an envelope, a quarter smaller than its base64 text
+
+    Returns None for content that does not round-trip exactly through
+    unpack_envelope(); such content is kept as text.
+    """
+    version = envelope_version(encrypted_content)
+    try:
+        if version in SALTED_ENVELOPES:
+            _, salt_b64, token = encrypted_content.split(ENVELOPE_SEPARATOR, 2)
+            salt = base64.urlsafe_b64decode(salt_b64)
+            packed = bytes((PACKED_ENVELOPES[version], len(salt))) + salt + base64.urlsafe_b64decode(token)
+        elif version in STREAM_ENVELOPES:
+            packed = bytes((PACKED_ENVELOPES[version],)) + base64.urlsafe_b64decode(encrypted_content[len(version) + 1:])
+        else:
+            packed = bytes((PACKED_LEGACY,)) + base64.urlsafe_b64decode(encrypted_content)
+    except ValueError:
+        return None
+    if unpack_envelope(packed) != encrypted_content:
+        return None
+    return packed
+
+
+def unpack_envelope(data):
+    """Text form of an envelope packed by pack_envelope()"""
+    code = data[0]
+    if code == PACKED_LEGACY:
+        return _b64(data[1:])
+    version = PACKED_TYPES.get(code)
+    if version is None:
+        raise ValueError(f"Unknown packed envelope type: {code:#x}")
+    if version in SALTED_ENVELOPES:
+        salt_end = 2 + data[1]
+        return ENVELOPE_SEPARATOR.join((version, _b64(data[2:salt_end]), _b64(data[salt_end:])))
+    return version + ENVELOPE_SEPARATOR + _b64(data[1:])
+
+
+class KeyCache:
+    """Bounded in-memory cache of derived keys with TTL and LRU eviction"""
+
+    def __init__(self, max_entries=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cache_key):
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            key, expires = entry
+            if expires < time.monotonic():
+                del self._entries[cache_key]
+                return None
+            self._entries.move_to_end(cache_key)
+            return key
+
+    def put(self, cache_key, key):
+        with self._lock:
+            self._entries[cache_key] = (key, time.monotonic() + self.ttl)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
 
 class EncryptionHandler:
-    def __init__(self):
-        self.salt = b'secure_notes_salt_value'  # In production, this should be randomly generated and stored securely
-    
-    def _get_key_from_password(self, password):
-        """Derive a key from the password using PBKDF2"""
+    def __init__(self, key_cache=None):
+        self.salt = LEGACY_SALT
+        self.key_cache = key_cache if key_cache is not None else KeyCache()
+        # Passwords are never used as cache keys directly, only as an HMAC
+        # under a secret that lives as long as this handler
+        self._fingerprint_secret = os.urandom(32)
+        self._stream_cipher = None
+
+    @property
+    def stream_cipher(self):
+        """Chunked AES-GCM cipher for files and large bodies, sharing this key cache"""
+        if self._stream_cipher is None:
+            from .stream_crypto import StreamCipher
+            self._stream_cipher = StreamCipher(self)
+        return self._stream_cipher
+
+    def _password_fingerprint(self, password):
+        return hmac.new(self._fingerprint_secret, password.encode('utf-8'), hashlib.sha256).digest()
+
+    def _get_key_from_password(self, password, salt=None):
+        """Derive a key from the password using PBKDF2, cached per (password, salt)"""
+        if salt is None:
+            salt = self.salt
+
+        cache_key = (self._password_fingerprint(password), salt)
+        key = self.key_cache.get(cache_key)
+        if key is not None:
+            instrumentation.count("crypto.key_cache_hit")
+            return key
+        instrumentation.count("crypto.key_cache_miss")
+
+        # Imported on first use so opening the app does not load cryptography
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
         password_bytes = password.encode('utf-8')
         kdf = PBKDF2HMAC(
             algorithm=hashes.SHA256(),
             length=32,
-            salt=self.salt,
-            iterations=100000,
+            salt=salt,
+            iterations=KDF_ITERATIONS,
         )
-        key = base64.urlsafe_b64encode(kdf.derive(password_bytes))
+        with instrumentation.span("crypto.kdf", "crypto"):
+            key = base64.urlsafe_b64encode(kdf.derive(password_bytes))
+        self.key_cache.put(cache_key, key)
         return key
-    
-    def encrypt(self, content, password):
-        """Encrypt content using the provided password"""
+
+    def derive_key_bytes(self, password, salt):
+        """Raw 32-byte PBKDF2 key for a (password, salt) pair, from the cache if possible"""
+        return base64.urlsafe_b64decode(self._get_key_from_password(password, salt))
+
+    def lock(self):
+        """Forget every derived key; the next encrypt/decrypt re-runs the KDF"""
+        self.key_cache.clear()
+
+    @staticmethod
+    def new_salt():
+        return os.urandom(SALT_SIZE)
+
+    @staticmethod
+    def salt_of(encrypted_content):
+        """
+        Get the salt stored in an encrypted envelope
+
+        Returns None for empty or legacy content. Passing the result back to
+        encrypt() re-uses the note's cached key instead of deriving a new one.
+        """
+        if not encrypted_content:
+            return None
+        version = envelope_version(encrypted_content)
+        if version in STREAM_ENVELOPES:
+            from .stream_crypto import StreamHeader, HEADER_SIZE
+            # 48 base64 characters decode to 36 bytes, enough for the header
+            prefix = encrypted_content[len(version) + 1:len(version) + 1 + 48]
+            return StreamHeader.unpack(base64.urlsafe_b64decode(prefix)[:HEADER_SIZE]).salt
+        if version is None:
+            return None
+        _, salt_b64, _ = encrypted_content.split(ENVELOPE_SEPARATOR, 2)
+        return base64.urlsafe_b64decode(salt_b64)
+
+    def encrypt(self, content, password, salt=None):
+        """
+        Encrypt content using the provided password
+
+        Args:
+            content: Plaintext to encrypt
+            password: Password to derive the key from
+            salt: Salt of the note being re-encrypted (see salt_of), or None
+                to generate a fresh one
+
+        Returns:
+            Versioned envelope string holding the salt and the ciphertext
+            (a Fernet token, or a chunked stream for large content), of the
+            deflated text if that is smaller
+        """
         if not content:
             return ""
-            
-        key = self._get_key_from_password(password)
+
+        if salt is None:
+            salt = self.new_salt()
+
+        data = content.encode('utf-8')
+        compressed = _deflate(data)
+        if len(compressed) < len(data):
+            data = compressed
+        else:
+            compressed = None
+
+        if len(content) > LARGE_CONTENT_THRESHOLD:
+            return self._encrypt_large(data, password, salt, compressed is not None)
+
+        from cryptography.fernet import Fernet
+        key = self._get_key_from_password(password, salt)
         f = Fernet(key)
-        
-        encrypted_data = f.encrypt(content.encode('utf-8'))
-        return encrypted_data.decode('utf-8')
-    
+
+        with instrumentation.span("crypto.encrypt", "crypto", size=len(content)):
+            encrypted_data = f.encrypt(data)
+        return ENVELOPE_SEPARATOR.join((
+            ENVELOPE_V4 if compressed is not None else ENVELOPE_V2,
+            base64.urlsafe_b64encode(salt).decode('ascii'),
+            encrypted_data.decode('utf-8'),
+        ))
+
     def decrypt(self, encrypted_content, password):
         """Decrypt content using the provided password"""
         if not encrypted_content:
             return ""
-            
-        key = self._get_key_from_password(password)
+
+        version = envelope_version(encrypted_content)
+        if version in STREAM_ENVELOPES:
+            data = self._decrypt_large(encrypted_content, password)
+            if version in COMPRESSED_ENVELOPES:
+                data = zlib.decompress(data, -zlib.MAX_WBITS)
+            return data.decode('utf-8')
+
+        salt = self.salt_of(encrypted_content)
+        if salt is None:
+            token = encrypted_content
+        else:
+            token = encrypted_content.split(ENVELOPE_SEPARATOR, 2)[2]
+
+        from cryptography.fernet import Fernet
+        key = self._get_key_from_password(password, salt)
         f = Fernet(key)
-        
-        decrypted_data = f.decrypt(encrypted_content.encode('utf-8'))
+
+        with instrumentation.span("crypto.decrypt", "crypto", size=len(token)):
+            decrypted_data = f.decrypt(token.encode('utf-8'))
+        if version in COMPRESSED_ENVELOPES:
+            decrypted_data = zlib.decompress(decrypted_data, -zlib.MAX_WBITS)
         return decrypted_data.decode('utf-8')
+
+    def _encrypt_large(self, data, password, salt, compressed):
+        encrypted = io.BytesIO()
+        self.stream_cipher.encrypt_stream(io.BytesIO(data), encrypted, password, salt)
+        version = ENVELOPE_V5 if compressed else ENVELOPE_V3
+        return version + ENVELOPE_SEPARATOR + base64.urlsafe_b64encode(encrypted.getbuffer()).decode('ascii')
+
+    def _decrypt_large(self, encrypted_content, password):
+        data = base64.urlsafe_b64decode(encrypted_content[len(ENVELOPE_V3) + 1:])
+        decrypted = io.BytesIO()
+        self.stream_cipher.decrypt_stream(io.BytesIO(data), decrypted, password)
+        return decrypted.getvalue()
@@ -1,13 +1,42 @@
 import os
 import shutil
 import uuid
-import sqlite3
 import datetime
 import mimetypes
-from PIL import Image
+
+from .database import ConnectionManager, RECLAIM_FREE_PAGES
+from .blob_store import BlobStore
+
+# Files hashed and copied at once by attach_files(); copying is I/O bound,
+# so more threads than CPUs keep the disk busy
+ATTACH_WORKERS = min(8, (os.cpu_count() or 1) + 4)
+# Error messages kept in an attach_files() result
+MAX_ERRORS = 100
+
+ATTACHMENT_COLUMNS = "id, note_id, filename, file_path, file_type, created_date, encrypted, content_hash"
+
+
+def collect_files(paths):
+    """
+    Files to attach for paths chosen or dropped by the user
+    
+    Folders are walked (in name order, hidden files and folders left out);
+    paths that do not exist are returned as they are, so attaching them
+    reports the error.
+    """
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+            files.extend(os.path.join(root, name) for name in sorted(names) if not name.startswith("."))
+    return files
+
 
 class FileHandler:
-    def __init__(self, storage_dir=None):
+    def __init__(self, storage_dir=None, db_path=None, encryption_handler=None):
         if storage_dir is None:
             # Use default path
             self.storage_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "attachments")
@@ -17,81 +46,205 @@ class FileHandler:
         # Create attachments directory if it doesn't exist
         os.makedirs(self.storage_dir, exist_ok=True)
         
-        self.db_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "notes.db")
+        if db_path is None:
+            self.db_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "notes.db")
+        else:
+            self.db_path = db_path
+        
+        self.db = ConnectionManager.for_path(self.db_path)
+        self._encryption_handler = encryption_handler
+        
+        # Attachment contents are stored once per distinct file, by hash
+        self.blob_store = BlobStore(os.path.join(self.storage_dir, "blobs"), self.db)
     
-    def attach_file(self, note_id, file_path):
+    @property
+    def encryption_handler(self):
+        if self._encryption_handler is None:
+            from .encryption import EncryptionHandler
+            self._encryption_handler = EncryptionHandler()
+        return self._encryption_handler
+    
+    def attach_file(self, note_id, file_path, password=None):
         """
         Attach a file to a note
         
         Args:
             note_id: ID of the note to attach the file to
             file_path: Path to the file to attach
+            password: If given, the stored copy is encrypted with the chunked
+                stream format (constant memory, whatever the file size)
             
         Returns:
             Dictionary with information about the attachment
         """
-        if not os.path.exists(file_path):
-            raise FileNotFoundError(f"File not found: {file_path}")
-        
-        # Generate a unique ID for the attachment
-        attachment_id = str(uuid.uuid4())
-        
-        # Get file information
-        filename = os.path.basename(file_path)
-        file_type, _ = mimetypes.guess_type(file_path)
-        
-        # Create a directory for this note's attachments if it doesn't exist
-        note_attachments_dir = os.path.join(self.storage_dir, note_id)
-        os.makedirs(note_attachments_dir, exist_ok=True)
+        prepared = self._prepare(file_path, password)
+        try:
+            with self.db.transaction():
+                attachment = self._insert(note_id, file_path, prepared, password)
+        finally:
+            self.blob_store.discard(prepared)
         
-        # Copy the file to the attachments directory
-        destination = os.path.join(note_attachments_dir, filename)
+        return attachment
+    
+    def attach_files(self, note_id, paths, password=None, progress=None, cancelled=None, workers=None):
+        """
+        Attach many files, and the files in folders, to a note at once
         
-        # If a file with the same name already exists, add a unique identifier
-        if os.path.exists(destination):
-            base_name, ext = os.path.splitext(filename)
-            filename = f"{base_name}_{attachment_id[:8]}{ext}"
-            destination = os.path.join(note_attachments_dir, filename)
+        Files are hashed and copied into the blob store by a pool of threads,
+        each with the cheapest copy the platform offers (see
+        blob_store.fast_copy), so a large batch is limited by the disk; then
+        every attachment row is inserted in one transaction. Files that
+        cannot be read are skipped and reported.
         
-        shutil.copy2(file_path, destination)
+        Args:
+            note_id: ID of the note to attach the files to
+            paths: Files and folders (see collect_files)
+            password: If given, the stored copies are encrypted (see attach_file)
+            progress: Called after each file with (file_path, files_done,
+                files_total, bytes_done, bytes_total)
+            cancelled: Called between files; once it returns True the
+                remaining files are not copied and nothing is attached
+            workers: Number of copying threads (ATTACH_WORKERS by default)
+            
+        Returns:
+            Dictionary with 'attachments' (each as returned by attach_file),
+            'failed', 'errors' and 'cancelled'
+        """
+        files = collect_files(paths)
+        sizes = {}
+        for file_path in files:
+            try:
+                sizes[file_path] = os.path.getsize(file_path)
+            except OSError:
+                sizes[file_path] = 0
+        total_bytes = sum(sizes.values())
+        stop = cancelled or (lambda: False)
         
-        # Store attachment information in the database
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        result = {'attachments': [], 'failed': 0, 'errors': [], 'cancelled': False}
+        prepared = {}
         
-        now = datetime.datetime.now().isoformat()
+        def prepare(file_path):
+            # Copying thread; files not started yet are skipped once cancelled
+            return None if stop() else self._prepare(file_path, password)
         
-        cursor.execute(
-            "INSERT INTO attachments (id, note_id, filename, file_path, file_type, created_date) VALUES (?, ?, ?, ?, ?, ?)",
-            (attachment_id, note_id, filename, destination, file_type, now)
-        )
+        # Imported here so opening the app does not load it
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        try:
+            files_done = 0
+            bytes_done = 0
+            with ThreadPoolExecutor(max_workers=workers or ATTACH_WORKERS, thread_name_prefix="attach") as pool:
+                futures = {pool.submit(prepare, file_path): index for index, file_path in enumerate(files)}
+                for future in as_completed(futures):
+                    index = futures[future]
+                    file_path = files[index]
+                    try:
+                        blob = future.result()
+                    except Exception as e:
+                        result['failed'] += 1
+                        if len(result['errors']) < MAX_ERRORS:
+                            result['errors'].append(f"{file_path}: {e}")
+                    else:
+                        if blob is not None:
+                            prepared[index] = blob
+                    files_done += 1
+                    bytes_done += sizes[file_path]
+                    if progress:
+                        progress(file_path, files_done, len(files), bytes_done, total_bytes)
+            
+            if stop():
+                result['cancelled'] = True
+                return result
+            
+            with self.db.transaction() as conn:
+                if conn.execute("SELECT 1 FROM notes WHERE id = ?", (note_id,)).fetchone() is None:
+                    # Deleted while the files were being copied
+                    raise ValueError(f"Note not found: {note_id}")
+                # In the order the files were given, whichever finished first
+                for index in sorted(prepared):
+                    result['attachments'].append(self._insert(note_id, files[index], prepared[index], password))
+        finally:
+            for blob in prepared.values():
+                self.blob_store.discard(blob)
         
-        conn.commit()
-        conn.close()
+        return result
+    
+    def _prepare(self, file_path, password):
+        """Hash a file and stage it for the blob store (see BlobStore.prepare)"""
+        if not os.path.isfile(file_path):
+            raise FileNotFoundError(f"File not found: {file_path}")
         
-        return {
-            'id': attachment_id,
+        # Hash the file and copy it into the blob store unless the same
+        # content is already there. Encrypted copies differ every time, so
+        # they are stored as their own blob.
+        if password:
+            encrypted_path = self.blob_store.new_temporary_path()
+            self.encryption_handler.stream_cipher.encrypt_file(file_path, encrypted_path, password)
+            return self.blob_store.prepare(encrypted_path, move=True)
+        return self.blob_store.prepare(file_path)
+    
+    def _insert(self, note_id, file_path, prepared, password):
+        """Commit a prepared blob and add its attachment row; runs in the caller's transaction"""
+        attachment = {
+            'id': str(uuid.uuid4()),
             'note_id': note_id,
-            'filename': filename,
-            'file_path': destination,
-            'file_type': file_type
+            'filename': os.path.basename(file_path),
+            'file_path': self.blob_store.commit(prepared),
+            'file_type': mimetypes.guess_type(file_path)[0],
+            'created_date': datetime.datetime.now().isoformat(),
+            'encrypted': 1 if password else 0,
+            'content_hash': prepared.content_hash
         }
+        self.db.execute(
+            f"INSERT INTO attachments ({ATTACHMENT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            tuple(attachment[column] for column in ATTACHMENT_COLUMNS.split(", "))
+        )
+        return attachment
     
     def get_attachment(self, attachment_id):
         """Get information about an attachment"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM attachments WHERE id = ?", (attachment_id,))
-        attachment = cursor.fetchone()
-        
-        conn.close()
+        attachment = self.db.fetchone("SELECT * FROM attachments WHERE id = ?", (attachment_id,))
         
         if attachment:
             return dict(attachment)
         return None
     
+    def export_attachment(self, attachment_id, destination, password=None):
+        """
+        Write an attachment's original content to destination
+        
+        Encrypted attachments are decrypted chunk by chunk, so memory use
+        does not depend on the file size.
+        """
+        attachment = self.get_attachment(attachment_id)
+        if not attachment:
+            raise FileNotFoundError(f"Attachment not found: {attachment_id}")
+        
+        if attachment.get('encrypted'):
+            if not password:
+                raise ValueError("This attachment is encrypted; a password is required")
+            self.encryption_handler.stream_cipher.decrypt_file(attachment['file_path'], destination, password)
+        else:
+            shutil.copy2(attachment['file_path'], destination)
+        return destination
+    
+    def read_attachment(self, attachment_id, offset=0, length=None, password=None):
+        """Read part of an attachment's content without decrypting the whole file"""
+        attachment = self.get_attachment(attachment_id)
+        if not attachment:
+            raise FileNotFoundError(f"Attachment not found: {attachment_id}")
+        
+        if attachment.get('encrypted'):
+            if not password:
+                raise ValueError("This attachment is encrypted; a password is required")
+            cipher = self.encryption_handler.stream_cipher
+            if length is None:
+                length = cipher.plaintext_size(attachment['file_path']) - offset
+            return cipher.read_range(attachment['file_path'], offset, length, password)
+        
+        with open(attachment['file_path'], 'rb') as f:
+            f.seek(offset)
+            return f.read(-1 if length is None else length)
+    
     def delete_attachment(self, attachment_id):
         """Delete an attachment"""
         # Get attachment information first
@@ -100,17 +253,93 @@ class FileHandler:
         if not attachment:
             return False
         
-        # Delete the file
-        if os.path.exists(attachment['file_path']):
+        # Remove from database
+        self.db.execute("DELETE FROM attachments WHERE id = ?", (attachment_id,))
+        
+        if attachment.get('content_hash'):
+            # Shared blobs stay until their last reference is gone
+            self.blob_store.collect_garbage()
+        elif os.path.exists(attachment['file_path']):
+            # Attachment stored before the blob store existed
             os.remove(attachment['file_path'])
         
-        # Remove from database
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        self.db.reclaim_space(min_free_pages=RECLAIM_FREE_PAGES)
+        return True
+    
+    def collect_garbage(self):
+        """
+        Remove attachment files that no attachment row refers to any more
         
-        cursor.execute("DELETE FROM attachments WHERE id = ?", (attachment_id,))
+        This covers blobs whose last reference went away (for example through
+        NoteManager.delete_note) and the folders of deleted notes from before
+        the blob store. A per-note folder is only removed when no attachment
+        row refers to it, by its note or by the folder named in a stored path
+        (compared by name, since paths stored on another system or before the
+        data folder moved do not match this one); files of notes that still
+        have such rows are left for migrate_legacy_attachments().
+        
+        Returns:
+            Tuple of (files removed, bytes freed)
+        """
+        removed, freed = self.blob_store.collect_garbage()
         
-        conn.commit()
-        conn.close()
+        kept = set()
+        for row in self.db.fetchall("SELECT note_id, file_path FROM attachments WHERE content_hash IS NULL"):
+            kept.add(row['note_id'])
+            # Stored paths may be Windows paths
+            parts = row['file_path'].replace("\\", "/").rstrip("/").split("/")
+            if len(parts) > 1:
+                kept.add(parts[-2])
+        for entry in os.scandir(self.storage_dir):
+            if not entry.is_dir(follow_symlinks=False) or entry.name in kept or not self._is_note_folder(entry.name):
+                continue
+            for file_entry in os.scandir(entry.path):
+                if file_entry.is_file(follow_symlinks=False):
+                    freed += file_entry.stat().st_size
+                    os.remove(file_entry.path)
+                    removed += 1
+            if not os.listdir(entry.path):
+                os.rmdir(entry.path)
         
+        return removed, freed
+    
+    @staticmethod
+    def _is_note_folder(name):
+        """Whether a folder in storage_dir is named like the per-note folders from before the blob store"""
+        try:
+            uuid.UUID(name)
+        except ValueError:
+            return False
         return True
+    
+    def migrate_legacy_attachments(self):
+        """
+        Move per-note attachment copies into the blob store
+        
+        The old copies belong to ScribeNote, so they are hard-linked into the
+        store where possible instead of copied. Returns the number migrated.
+        """
+        legacy = self.db.fetchall(
+            "SELECT id, note_id, filename, file_path FROM attachments WHERE content_hash IS NULL"
+        )
+        migrated = 0
+        for row in legacy:
+            path = row['file_path']
+            if not os.path.exists(path):
+                # Stored on another system or before the data folder moved
+                path = os.path.join(self.storage_dir, row['note_id'], row['filename'])
+                if not os.path.exists(path):
+                    continue
+            prepared = self.blob_store.prepare(path, owned=True)
+            try:
+                with self.db.transaction():
+                    destination = self.blob_store.commit(prepared)
+                    self.db.execute(
+                        "UPDATE attachments SET content_hash = ?, file_path = ? WHERE id = ?",
+                        (prepared.content_hash, destination, row['id'])
+                    )
+            finally:
+                self.blob_store.discard(prepared)
+            os.remove(path)
+            migrated += 1
+        return migrated
@@ -0,0 +1,308 @@
+import functools
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+
+# Tracing is off unless this is set (or it is switched on from the debug
+# panel / `cli.py --trace`). While off, every hook is a flag check.
+TRACE_ENV = "SCRIBENOTE_TRACE"
+
+# Operations slower than this are kept in the slow-operation log; SQL
+# statements also get their EXPLAIN QUERY PLAN captured
+SLOW_THRESHOLD_MS = 50.0
+SLOW_LOG_SIZE = 200
+
+# Most recent spans kept for the Chrome trace file
+TRACE_BUFFER_SIZE = 100000
+
+# Histogram buckets are half powers of two of a microsecond: 1us, 1.4us,
+# 2us, ... up to about 50 minutes
+HISTOGRAM_BUCKETS = 64
+
+# Statements whose query plan is worth capturing
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+
+
+def statement_name(sql):
+    """Short, stable name of an SQL statement for histograms: db.select, db.insert, ..."""
+    verb = sql.lstrip().split(None, 1)[0] if sql.strip() else "empty"
+    return "db." + verb.lower()
+
+
+class Histogram:
+    """Count, total and log-scale latency buckets of one operation"""
+
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        micros = seconds * 1e6
+        index = int(math.log2(micros) * 2) + 1 if micros >= 1 else 0
+        self.buckets[min(index, HISTOGRAM_BUCKETS - 1)] += 1
+
+    def percentile(self, fraction):
+        """Upper bound, in milliseconds, of the bucket holding the percentile"""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(fraction * self.count))
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(2 ** (index / 2) / 1000, self.max * 1000)
+        return self.max * 1000
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total_ms': round(self.total * 1000, 3),
+            'mean_ms': round(self.total / self.count * 1000, 3) if self.count else None,
+            'p50_ms': round(self.percentile(0.50), 3) if self.count else None,
+            'p90_ms': round(self.percentile(0.90), 3) if self.count else None,
+            'p99_ms': round(self.percentile(0.99), 3) if self.count else None,
+            'max_ms': round(self.max * 1000, 3),
+        }
+
+
+class _NullSpan:
+    """What span() returns while tracing is off"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span:
+    __slots__ = ("instrumentation", "name", "category", "args", "start")
+
+    def __init__(self, instrumentation, name, category, args):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.instrumentation.record(self.name, self.category, self.start, time.perf_counter() - self.start,
+                                    self.args)
+        return False
+
+    def set(self, **args):
+        """Attach extra arguments (sizes, counts) to the span"""
+        self.args.update(args)
+
+
+class Instrumentation:
+    """
+    In-process timings of database, crypto, file and UI work
+
+    Every span feeds a per-name histogram and the trace buffer; spans slower
+    than slow_threshold_ms also go to the slow-operation log. dump() writes
+    everything as a Chrome trace file (chrome://tracing, Perfetto) with the
+    counters and histograms under "otherData".
+    """
+
+    def __init__(self, enabled=False, slow_threshold_ms=SLOW_THRESHOLD_MS):
+        self.enabled = enabled
+        self.slow_threshold = slow_threshold_ms / 1000
+        self._lock = threading.Lock()
+        self._epoch = time.perf_counter()
+        self._pid = os.getpid()
+        self.reset()
+
+        self._profiler = None
+        self._task_profiles = []
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+            self.events = deque(maxlen=TRACE_BUFFER_SIZE)
+            self.slow_log = deque(maxlen=SLOW_LOG_SIZE)
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+
+    # Recording
+
+    def span(self, name, category="app", **args):
+        """Context manager timing a block; a shared no-op while tracing is off"""
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, category, args)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, name, category, start, duration, args=None, slow_detail=None):
+        """Record a finished operation that started at perf_counter() time start"""
+        thread = threading.current_thread()
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': "X",
+            'ts': round((start - self._epoch) * 1e6, 1),
+            'dur': round(duration * 1e6, 1),
+            'pid': self._pid,
+            'tid': thread.ident,
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(duration)
+            self.events.append(event)
+            if duration >= self.slow_threshold:
+                entry = {
+                    'name': name,
+                    'category': category,
+                    'duration_ms': round(duration * 1000, 3),
+                    'thread': thread.name,
+                    'time': time.time(),
+                }
+                if args:
+                    entry['args'] = args
+                if slow_detail:
+                    entry.update(slow_detail)
+                self.slow_log.append(entry)
+
+    def is_slow(self, duration):
+        return duration >= self.slow_threshold
+
+    # Reporting
+
+    def snapshot(self):
+        """Counters, histograms and slow operations as plain data"""
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {name: histogram.to_dict() for name, histogram in sorted(self.histograms.items())},
+                'slow_operations': list(self.slow_log),
+                'slow_threshold_ms': self.slow_threshold * 1000,
+            }
+
+    def dump(self, path):
+        """Write the trace buffer and a snapshot as a Chrome trace JSON file"""
+        with self._lock:
+            events = list(self.events)
+        thread_names = [
+            {'name': "thread_name", 'ph': "M", 'pid': self._pid, 'tid': thread.ident,
+             'args': {'name': thread.name}}
+            for thread in threading.enumerate()
+        ]
+        trace = {
+            'traceEvents': thread_names + events,
+            'displayTimeUnit': "ms",
+            'otherData': self.snapshot(),
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(trace, f)
+        os.replace(tmp_path, path)
+
+    # Profiling
+
+    @property
+    def profiling(self):
+        return self._profiler is not None
+
+    def start_profile(self):
+        """Profile the calling (UI) thread and every task run by the TaskExecutor"""
+        if self._profiler is not None:
+            return
+        import cProfile
+        self._task_profiles = []
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+
+    def stop_profile(self, path=None):
+        """
+        Stop profiling
+
+        Args:
+            path: Where to write the merged stats (pstats format, readable
+                with `python -m pstats` or snakeviz)
+
+        Returns:
+            pstats.Stats of everything profiled, or None if not profiling
+        """
+        if self._profiler is None:
+            return None
+        import pstats
+        profiler, self._profiler = self._profiler, None
+        profiler.disable()
+        stats = pstats.Stats(profiler)
+        with self._lock:
+            task_profiles, self._task_profiles = self._task_profiles, []
+        for task_profile in task_profiles:
+            stats.add(task_profile)
+        if path:
+            stats.dump_stats(path)
+        return stats
+
+    def call(self, fn, *args, **kwargs):
+        """Run fn, under its own profiler while a capture is active (used for worker threads)"""
+        if self._profiler is None:
+            return fn(*args, **kwargs)
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(fn, *args, **kwargs)
+        finally:
+            with self._lock:
+                self._task_profiles.append(profile)
+
+
+instrumentation = Instrumentation(enabled=bool(os.environ.get(TRACE_ENV)))
+
+
+def span(name, category="app", **args):
+    return instrumentation.span(name, category, **args)
+
+
+def traced(name, category="app"):
+    """Decorator timing every call of a function as a span"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not instrumentation.enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                instrumentation.record(name, category, start, time.perf_counter() - start)
+        return wrapper
+    return decorator
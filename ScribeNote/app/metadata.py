@@ -0,0 +1,197 @@
+import json
+import sqlite3
+
+from .database import split_statements
+
+# Separator of the tags packed into a summary's `tags` column
+TAG_SEPARATOR = "\x1f"
+
+# Metadata with a JSON syntax error is treated as empty instead of failing
+VALID_METADATA = "CASE WHEN json_valid({0}) THEN {0} END"
+
+# Tags live in their own table, kept in sync with notes.metadata by triggers,
+# so filtering and counting by tag are index lookups
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS note_tags (
+    tag TEXT NOT NULL,
+    note_id TEXT NOT NULL,
+    PRIMARY KEY (tag, note_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_note_tags_note_id ON note_tags (note_id);
+
+CREATE TRIGGER IF NOT EXISTS note_tags_after_insert AFTER INSERT ON notes BEGIN
+    INSERT OR IGNORE INTO note_tags (tag, note_id)
+    SELECT value, new.id FROM json_each(CASE WHEN json_valid(new.metadata) THEN new.metadata END, '$.tags')
+    WHERE type = 'text';
+END;
+
+CREATE TRIGGER IF NOT EXISTS note_tags_after_update AFTER UPDATE OF metadata ON notes BEGIN
+    DELETE FROM note_tags WHERE note_id = old.id;
+    INSERT OR IGNORE INTO note_tags (tag, note_id)
+    SELECT value, new.id FROM json_each(CASE WHEN json_valid(new.metadata) THEN new.metadata END, '$.tags')
+    WHERE type = 'text';
+END;
+
+CREATE TRIGGER IF NOT EXISTS note_tags_after_delete AFTER DELETE ON notes BEGIN
+    DELETE FROM note_tags WHERE note_id = old.id;
+END;
+'''
+
+# Scalar metadata keys exposed as indexed (virtual, generated) columns:
+# key -> column name. Other keys can still be filtered on, without an index.
+INDEXED_FIELDS = {
+    'source': "meta_source",
+}
+
+# Generated columns can be added to an existing table from SQLite 3.31; older
+# versions index the json_extract() expression instead
+GENERATED_COLUMNS = sqlite3.sqlite_version_info >= (3, 31, 0)
+
+
+def parse_tags(text):
+    """Split comma-separated tags typed by the user, dropping blanks and repeats"""
+    tags = []
+    for tag in text.split(","):
+        tag = tag.strip()
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tags
+
+
+def tags_of(metadata_json):
+    """Tags in a note's metadata JSON (empty for missing or malformed metadata)"""
+    try:
+        metadata = json.loads(metadata_json) if metadata_json else {}
+    except ValueError:
+        return []
+    tags = metadata.get('tags') if isinstance(metadata, dict) else None
+    return [tag for tag in tags if isinstance(tag, str)] if isinstance(tags, list) else []
+
+
+def field_expression(key):
+    """SQL expression of a metadata key: its generated column if it has one"""
+    if key in INDEXED_FIELDS and GENERATED_COLUMNS:
+        return INDEXED_FIELDS[key]
+    path = "$." + json.dumps(key)
+    return "json_extract({}, '{}')".format(VALID_METADATA.format("metadata"), path.replace("'", "''"))
+
+
+class MetadataIndex:
+    """Tag table, indexed metadata fields and the note filters built on them"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def initialize(self, conn):
+        """Create the tag table, triggers and field indexes, backfilling existing notes once"""
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'note_tags'"
+        ).fetchone()
+
+        for statement in split_statements(SCHEMA):
+            conn.execute(statement)
+
+        if not exists:
+            conn.execute(
+                "INSERT OR IGNORE INTO note_tags (tag, note_id) "
+                "SELECT t.value, n.id FROM notes n, json_each(" + VALID_METADATA.format("n.metadata") + ", '$.tags') t "
+                "WHERE t.type = 'text'"
+            )
+
+        columns = [row['name'] for row in conn.execute("PRAGMA table_xinfo(notes)")]
+        for key, column in INDEXED_FIELDS.items():
+            if GENERATED_COLUMNS and column not in columns:
+                path = "$." + json.dumps(key)
+                conn.execute(
+                    f"ALTER TABLE notes ADD COLUMN {column} GENERATED ALWAYS AS "
+                    f"(json_extract({VALID_METADATA.format('metadata')}, '{path}')) VIRTUAL"
+                )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_notes_{column} ON notes ({field_expression(key)})")
+
+    def tag_counts(self):
+        """
+        Number of notes per tag
+
+        Returns:
+            List of (tag, count) tuples, most used first
+        """
+        rows = self.db.fetchall(
+            "SELECT tag, COUNT(*) AS count FROM note_tags GROUP BY tag ORDER BY count DESC, tag"
+        )
+        return [(row['tag'], row['count']) for row in rows]
+
+    def filter_clause(self, filters):
+        """
+        WHERE conditions for a note filter
+
+        Args:
+            filters: Dict with any of (the table must not be aliased)
+                tags: Notes must have every one of these tags
+                modified_from, modified_to, created_from, created_to: ISO
+                    date(time) bounds, inclusive from and exclusive to
+                encrypted: True or False to keep only (un)encrypted notes
+                fields: {metadata key: value} the notes must match
+
+        Returns:
+            (list of SQL conditions, list of parameters)
+        """
+        conditions = []
+        params = []
+        if not filters:
+            return conditions, params
+
+        tags = list(filters.get('tags') or ())
+        if len(tags) == 1:
+            conditions.append("notes.id IN (SELECT note_id FROM note_tags WHERE tag = ?)")
+            params.append(tags[0])
+        elif tags:
+            placeholders = ", ".join("?" * len(tags))
+            conditions.append(
+                f"notes.id IN (SELECT note_id FROM note_tags WHERE tag IN ({placeholders}) "
+                "GROUP BY note_id HAVING COUNT(*) = ?)"
+            )
+            params += tags + [len(tags)]
+
+        for column in ("modified", "created"):
+            if filters.get(column + "_from"):
+                conditions.append(f"notes.{column}_date >= ?")
+                params.append(filters[column + "_from"])
+            if filters.get(column + "_to"):
+                conditions.append(f"notes.{column}_date < ?")
+                params.append(filters[column + "_to"])
+
+        if filters.get('encrypted') is not None:
+            conditions.append("notes.encrypted = ?")
+            params.append(1 if filters['encrypted'] else 0)
+
+        for key, value in (filters.get('fields') or {}).items():
+            conditions.append(f"{field_expression(key)} = ?")
+            params.append(value)
+
+        return conditions, params
+
+    @staticmethod
+    def matches(summary, filters):
+        """
+        Whether a note summary passes the tag, date and encryption parts of a filter
+
+        Lets the note list decide if an edited note stays visible without
+        a query; metadata fields are not part of a summary and are ignored.
+        """
+        if not filters:
+            return True
+        tags = summary.get('tags') or []
+        if any(tag not in tags for tag in filters.get('tags') or ()):
+            return False
+        for column in ("modified", "created"):
+            value = summary.get(column + "_date")
+            if value is None:
+                continue
+            if filters.get(column + "_from") and value < filters[column + "_from"]:
+                return False
+            if filters.get(column + "_to") and value >= filters[column + "_to"]:
+                return False
+        if filters.get('encrypted') is not None and bool(summary['encrypted']) != bool(filters['encrypted']):
+            return False
+        return True
@@ -0,0 +1,423 @@
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QMimeData, pyqtSignal
+
+from .instrumentation import traced
+from .note_manager import DEFAULT_ORDER
+from .metadata import MetadataIndex
+from .tasks import WRITE
+
+# Custom item data roles
+NOTE_ID_ROLE = Qt.UserRole
+MODIFIED_DATE_ROLE = Qt.UserRole + 1
+ENCRYPTED_ROLE = Qt.UserRole + 2
+
+# Number of rows requested from the database per fetchMore() call
+PAGE_SIZE = 200
+
+# Drag and drop payload: the dragged note's id
+NOTE_ID_MIME_TYPE = "application/x-scribenote-note-id"
+
+
+class NoteListModel(QAbstractListModel):
+    """
+    Lazily populated list of note summaries
+
+    Rows hold only id, title, modified_date and encrypted. The view pulls
+    further pages through fetchMore() as the user scrolls, using keyset
+    pagination so every page costs the same regardless of its position.
+    When a search is active the rows are the ranked search results instead.
+    In the manual order, rows can be dragged to a new place. A filter (tags,
+    dates, encrypted state) narrows the listing but not search results.
+
+    With a TaskExecutor, pages are queried on a worker thread and inserted
+    when they arrive; `reloaded` is emitted once the first page of a reload
+    is in. Until then, rows saved from a previous session can stand in for
+    it (see show_snapshot).
+    """
+
+    reloaded = pyqtSignal()
+
+    def __init__(self, note_manager, page_size=PAGE_SIZE, parent=None, executor=None):
+        super().__init__(parent)
+        self.note_manager = note_manager
+        self.page_size = page_size
+        self.executor = executor
+        self.search_text = ""
+        self.order = DEFAULT_ORDER
+        self.filters = None
+        self._rows = []
+        self._row_by_id = {}
+        self._exhausted = False
+        self._loading = False
+        # Whether the rows are a snapshot standing in for the first page
+        self._placeholder = False
+        # Bumped on every reset so pages of a previous listing are ignored
+        self._generation = 0
+
+    # Qt model interface
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or not 0 <= index.row() < len(self._rows):
+            return None
+
+        row = self._rows[index.row()]
+        if role == Qt.DisplayRole:
+            return row['title']
+        if role == Qt.ToolTipRole:
+            # HTML (see search.snippet_html); <qt> makes Qt render it as such
+            # even when it has no tags, only escaped characters
+            return f"<qt>{row['snippet']}</qt>" if row.get('snippet') else None
+        if role == NOTE_ID_ROLE:
+            return row['id']
+        if role == MODIFIED_DATE_ROLE:
+            return row['modified_date']
+        if role == ENCRYPTED_ROLE:
+            return bool(row['encrypted'])
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return False
+        return not self._exhausted and not self._loading
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self._exhausted or self._loading:
+            return
+
+        # The query parameters are taken now, on the UI thread
+        generation = self._generation
+        search_text = self.search_text
+        order = self.order
+        filters = self.filters
+        if self._placeholder:
+            offset, after = 0, None
+        else:
+            offset = len(self._rows)
+            after = self.note_manager.summary_cursor(self._rows[-1], order) if self._rows else None
+
+        if self.executor is None:
+            self._page_loaded(generation, self._fetch_page(search_text, offset, after, order, filters))
+            return
+
+        self._loading = True
+        self.executor.submit(
+            self._fetch_page, search_text, offset, after, order, filters,
+            on_result=lambda page: self._page_loaded(generation, page),
+            on_error=lambda error: self._page_failed(generation),
+            key=("note-list-page", id(self))
+        )
+
+    def _fetch_page(self, search_text, offset, after, order, filters):
+        if search_text:
+            return self.note_manager.search_notes(search_text, limit=self.page_size, offset=offset)
+        return self.note_manager.get_note_summaries(limit=self.page_size, after=after, order=order,
+                                                    filters=filters)
+
+    @traced("ui.list_page", "ui")
+    def _page_loaded(self, generation, page):
+        if generation != self._generation:
+            return
+        self._loading = False
+        first_page = not self._rows or self._placeholder
+
+        if len(page) < self.page_size:
+            self._exhausted = True
+        if self._placeholder:
+            # Swap the snapshot for the real rows in one go
+            self.beginResetModel()
+            self._rows = list(page)
+            self._row_by_id = {}
+            self._reindex(0)
+            self._placeholder = False
+            self.endResetModel()
+        elif page:
+            first = len(self._rows)
+            self.beginInsertRows(QModelIndex(), first, first + len(page) - 1)
+            for offset, row in enumerate(page):
+                self._rows.append(row)
+                self._row_by_id[row['id']] = first + offset
+            self.endInsertRows()
+
+        if first_page:
+            self.reloaded.emit()
+
+    def _page_failed(self, generation):
+        if generation == self._generation:
+            self._loading = False
+
+    # Loading
+
+    def reload(self):
+        """Drop all rows and load the first page again"""
+        self.beginResetModel()
+        self._generation += 1
+        self._rows = []
+        self._row_by_id = {}
+        self._exhausted = False
+        self._loading = False
+        self._placeholder = False
+        self.endResetModel()
+        self.fetchMore()
+
+    def show_snapshot(self, rows, order=None, filters=None):
+        """
+        Reload, showing saved rows (see ListSnapshot) until the first page is in
+
+        The rows only fill the list for its first paint: no further pages are
+        fetched after them, and the first page replaces them all at once.
+        order and filters are those the rows were listed with.
+        """
+        self.beginResetModel()
+        self._generation += 1
+        if order is not None:
+            self.order = order
+        self.filters = filters or None
+        self._rows = list(rows)
+        self._row_by_id = {}
+        self._reindex(0)
+        self._exhausted = False
+        self._loading = False
+        self._placeholder = bool(self._rows)
+        self.endResetModel()
+        self.fetchMore()
+
+    @property
+    def showing_snapshot(self):
+        return self._placeholder
+
+    def set_search(self, search_text):
+        """Show ranked search results, or every note when search_text is empty"""
+        search_text = search_text.strip()
+        if search_text == self.search_text:
+            return
+        self.search_text = search_text
+        self.reload()
+
+    def set_order(self, order):
+        """
+        List notes in one of NoteManager's SORT_ORDERS
+
+        Search results keep their rank order; the new order applies once the
+        search is cleared. Returns whether the list is being reloaded.
+        """
+        if order == self.order:
+            return False
+        self.order = order
+        if self.search_text:
+            return False
+        self.reload()
+        return True
+
+    def set_filters(self, filters):
+        """
+        Only list notes matching a filter (see MetadataIndex.filter_clause), or all with None
+
+        Returns whether the list is being reloaded.
+        """
+        filters = filters or None
+        if filters == self.filters:
+            return False
+        self.filters = filters
+        if self.search_text:
+            return False
+        self.reload()
+        return True
+
+    # Row lookup
+
+    def note_id(self, row):
+        if 0 <= row < len(self._rows):
+            return self._rows[row]['id']
+        return None
+
+    def loaded_rows(self, count=None):
+        """Summaries of the loaded rows, or of the first count of them"""
+        return list(self._rows[:count])
+
+    def row_for_id(self, note_id):
+        """Row of a loaded note, or -1 if it is not (yet) in the model"""
+        return self._row_by_id.get(note_id, -1)
+
+    def _reindex(self, start, end=None):
+        for row in range(start, len(self._rows) if end is None else end):
+            self._row_by_id[self._rows[row]['id']] = row
+
+    # Single-row updates, used instead of reloading the whole list
+
+    def set_title(self, row, title):
+        """Show an edited title before it has been saved"""
+        if 0 <= row < len(self._rows):
+            self._rows[row]['title'] = title
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DisplayRole])
+
+    def refresh_note(self, note_id, summary=None):
+        """
+        Re-read one note's summary and move its row to the right position
+
+        Pass the summary if it was already read (e.g. on a worker thread).
+        Returns the note's row afterwards, or -1 if it is not shown.
+        """
+        if summary is None:
+            summary = self.note_manager.get_note_summary(note_id)
+        if summary is None:
+            self.remove_note(note_id)
+            return -1
+
+        row = self.row_for_id(note_id)
+        if not self.search_text and not MetadataIndex.matches(summary, self.filters):
+            # No longer (or never) part of the filtered listing
+            self.remove_note(note_id)
+            return -1
+        if self.search_text:
+            # Search results keep their rank order; only the data changes
+            if row >= 0:
+                self._rows[row].update(summary)
+                index = self.index(row)
+                self.dataChanged.emit(index, index)
+            return row
+
+        if row >= 0:
+            self._rows[row] = summary
+            target = self._insert_position(summary, exclude=row)
+            if target == len(self._rows) - 1 and not self._exhausted:
+                # Moved past the loaded pages; keep the keyset cursor valid
+                self.remove_note(note_id)
+                return -1
+            if target != row:
+                # beginMoveRows expects the destination in pre-move numbering
+                destination = target if target < row else target + 1
+                self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), destination)
+                self._rows.insert(target, self._rows.pop(row))
+                self.endMoveRows()
+                self._reindex(min(row, target), max(row, target) + 1)
+                row = target
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+            return row
+
+        target = self._insert_position(summary)
+        if target == len(self._rows) and not self._exhausted:
+            # Belongs to a page that has not been fetched yet
+            return -1
+        self.beginInsertRows(QModelIndex(), target, target)
+        self._rows.insert(target, summary)
+        self._reindex(target)
+        self.endInsertRows()
+        return target
+
+    def remove_note(self, note_id):
+        row = self.row_for_id(note_id)
+        if row < 0:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self._rows[row]
+        del self._row_by_id[note_id]
+        self._reindex(row)
+        self.endRemoveRows()
+
+    def _insert_position(self, summary, exclude=None):
+        """Binary search for the row a summary belongs at in the current order"""
+        sort_key = self.note_manager.sort_key
+        key = sort_key(summary, self.order)
+        descending = self.note_manager.is_descending(self.order)
+        rows = self._rows
+        lo, hi = 0, len(rows)
+        if exclude is not None:
+            hi -= 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            probe = mid if exclude is None or mid < exclude else mid + 1
+            probe_key = sort_key(rows[probe], self.order)
+            if (probe_key > key) if descending else (probe_key < key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Manual order
+
+    def is_reorderable(self):
+        return self.order == "manual" and not self.search_text and not self._placeholder
+
+    def flags(self, index):
+        flags = super().flags(index)
+        if not self.is_reorderable():
+            return flags
+        if index.isValid():
+            return flags | Qt.ItemIsDragEnabled
+        return flags | Qt.ItemIsDropEnabled
+
+    def supportedDropActions(self):
+        return Qt.MoveAction
+
+    def mimeTypes(self):
+        return [NOTE_ID_MIME_TYPE]
+
+    def mimeData(self, indexes):
+        data = QMimeData()
+        if indexes:
+            data.setData(NOTE_ID_MIME_TYPE, self._rows[indexes[0].row()]['id'].encode('utf-8'))
+        return data
+
+    def moveRows(self, source_parent, source_row, count, destination_parent, destination_row):
+        # QListView's InternalMove mode moves rows through here
+        if count != 1 or source_parent.isValid() or destination_parent.isValid() or not self.is_reorderable():
+            return False
+        note_id = self.note_id(source_row)
+        if note_id is None:
+            return False
+        self.move_note(note_id, destination_row)
+        return True
+
+    def dropMimeData(self, data, action, row, column, parent):
+        if action != Qt.MoveAction or not self.is_reorderable() or not data.hasFormat(NOTE_ID_MIME_TYPE):
+            return False
+        note_id = bytes(data.data(NOTE_ID_MIME_TYPE)).decode('utf-8')
+        if row < 0:
+            row = parent.row() if parent.isValid() else len(self._rows)
+        self.move_note(note_id, row)
+        # The row is moved here; returning False stops the view removing it
+        return False
+
+    def move_note(self, note_id, row):
+        """Move a note to a row (counted before the move) and store the new position"""
+        source = self.row_for_id(note_id)
+        if source < 0 or row in (source, source + 1):
+            return
+        target = row - 1 if row > source else row
+        after_id = None
+        if target > 0:
+            after_id = self._rows[target - 1 if target < source else target]['id']
+
+        self.beginMoveRows(QModelIndex(), source, source, QModelIndex(), row)
+        self._rows.insert(target, self._rows.pop(source))
+        self.endMoveRows()
+        self._reindex(min(source, target), max(source, target) + 1)
+
+        generation = self._generation
+        if self.executor is None:
+            self._position_saved(generation, note_id, self.note_manager.move_note(note_id, after_id))
+            return
+        self.executor.submit(
+            self.note_manager.move_note, note_id, after_id,
+            on_result=lambda moved: self._position_saved(generation, note_id, moved),
+            on_error=lambda error: self.reload(),
+            lane=WRITE
+        )
+
+    def _position_saved(self, generation, note_id, moved):
+        position, renumbered = moved
+        if generation != self._generation:
+            return
+        if renumbered:
+            # Every loaded position (and the paging cursor) is stale
+            self.reload()
+            return
+        row = self.row_for_id(note_id)
+        if row >= 0:
+            self._rows[row]['position'] = position
@@ -1,156 +1,726 @@
-import sqlite3
 import os
 import json
 import datetime
 import uuid
 
+from .database import ConnectionManager, RECLAIM_FREE_PAGES, drop_triggers_containing
+from .search import SearchIndex
+from .revisions import RevisionStore
+from .metadata import MetadataIndex
+from .compression import BodyCodec
+from .blind_index import BlindIndex
+from .changes import ChangeFeed
+from .attachment_text import AttachmentTextIndex
+from .sync import NoteVersions
+from .records import NoteSummary, Note, Attachment
+from . import blob_store
+
+# Columns needed to show a note in the list; bodies are loaded only on demand.
+# Tags come packed in one string (see _summary).
+SUMMARY_COLUMNS = (
+    "id, title, created_date, modified_date, encrypted, position, "
+    "(SELECT group_concat(tag, char(31)) FROM note_tags WHERE note_id = notes.id) AS tags"
+)
+
+# List orders: name -> (sort column, SQL sort expression, descending). Every
+# order has an index on (expression, id), so a page is one index range scan
+# and id breaks ties for stable keyset cursors.
+SORT_ORDERS = {
+    'modified_desc': ("modified_date", "modified_date", True),
+    'modified_asc': ("modified_date", "modified_date", False),
+    'created_desc': ("created_date", "created_date", True),
+    'created_asc': ("created_date", "created_date", False),
+    'title_asc': ("title", "title COLLATE NOCASE", False),
+    'title_desc': ("title", "title COLLATE NOCASE", True),
+    # Manual order set by move_note()
+    'manual': ("position", "position", False),
+}
+DEFAULT_ORDER = 'modified_desc'
+
+# SQLite's NOCASE collation only folds ASCII letters
+_NOCASE = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+# New notes go to the top of the manual order, whichever way they are inserted
+POSITION_TRIGGER = '''
+CREATE TRIGGER IF NOT EXISTS notes_position_after_insert
+AFTER INSERT ON notes WHEN new.position IS NULL BEGIN
+    UPDATE notes SET position = COALESCE((SELECT MIN(position) FROM notes), 1.0) - 1.0 WHERE id = new.id;
+END
+'''
+
+# Columns iter_notes() reads up front unless told otherwise; the body and
+# metadata are read when first used
+NOTE_LIST_FIELDS = ('title', 'created_date', 'modified_date', 'encrypted', 'position')
+
+# Rows fetched from the cursor at a time by the iter_* methods
+ITER_BATCH_SIZE = 500
+
+# Bodies re-encoded per transaction by compact_storage()
+COMPACT_BATCH = 500
+
 class NoteManager:
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, encryption_handler=None):
         if db_path is None:
             # Use default path
             self.db_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "notes.db")
         else:
             self.db_path = db_path
             
+        self.db = ConnectionManager.for_path(self.db_path)
+        # Bodies are stored compressed; the full-text index reads them
+        # through note_text()
+        self.codec = BodyCodec(self.db)
+        self.db.create_function("note_text", 1, self.codec.decode)
+        self.search_index = SearchIndex(self.db)
+        self.blind_index = BlindIndex(self.db, encryption_handler)
+        self.revisions = RevisionStore(self.db, encryption_handler)
+        self.metadata = MetadataIndex(self.db)
+        self.changes = ChangeFeed(self.db)
+        self.versions = NoteVersions(self.db)
+        self.attachment_text = AttachmentTextIndex(self.db)
         self.initialize_db()
     
     def initialize_db(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Create notes table if it doesn't exist
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS notes (
-            id TEXT PRIMARY KEY,
-            title TEXT NOT NULL,
-            content TEXT,
-            created_date TEXT NOT NULL,
-            modified_date TEXT NOT NULL,
-            metadata TEXT,
-            encrypted INTEGER DEFAULT 0
-        )
-        ''')
-        
-        # Create attachments table if it doesn't exist
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS attachments (
-            id TEXT PRIMARY KEY,
-            note_id TEXT NOT NULL,
-            filename TEXT NOT NULL,
-            file_path TEXT NOT NULL,
-            file_type TEXT,
-            created_date TEXT NOT NULL,
-            FOREIGN KEY (note_id) REFERENCES notes (id) ON DELETE CASCADE
+        with self.db.transaction() as conn:
+            # Create notes table if it doesn't exist
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS notes (
+                id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                content TEXT,
+                created_date TEXT NOT NULL,
+                modified_date TEXT NOT NULL,
+                metadata TEXT,
+                encrypted INTEGER DEFAULT 0
+            )
+            ''')
+            
+            # Create attachments table if it doesn't exist
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS attachments (
+                id TEXT PRIMARY KEY,
+                note_id TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                file_type TEXT,
+                created_date TEXT NOT NULL,
+                FOREIGN KEY (note_id) REFERENCES notes (id) ON DELETE CASCADE
+            )
+            ''')
+            
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_attachments_note_id ON attachments (note_id)")
+            
+            # Columns added after the first release
+            self._add_column(conn, "attachments", "encrypted", "INTEGER DEFAULT 0")
+            self._add_column(conn, "attachments", "content_hash", "TEXT")
+            
+            # Content-addressed attachment storage with reference counts
+            blob_store.initialize_db(conn)
+            
+            # Manual order; fractional so a move only rewrites the moved note
+            if self._add_column(conn, "notes", "position", "REAL"):
+                self._number_positions(conn)
+            conn.execute(POSITION_TRIGGER)
+            
+            # One index per list order (see SORT_ORDERS)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_notes_modified_date ON notes (modified_date, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_notes_created_date ON notes (created_date, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_notes_title ON notes (title COLLATE NOCASE, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_notes_position ON notes (position, id)")
+            
+            # Compression dictionaries, needed before the index reads any body
+            self.codec.initialize(conn)
+            # Triggers from before they compared stored bodies instead of
+            # decoding both with note_text(); recreated below
+            drop_triggers_containing(conn, "note_text(old.content) IS NOT")
+            
+            # Full-text index, kept in sync with the notes table by triggers
+            self.search_index.initialize(conn)
+            
+            # Optional index of encrypted bodies, also cleared by triggers
+            self.blind_index.initialize(conn)
+            
+            # Tag table and indexed metadata fields, also kept in sync by triggers
+            self.metadata.initialize(conn)
+            
+            # Revision history (removed with its note by a trigger)
+            self.revisions.initialize(conn)
+            
+            # Log of changes, for other windows and processes to pick up
+            self.changes.initialize(conn)
+            
+            # Lamport clock and note versions, for syncing with other stores
+            self.versions.initialize(conn)
+            
+            # Text of attachments, extracted in the background (see index_pending)
+            self.attachment_text.initialize(conn)
+    
+    @staticmethod
+    def _add_column(conn, table, column, definition):
+        """Add a column to an existing table unless it is already there; returns whether it was added"""
+        columns = [row['name'] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            return True
+        return False
+    
+    @staticmethod
+    def _number_positions(conn, order_by="modified_date DESC, id DESC"):
+        """Give every note a whole-number position, in the given order"""
+        ids = [row['id'] for row in conn.execute(f"SELECT id FROM notes ORDER BY {order_by}")]
+        conn.executemany(
+            "UPDATE notes SET position = ? WHERE id = ?",
+            ((float(position), note_id) for position, note_id in enumerate(ids))
         )
-        ''')
-        
-        conn.commit()
-        conn.close()
+    
+    def transaction(self):
+        """Group several NoteManager/FileHandler calls into one commit"""
+        return self.db.transaction()
     
     def create_note(self, title, content, metadata=None, encrypted=False):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         note_id = str(uuid.uuid4())
         now = datetime.datetime.now().isoformat()
         
         metadata_json = json.dumps(metadata) if metadata else "{}"
         
-        cursor.execute(
-            "INSERT INTO notes (id, title, content, created_date, modified_date, metadata, encrypted) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (note_id, title, content, now, now, metadata_json, 1 if encrypted else 0)
-        )
-        
-        conn.commit()
-        conn.close()
+        with self.db.transaction() as conn:
+            self.codec.refresh(conn)
+            self.db.execute(
+                "INSERT INTO notes (id, title, content, created_date, modified_date, metadata, encrypted) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (note_id, title, self.codec.encode(content, encrypted), now, now, metadata_json, 1 if encrypted else 0)
+            )
+            self.revisions.record(note_id, title, content, encrypted)
         
         return note_id
     
     def get_note(self, note_id):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        note = self.db.fetchone("SELECT * FROM notes WHERE id = ?", (note_id,))
+        
+        if note:
+            return self._note(note)
+        return None
+    
+    def _note(self, row):
+        note = dict(row)
+        note['content'] = self.codec.decode(note['content'])
+        return note
+    
+    @staticmethod
+    def _summary(row):
+        return NoteSummary(row)
+    
+    def _iter_rows(self, sql, params=(), batch_size=ITER_BATCH_SIZE):
+        """
+        Rows of a query, fetched batch_size at a time
+        
+        The query stays open (and holds a read snapshot) until the
+        generator is exhausted or closed.
+        """
+        cursor = self.db.connection.execute(sql, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
+    
+    def _list_clauses(self, order, filters, after=None):
+        """WHERE and ORDER BY of a listing in one of SORT_ORDERS, with its parameters"""
+        _, expression, descending = SORT_ORDERS[order]
+        direction = "DESC" if descending else "ASC"
+        conditions, params = self.metadata.filter_clause(filters)
+        if after is not None:
+            # Spelled out rather than as a row value, (expression, id) > (?, ?),
+            # which SQLite cannot turn into an index range for COLLATE NOCASE
+            op = "<" if descending else ">"
+            value, note_id = after
+            conditions.append(f"{expression} {op}= ? AND ({expression} {op} ? OR id {op} ?)")
+            params += [value, value, note_id]
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        return where + f" ORDER BY {expression} {direction}, id {direction}", params
+    
+    @staticmethod
+    def _projection(record_type, columns):
+        """Column list for a record type: id first, then the requested fields"""
+        columns = ['id'] + [column for column in columns if column != 'id']
+        unknown = [column for column in columns if column not in record_type.FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+        return ", ".join(columns)
+    
+    def iter_notes(self, columns=NOTE_LIST_FIELDS, order=DEFAULT_ORDER, filters=None, batch_size=ITER_BATCH_SIZE):
+        """
+        Stream notes as Note records, batch_size rows at a time
         
-        cursor.execute("SELECT * FROM notes WHERE id = ?", (note_id,))
-        note = cursor.fetchone()
+        Memory use depends on the batch size, not on the number of notes.
+        Columns left out of the projection (by default the body and the
+        metadata) are read the first time a record's field is used.
         
-        conn.close()
+        Args:
+            columns: Fields of Note to read up front (id always is)
+            order: One of SORT_ORDERS
+            filters: See MetadataIndex.filter_clause
+            batch_size: Rows fetched from the cursor at a time
+        """
+        clauses, params = self._list_clauses(order, filters)
+        sql = f"SELECT {self._projection(Note, columns)} FROM notes" + clauses
+        for row in self._iter_rows(sql, params, batch_size):
+            yield Note(self.db, self.codec, row)
+    
+    def iter_summaries(self, order=DEFAULT_ORDER, filters=None, batch_size=ITER_BATCH_SIZE):
+        """Stream NoteSummary records like get_note_summaries() without paging, batch_size rows at a time"""
+        clauses, params = self._list_clauses(order, filters)
+        for row in self._iter_rows("SELECT " + SUMMARY_COLUMNS + " FROM notes" + clauses, params, batch_size):
+            yield NoteSummary(row)
+    
+    def get_note_summary(self, note_id):
+        """Get the list columns of a single note, without its body"""
+        note = self.db.fetchone(
+            "SELECT " + SUMMARY_COLUMNS + " FROM notes WHERE id = ?",
+            (note_id,)
+        )
         
         if note:
-            return dict(note)
+            return self._summary(note)
         return None
     
-    def get_note_by_index(self, index):
-        notes = self.get_all_notes()
-        if 0 <= index < len(notes):
-            return notes[index]
+    def get_note_summaries_by_ids(self, note_ids):
+        """Get summaries for a list of ids, in no particular order; missing notes are left out"""
+        note_ids = list(note_ids)
+        if not note_ids:
+            return []
+        placeholders = ", ".join("?" * len(note_ids))
+        notes = self.db.fetchall(
+            "SELECT " + SUMMARY_COLUMNS + f" FROM notes WHERE id IN ({placeholders})",
+            note_ids
+        )
+        return [self._summary(note) for note in notes]
+    
+    def get_note_summaries(self, limit=200, after=None, order=DEFAULT_ORDER, filters=None):
+        """
+        Get one page of note summaries
+        
+        Args:
+            limit: Maximum number of notes to return
+            after: Keyset cursor returned by summary_cursor() for the last
+                note of the previous page, or None for the first page
+            order: One of SORT_ORDERS (newest first by default)
+            filters: Only notes matching these tags, dates, encrypted state
+                and metadata fields (see MetadataIndex.filter_clause)
+            
+        Returns:
+            List of NoteSummary records with id, title, created_date,
+            modified_date, encrypted, position and tags
+        """
+        clauses, params = self._list_clauses(order, filters, after)
+        notes = self.db.fetchall(
+            "SELECT " + SUMMARY_COLUMNS + " FROM notes" + clauses + " LIMIT ?",
+            params + [limit]
+        )
+        
+        return [self._summary(note) for note in notes]
+    
+    def count_notes(self, filters=None):
+        """Number of notes matching a filter (all notes without one)"""
+        conditions, params = self.metadata.filter_clause(filters)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        return self.db.fetchone("SELECT COUNT(*) AS count FROM notes" + where, params)['count']
+    
+    def tag_counts(self):
+        """(tag, number of notes) pairs, most used first, counted in SQL"""
+        return self.metadata.tag_counts()
+    
+    def set_tags(self, note_id, tags):
+        """
+        Replace a note's tags, keeping the rest of its metadata
+        
+        Tags are not part of the note's text, so modified_date and the
+        revision history are left alone.
+        """
+        with self.db.transaction():
+            self.db.execute(
+                "UPDATE notes SET metadata = json_set("
+                "CASE WHEN json_valid(metadata) THEN metadata ELSE '{}' END, '$.tags', json(?)"
+                ") WHERE id = ?",
+                (json.dumps(list(tags)), note_id)
+            )
+    
+    @staticmethod
+    def summary_cursor(summary, order=DEFAULT_ORDER):
+        """Keyset cursor positioned after the given summary"""
+        return (summary[SORT_ORDERS[order][0]], summary['id'])
+    
+    @staticmethod
+    def sort_key(summary, order=DEFAULT_ORDER):
+        """
+        Python equivalent of a summary's place in an order, ascending
+        
+        Compares like the SQL ordering (titles case-insensitively, as NOCASE
+        does), so a list can insert an edited note without re-querying.
+        """
+        column = SORT_ORDERS[order][0]
+        value = summary[column]
+        if column == "title":
+            value = value.translate(_NOCASE)
+        return (value, summary['id'])
+    
+    @staticmethod
+    def is_descending(order):
+        return SORT_ORDERS[order][2]
+    
+    def get_note_by_index(self, index, order=DEFAULT_ORDER):
+        if index < 0:
+            return None
+        _, expression, descending = SORT_ORDERS[order]
+        direction = "DESC" if descending else "ASC"
+        note = self.db.fetchone(
+            f"SELECT * FROM notes ORDER BY {expression} {direction}, id {direction} LIMIT 1 OFFSET ?",
+            (index,)
+        )
+        if note:
+            return self._note(note)
         return None
     
-    def get_all_notes(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+    def move_note(self, note_id, after_id=None):
+        """
+        Place a note directly after another one in the manual order
         
-        cursor.execute("SELECT * FROM notes ORDER BY modified_date DESC")
-        notes = cursor.fetchall()
+        Only the moved note's position changes (it gets the midpoint of its
+        new neighbours) unless the gap has become too small to split, in which
+        case every note is renumbered first.
         
-        conn.close()
+        Args:
+            note_id: Note to move
+            after_id: Note it should follow, or None to move it to the top
+            
+        Returns:
+            (new position, whether every note was renumbered)
+        """
+        renumbered = False
+        with self.db.transaction() as conn:
+            for _ in range(2):
+                if after_id is None:
+                    lower = None
+                    upper = conn.execute(
+                        "SELECT position FROM notes WHERE id != ? ORDER BY position, id LIMIT 1", (note_id,)
+                    ).fetchone()
+                else:
+                    lower = conn.execute("SELECT position, id FROM notes WHERE id = ?", (after_id,)).fetchone()
+                    if lower is None:
+                        raise ValueError(f"Note not found: {after_id}")
+                    upper = conn.execute(
+                        "SELECT position FROM notes WHERE (position, id) > (?, ?) AND id != ? "
+                        "ORDER BY position, id LIMIT 1",
+                        (lower['position'], lower['id'], note_id)
+                    ).fetchone()
+                    lower = lower['position']
+                upper = upper['position'] if upper else None
+                
+                if lower is None and upper is None:
+                    position = 0.0
+                elif lower is None:
+                    position = upper - 1.0
+                elif upper is None:
+                    position = lower + 1.0
+                else:
+                    position = (lower + upper) / 2
+                    if not lower < position < upper:
+                        # Out of float precision between the neighbours
+                        self._number_positions(conn, "position, id")
+                        renumbered = True
+                        continue
+                break
+            
+            cursor = conn.execute("UPDATE notes SET position = ? WHERE id = ?", (position, note_id))
+            if cursor.rowcount == 0:
+                raise ValueError(f"Note not found: {note_id}")
+        return position, renumbered
+    
+    def get_all_notes(self):
+        """
+        Every note as a Note record, newest first
         
-        return [dict(note) for note in notes]
+        Bodies stay compressed until read; iter_notes() avoids holding all
+        notes at once.
+        """
+        return list(self.iter_notes(Note.FIELDS, order='modified_desc'))
     
-    def update_note(self, note_id, title, content, metadata=None, encrypted=False):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def update_note(self, note_id, title, content, metadata=None, encrypted=False, password=None):
+        """
+        Save a note and add the new state to its history
         
+        Pass the password of an encrypted note so its revision can be stored
+        as a sealed delta (and its words added to the blind index, when that
+        is on); without it the whole envelope is kept instead.
+        """
         now = datetime.datetime.now().isoformat()
         
-        if metadata is not None:
-            metadata_json = json.dumps(metadata)
-            cursor.execute(
-                "UPDATE notes SET title = ?, content = ?, modified_date = ?, metadata = ?, encrypted = ? WHERE id = ?",
-                (title, content, now, metadata_json, 1 if encrypted else 0, note_id)
-            )
-        else:
-            cursor.execute(
-                "UPDATE notes SET title = ?, content = ?, modified_date = ?, encrypted = ? WHERE id = ?",
-                (title, content, now, 1 if encrypted else 0, note_id)
-            )
+        with self.db.transaction() as conn:
+            self.codec.refresh(conn)
+            stored = self.codec.encode(content, encrypted)
+            if metadata is not None:
+                metadata_json = json.dumps(metadata)
+                self.db.execute(
+                    "UPDATE notes SET title = ?, content = ?, modified_date = ?, metadata = ?, encrypted = ? WHERE id = ?",
+                    (title, stored, now, metadata_json, 1 if encrypted else 0, note_id)
+                )
+            else:
+                self.db.execute(
+                    "UPDATE notes SET title = ?, content = ?, modified_date = ?, encrypted = ? WHERE id = ?",
+                    (title, stored, now, 1 if encrypted else 0, note_id)
+                )
+            self.revisions.record(note_id, title, content, encrypted, password=password)
+            if encrypted and password and self.blind_index.enabled:
+                text = self.blind_index.encryption_handler.decrypt(content, password)
+                self.blind_index.index_note(note_id, text, password)
+    
+    def update_note_fields(self, note_id, title=None, content=None):
+        """
+        Update only the given fields of a plaintext note
         
-        conn.commit()
-        conn.close()
+        Used by autosave, which writes the title or the body only when it
+        changed. Encrypted notes are left alone since their content has to be
+        re-encrypted with the note's password.
+        
+        Returns:
+            True if the note was updated
+        """
+        assignments = ["modified_date = ?"]
+        params = [datetime.datetime.now().isoformat()]
+        if title is not None:
+            assignments.append("title = ?")
+            params.append(title)
+        
+        with self.db.transaction() as conn:
+            if content is not None:
+                self.codec.refresh(conn)
+                assignments.append("content = ?")
+                params.append(self.codec.encode(content))
+            params.append(note_id)
+            cursor = self.db.execute(
+                f"UPDATE notes SET {', '.join(assignments)} WHERE id = ? AND encrypted = 0",
+                params
+            )
+            if cursor.rowcount == 0:
+                return False
+            note = self.db.fetchone("SELECT title, content FROM notes WHERE id = ?", (note_id,))
+            self.revisions.record(note_id, note['title'], self.codec.decode(note['content']))
+        return True
     
-    def delete_note(self, note_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def update_note_contents(self, updates, expected=None):
+        """
+        Replace the content and encrypted flag of many notes at once
         
-        # First delete any attachments
-        cursor.execute("DELETE FROM attachments WHERE note_id = ?", (note_id,))
+        Used by bulk operations that change how a note is stored rather than
+        what it says, so modified_date is left alone and no revision is
+        recorded. Notes that become encrypted lose their plaintext history.
         
-        # Then delete the note
-        cursor.execute("DELETE FROM notes WHERE id = ?", (note_id,))
+        Args:
+            updates: Iterable of (note_id, content, encrypted) tuples
+            expected: Stored content (as read from the notes table) of each
+                note when its new content was computed; notes whose content
+                changed since then, such as by an autosave, are left alone
+            
+        Returns:
+            Ids of the notes updated
+        """
+        updated = []
+        with self.db.transaction() as conn:
+            self.codec.refresh(conn)
+            for note_id, content, encrypted in updates:
+                stored = (self.codec.encode(content, encrypted), 1 if encrypted else 0, note_id)
+                if expected is None:
+                    cursor = conn.execute("UPDATE notes SET content = ?, encrypted = ? WHERE id = ?", stored)
+                else:
+                    cursor = conn.execute(
+                        "UPDATE notes SET content = ?, encrypted = ? WHERE id = ? AND content IS ?",
+                        stored + (expected.get(note_id),)
+                    )
+                if cursor.rowcount:
+                    updated.append((note_id, encrypted))
+            self.revisions.drop_plaintext([note_id for note_id, encrypted in updated if encrypted])
+        return [note_id for note_id, encrypted in updated]
+    
+    def get_note_ids(self, tag=None, filters=None):
+        """Get the ids of all notes, or of the notes with the given tag or matching a filter"""
+        if tag is not None:
+            filters = dict(filters or {}, tags=list((filters or {}).get('tags') or ()) + [tag])
+        conditions, params = self.metadata.filter_clause(filters)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        rows = self.db.fetchall("SELECT id FROM notes" + where + " ORDER BY modified_date DESC", params)
+        return [row['id'] for row in rows]
+    
+    def get_notes_by_ids(self, note_ids):
+        """Get full notes for a list of ids, in no particular order"""
+        note_ids = list(note_ids)
+        if not note_ids:
+            return []
+        placeholders = ", ".join("?" * len(note_ids))
+        notes = self.db.fetchall(f"SELECT * FROM notes WHERE id IN ({placeholders})", note_ids)
+        return [self._note(note) for note in notes]
+    
+    def delete_note(self, note_id):
+        with self.db.transaction() as conn:
+            # First delete any attachments (their blobs lose a reference and
+            # are removed by FileHandler.collect_garbage)
+            conn.execute("DELETE FROM attachments WHERE note_id = ?", (note_id,))
+            
+            # Then delete the note
+            conn.execute("DELETE FROM notes WHERE id = ?", (note_id,))
         
-        conn.commit()
-        conn.close()
+        # Not inside a caller's transaction (reclaim_space skips those)
+        self.db.reclaim_space(min_free_pages=RECLAIM_FREE_PAGES)
     
     def get_attachments(self, note_id):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        """A note's attachments as Attachment records"""
+        attachments = self.db.fetchall(
+            f"SELECT {', '.join(Attachment.FIELDS)} FROM attachments WHERE note_id = ?",
+            (note_id,)
+        )
+        
+        return [Attachment(self.db, attachment) for attachment in attachments]
+    
+    def iter_attachments(self, note_id=None, columns=Attachment.FIELDS, batch_size=ITER_BATCH_SIZE):
+        """Stream the attachments of one note (or of all notes) as Attachment records, batch_size rows at a time"""
+        sql = f"SELECT {self._projection(Attachment, columns)} FROM attachments"
+        params = ()
+        if note_id is not None:
+            sql += " WHERE note_id = ?"
+            params = (note_id,)
+        for row in self._iter_rows(sql, params, batch_size):
+            yield Attachment(self.db, row)
+    
+    def search_notes(self, search_text, limit=50, offset=0):
+        """
+        Full-text search over titles, unencrypted bodies and metadata
         
-        cursor.execute("SELECT * FROM attachments WHERE note_id = ?", (note_id,))
-        attachments = cursor.fetchall()
+        Notes are also found by the text of their attachments, once
+        attachment_text.index_pending() has extracted it. Encrypted notes
+        whose password has been given to blind_index.unlock() are also found
+        by the (whole) words of their bodies.
+        """
+        return self.search_index.search(search_text, limit=limit, offset=offset,
+                                        also=self.blind_index.search(search_text))
+    
+    def sort_notes(self, order=DEFAULT_ORDER, limit=None):
+        """
+        Get full notes in one of SORT_ORDERS (one indexed query)
         
-        conn.close()
+        The list itself pages through get_note_summaries() instead.
+        """
+        _, expression, descending = SORT_ORDERS[order]
+        direction = "DESC" if descending else "ASC"
+        sql = f"SELECT * FROM notes ORDER BY {expression} {direction}, id {direction}"
+        if limit is None:
+            notes = self.db.fetchall(sql)
+        else:
+            notes = self.db.fetchall(sql + " LIMIT ?", (limit,))
+        return [self._note(note) for note in notes]
+    
+    def storage_stats(self):
+        """
+        Size of the database and of the note bodies stored in it
         
-        return [dict(attachment) for attachment in attachments]
+        Returns:
+            Dictionary with file_bytes, free_bytes, notes, body_bytes (as
+            stored), uncompressed_bodies (plaintext bodies stored as text
+            that compact_storage() would compress), dictionary_id and
+            incremental_vacuum
+        """
+        conn = self.db.connection
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        bodies = conn.execute(
+            "SELECT COUNT(*) AS notes, COALESCE(SUM(length(CAST(content AS BLOB))), 0) AS body_bytes FROM notes"
+        ).fetchone()
+        uncompressed = 0
+        for row in conn.execute("SELECT content, encrypted FROM notes WHERE typeof(content) = 'text'"):
+            if not self.codec.is_current(row['content'], row['encrypted']):
+                uncompressed += 1
+        return {
+            'file_bytes': page_size * page_count,
+            'free_bytes': page_size * free_pages,
+            'notes': bodies['notes'],
+            'body_bytes': bodies['body_bytes'],
+            'uncompressed_bodies': uncompressed,
+            'dictionary_id': self.codec.dictionary_id,
+            'incremental_vacuum': conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2,
+        }
     
-    def sort_notes(self, notes):
-        # This method is used to reorder notes in the database
-        # based on the sorted list provided
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def compact_storage(self, retrain=False, progress=None):
+        """
+        Compress stored note bodies and give free space back to the filesystem
+        
+        Trains a compression dictionary if there is none yet (or retrain is
+        set), re-encodes every body not already in its current stored form,
+        retires dictionaries nothing uses any more (see
+        BodyCodec.retire_unused_dictionaries) and releases free pages. A
+        database from before incremental vacuum is converted by one full
+        VACUUM, which needs as much free disk space as the database takes.
         
-        # For now we don't actually change the database order
-        # The UI handles the sorting display
+        Bodies are re-encoded a batch at a time, so the notes stay usable
+        while this runs; neither modified_date nor the history changes.
+        
+        Args:
+            retrain: Train a new dictionary even if one exists
+            progress: Called with (notes checked, total notes) after each batch
+            
+        Returns:
+            Dictionary with reencoded, dictionary_id, retired_dictionaries,
+            bytes_before and bytes_after
+        """
+        bytes_before = self.storage_stats()['file_bytes']
+        with self.db.transaction() as conn:
+            self.codec.refresh(conn)
+            if retrain or self.codec.dictionary_id is None:
+                self.codec.train(conn)
+        
+        total = self.count_notes()
+        checked = 0
+        reencoded = 0
+        after = ""
+        while True:
+            with self.db.transaction() as conn:
+                self.codec.refresh(conn)
+                rows = conn.execute(
+                    "SELECT id, content, encrypted FROM notes WHERE id > ? ORDER BY id LIMIT ?",
+                    (after, COMPACT_BATCH)
+                ).fetchall()
+                if not rows:
+                    break
+                updates = [
+                    (self.codec.encode(self.codec.decode(row['content']), row['encrypted']), row['id'])
+                    for row in rows if not self.codec.is_current(row['content'], row['encrypted'])
+                ]
+                # The text is unchanged, so the note triggers skip these
+                conn.execute("INSERT INTO body_reencoding (active) VALUES (1)")
+                conn.executemany("UPDATE notes SET content = ? WHERE id = ?", updates)
+                conn.execute("DELETE FROM body_reencoding")
+            reencoded += len(updates)
+            checked += len(rows)
+            after = rows[-1]['id']
+            if progress:
+                progress(checked, total)
+        
+        with self.db.transaction() as conn:
+            retired = self.codec.retire_unused_dictionaries(conn)
+        
+        conn = self.db.connection
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # Only a VACUUM can switch an existing database to incremental mode
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        else:
+            self.db.reclaim_space()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
         
-        conn.close()
+        return {
+            'reencoded': reencoded,
+            'dictionary_id': self.codec.dictionary_id,
+            'retired_dictionaries': retired,
+            'bytes_before': bytes_before,
+            'bytes_after': self.storage_stats()['file_bytes'],
+        }
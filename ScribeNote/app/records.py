@@ -0,0 +1,124 @@
+from .metadata import TAG_SEPARATOR
+
+
+class Record:
+    """
+    A row as an object with one slot per column instead of a dictionary
+
+    Fields are read as attributes or, like the dictionaries these replace,
+    by key (record['title'], record.get('title')); dict(record) and
+    to_dict() make a plain dictionary, e.g. for JSON.
+    """
+
+    __slots__ = ()
+    FIELDS = ()
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.FIELDS
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+    def keys(self):
+        return self.FIELDS
+
+    def update(self, other):
+        """Copy the fields of a dictionary or record; keys this record has no field for are ignored"""
+        for key in other.keys():
+            if key in self.FIELDS:
+                setattr(self, key, other[key])
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __repr__(self):
+        return f"{type(self).__name__}(id={getattr(self, 'id', None)!r})"
+
+
+class NoteSummary(Record):
+    """A note's list columns (see NoteManager.get_note_summaries)"""
+
+    __slots__ = ('id', 'title', 'created_date', 'modified_date', 'encrypted', 'position', 'tags')
+    FIELDS = __slots__
+
+    def __init__(self, row):
+        for field in self.FIELDS:
+            setattr(self, field, row[field])
+        self.tags = self.tags.split(TAG_SEPARATOR) if self.tags else []
+
+
+class LazyRecord(Record):
+    """
+    A record read with only some of its columns
+
+    The other columns are read from the database the first time they are
+    used, one query per record and column; project the columns a loop
+    needs so it does not make one query per row.
+    """
+
+    __slots__ = ('_db',)
+    TABLE = None
+
+    def __init__(self, db, row):
+        self._db = db
+        for key in row.keys():
+            setattr(self, key, row[key])
+
+    def _load(self, field):
+        row = self._db.fetchone(f"SELECT {field} FROM {self.TABLE} WHERE id = ?", (self.id,))
+        return row[0] if row is not None else None
+
+    def __getattr__(self, name):
+        # Only called for slots that are not set yet: columns not read
+        if name not in self.FIELDS or name == 'id':
+            raise AttributeError(name)
+        value = self._load(name)
+        setattr(self, name, value)
+        return value
+
+
+class Note(LazyRecord):
+    """
+    A note, with the same fields as NoteManager.get_note()
+
+    The body is kept as stored (compressed) until content is first read.
+    """
+
+    __slots__ = ('id', 'title', 'content', 'created_date', 'modified_date', 'metadata', 'encrypted', 'position',
+                 '_codec', '_stored')
+    FIELDS = ('id', 'title', 'content', 'created_date', 'modified_date', 'metadata', 'encrypted', 'position')
+    TABLE = "notes"
+
+    def __init__(self, db, codec, row):
+        self._codec = codec
+        self._db = db
+        for key in row.keys():
+            setattr(self, '_stored' if key == 'content' else key, row[key])
+
+    def _load(self, field):
+        if field != 'content':
+            return super()._load(field)
+        try:
+            stored = self._stored
+            del self._stored
+        except AttributeError:
+            stored = super()._load(field)
+        return self._codec.decode(stored)
+
+
+class Attachment(LazyRecord):
+    """An attachment (see NoteManager.get_attachments)"""
+
+    __slots__ = ('id', 'note_id', 'filename', 'file_path', 'file_type', 'created_date', 'encrypted', 'content_hash')
+    FIELDS = __slots__
+    TABLE = "attachments"
@@ -0,0 +1,646 @@
+import datetime
+import difflib
+import hashlib
+import hmac
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+from .database import split_statements
+from .encryption import pack_envelope, unpack_envelope, PACKED_LEGACY, PACKED_TYPES
+
+# How a revision's data is stored
+SNAPSHOT = 0   # Full body, compressed (and sealed for encrypted notes)
+DELTA = 1      # Line delta against the previous revision of the chain
+ENVELOPE = 2   # The note's encrypted envelope as stored, when no password was at hand
+
+# A new snapshot starts a chain after this many deltas, or once the deltas
+# of the chain add up to more than SNAPSHOT_RATIO of a snapshot's size
+MAX_CHAIN_LENGTH = 32
+SNAPSHOT_RATIO = 0.5
+COMPRESSION_LEVEL = 6
+
+# Retention: (maximum age in seconds, bucket size in seconds). Within each
+# age band only the newest revision of every bucket is kept (0 keeps all)
+RETENTION = (
+    (3600, 0),
+    (24 * 3600, 600),
+    (30 * 24 * 3600, 24 * 3600),
+    (None, 7 * 24 * 3600),
+)
+# Compact a note's history every this many revisions
+COMPACT_EVERY = 64
+
+# Plaintext of the latest revision of recently edited notes, so recording
+# a revision does not have to replay the chain (plaintext notes only)
+LATEST_CACHE_SIZE = 8
+
+SEAL_SALT_SIZE = 16
+SEAL_NONCE_SIZE = 12
+SEAL_INFO = b"scribenote revision v1"
+
+# content_hash is what tells an unchanged save from a new revision: the
+# SHA-256 of a plaintext body, of the envelope of an ENVELOPE revision, and
+# for sealed revisions (hash_keyed = 1) an HMAC under the sealing key, so it
+# says nothing about the text to anyone without the password
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS note_revisions (
+    note_id TEXT NOT NULL,
+    revision INTEGER NOT NULL,
+    base_revision INTEGER NOT NULL,
+    kind INTEGER NOT NULL,
+    encrypted INTEGER NOT NULL DEFAULT 0,
+    title TEXT,
+    created_date TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    content_hash BLOB NOT NULL,
+    data BLOB NOT NULL,
+    hash_keyed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (note_id, revision)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS note_revisions_after_note_delete AFTER DELETE ON notes BEGIN
+    DELETE FROM note_revisions WHERE note_id = old.id;
+END;
+'''
+
+
+def make_delta(old, new):
+    """
+    Encode new as a line delta against old
+
+    The delta is a list of [start, end] ranges of old's lines to copy and
+    strings to insert. Common leading and trailing lines are matched
+    directly, so a small edit in a large note only diffs the changed region.
+    """
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+
+    prefix = 0
+    limit = min(len(old_lines), len(new_lines))
+    while prefix < limit and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    limit -= prefix
+    while suffix < limit and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+        suffix += 1
+
+    ops = []
+
+    def copy(start, end):
+        if start >= end:
+            return
+        if ops and isinstance(ops[-1], list) and ops[-1][1] == start:
+            ops[-1][1] = end
+        else:
+            ops.append([start, end])
+
+    def insert(lines):
+        if not lines:
+            return
+        text = "".join(lines)
+        if ops and isinstance(ops[-1], str):
+            ops[-1] += text
+        else:
+            ops.append(text)
+
+    copy(0, prefix)
+    old_middle = old_lines[prefix:len(old_lines) - suffix]
+    new_middle = new_lines[prefix:len(new_lines) - suffix]
+    matcher = difflib.SequenceMatcher(None, old_middle, new_middle)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            copy(prefix + i1, prefix + i2)
+        else:
+            insert(new_middle[j1:j2])
+    copy(len(old_lines) - suffix, len(old_lines))
+    return ops
+
+
+def apply_delta(old, ops):
+    lines = old.splitlines(keepends=True)
+    return "".join("".join(lines[op[0]:op[1]]) if isinstance(op, list) else op for op in ops)
+
+
+def unified_diff(old, new, old_label="before", new_label="after"):
+    return "".join(difflib.unified_diff(
+        old.splitlines(keepends=True), new.splitlines(keepends=True), old_label, new_label
+    ))
+
+
+def envelope_data(content):
+    """Stored form of an ENVELOPE revision: the packed envelope, or its text if it cannot be packed"""
+    packed = pack_envelope(content)
+    return packed if packed is not None else content.encode("utf-8")
+
+
+def envelope_of(data):
+    """Envelope text of an ENVELOPE revision's data (packed, or text from before packing)"""
+    data = bytes(data)
+    if data and (data[0] == PACKED_LEGACY or data[0] in PACKED_TYPES):
+        return unpack_envelope(data)
+    return data.decode("utf-8")
+
+
+def retained_revisions(revisions, now):
+    """
+    Apply RETENTION to a note's revisions
+
+    Args:
+        revisions: (revision, created datetime) pairs, oldest first
+        now: Reference time
+
+    Returns:
+        Set of revision numbers to keep; the latest revision is always kept
+    """
+    keep = set()
+    newest_in_bucket = {}
+    for revision, created in revisions:
+        age = (now - created).total_seconds()
+        for band, (max_age, bucket_size) in enumerate(RETENTION):
+            if max_age is None or age < max_age:
+                break
+        if bucket_size == 0:
+            keep.add(revision)
+        else:
+            # Later revisions replace earlier ones in the same bucket
+            newest_in_bucket[(band, int(created.timestamp()) // bucket_size)] = revision
+    keep.update(newest_in_bucket.values())
+    if revisions:
+        keep.add(revisions[-1][0])
+    return keep
+
+
+class RevisionStore:
+    """
+    Revision history of notes, stored as chains of compressed line deltas
+
+    Each chain starts with a full snapshot followed by up to
+    MAX_CHAIN_LENGTH deltas, so any revision is rebuilt from one snapshot
+    and a bounded number of deltas. Revisions of encrypted notes are sealed
+    with AES-GCM under a key derived from the note's password and salt; when
+    a revision is recorded without the password (e.g. by a bulk operation)
+    the note's encrypted envelope is stored as-is instead.
+    """
+
+    def __init__(self, db, encryption_handler=None):
+        self.db = db
+        self._encryption_handler = encryption_handler
+        self._latest = OrderedDict()
+        self._latest_lock = threading.Lock()
+
+    @property
+    def encryption_handler(self):
+        if self._encryption_handler is None:
+            from .encryption import EncryptionHandler
+            self._encryption_handler = EncryptionHandler()
+        return self._encryption_handler
+
+    def initialize(self, conn):
+        for statement in split_statements(SCHEMA):
+            conn.execute(statement)
+        columns = [row['name'] for row in conn.execute("PRAGMA table_info(note_revisions)")]
+        if 'hash_keyed' not in columns:
+            conn.execute("ALTER TABLE note_revisions ADD COLUMN hash_keyed INTEGER NOT NULL DEFAULT 0")
+            # Sealed revisions used to keep the SHA-256 of their plaintext,
+            # which lets anyone confirm a guess of an encrypted note's text
+            conn.execute(
+                "UPDATE note_revisions SET content_hash = zeroblob(32) WHERE encrypted = 1 AND kind != ?",
+                (ENVELOPE,)
+            )
+
+    # Sealing of encrypted revisions
+
+    def _seal_key(self, password, salt):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+        key = self.encryption_handler.derive_key_bytes(password, salt)
+        return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=SEAL_INFO).derive(key)
+
+    def _content_hash(self, body, password=None, salt=None):
+        """content_hash of a revision: keyed with the sealing key when there is a password"""
+        data = body.encode("utf-8")
+        if password is None:
+            return hashlib.sha256(data).digest()
+        return hmac.new(self._seal_key(password, salt), data, hashlib.sha256).digest()
+
+    def _seal(self, data, password, salt, note_id, revision):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        nonce = os.urandom(SEAL_NONCE_SIZE)
+        aad = f"{note_id}:{revision}".encode("utf-8")
+        return salt + nonce + AESGCM(self._seal_key(password, salt)).encrypt(nonce, data, aad)
+
+    def _unseal(self, data, password, note_id, revision):
+        from cryptography.exceptions import InvalidTag
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        salt = data[:SEAL_SALT_SIZE]
+        nonce = data[SEAL_SALT_SIZE:SEAL_SALT_SIZE + SEAL_NONCE_SIZE]
+        aad = f"{note_id}:{revision}".encode("utf-8")
+        try:
+            return AESGCM(self._seal_key(password, salt)).decrypt(
+                nonce, data[SEAL_SALT_SIZE + SEAL_NONCE_SIZE:], aad
+            )
+        except InvalidTag:
+            raise ValueError("Incorrect password or corrupted data")
+
+    # Encoding of a single revision
+
+    def _encode(self, payload, note_id, revision, password=None, salt=None):
+        data = zlib.compress(payload.encode("utf-8"), COMPRESSION_LEVEL)
+        if password is not None:
+            data = self._seal(data, password, salt, note_id, revision)
+        return data
+
+    def _decode(self, row, previous, password):
+        """Body of a revision given the body of the revision before it in the chain"""
+        if row['kind'] == ENVELOPE:
+            if password is None:
+                raise ValueError("A password is required for the history of an encrypted note")
+            return self.encryption_handler.decrypt(envelope_of(row['data']), password)
+
+        data = bytes(row['data'])
+        if row['encrypted']:
+            if password is None:
+                raise ValueError("A password is required for the history of an encrypted note")
+            data = self._unseal(data, password, row['note_id'], row['revision'])
+        payload = zlib.decompress(data).decode("utf-8")
+        if row['kind'] == SNAPSHOT:
+            return payload
+        return apply_delta(previous, json.loads(payload))
+
+    def _replay(self, note_id, base_revision, revision, password):
+        """Rebuild every revision of a chain up to revision, yielding (row, body)"""
+        rows = self.db.fetchall(
+            "SELECT * FROM note_revisions WHERE note_id = ? AND base_revision = ? AND revision <= ? "
+            "ORDER BY revision",
+            (note_id, base_revision, revision)
+        )
+        body = None
+        for row in rows:
+            body = self._decode(row, body, password)
+            yield row, body
+
+    # Recording
+
+    def _cache_latest(self, note_id, revision, body):
+        with self._latest_lock:
+            self._latest[note_id] = (revision, body)
+            self._latest.move_to_end(note_id)
+            while len(self._latest) > LATEST_CACHE_SIZE:
+                self._latest.popitem(last=False)
+
+    def _cached_latest(self, note_id, revision):
+        with self._latest_lock:
+            cached = self._latest.get(note_id)
+        if cached is not None and cached[0] == revision:
+            return cached[1]
+        return None
+
+    def record(self, note_id, title, content, encrypted=False, password=None):
+        """
+        Add the note's current state to its history
+
+        Runs in the caller's transaction when there is one. Nothing is
+        recorded if title and content are unchanged since the last revision.
+
+        Args:
+            note_id: Note the revision belongs to
+            title: Title as saved
+            content: Content as saved (the envelope for encrypted notes)
+            encrypted: Whether content is encrypted
+            password: Password of an encrypted note; without it the envelope
+                is stored as a standalone revision
+
+        Returns:
+            The new revision number, or None if nothing changed
+        """
+        content = content or ""
+        now = datetime.datetime.now().isoformat()
+
+        with self.db.transaction() as conn:
+            latest = conn.execute(
+                "SELECT revision, base_revision, kind, encrypted, title, content_hash, hash_keyed, "
+                "substr(data, 1, ?) AS seal_salt FROM note_revisions "
+                "WHERE note_id = ? ORDER BY revision DESC LIMIT 1",
+                (SEAL_SALT_SIZE, note_id)
+            ).fetchone()
+            revision = latest['revision'] + 1 if latest is not None else 1
+
+            if encrypted and password is None:
+                envelope_hash = self._content_hash(content)
+                if (latest is not None and latest['kind'] == ENVELOPE and latest['title'] == title
+                        and bytes(latest['content_hash']) == envelope_hash):
+                    return None
+                conn.execute(
+                    "INSERT INTO note_revisions (note_id, revision, base_revision, kind, encrypted, title, "
+                    "created_date, size, content_hash, data) VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?)",
+                    (note_id, revision, revision, ENVELOPE, title, now, len(content), envelope_hash,
+                     envelope_data(content))
+                )
+                return revision
+
+            if encrypted:
+                body = self.encryption_handler.decrypt(content, password)
+                salt = self.encryption_handler.salt_of(content) or self.encryption_handler.new_salt()
+            else:
+                body = content
+                salt = None
+            seal_password = password if encrypted else None
+            stored_hash = self._content_hash(body, seal_password, salt)
+
+            # Whether the body is unchanged is decided on the plaintext, in
+            # memory: under the latest revision's own key when its hash is
+            # keyed, else (envelopes, older sealed revisions) against its body
+            same = latest is not None and latest['title'] == title and bool(latest['encrypted']) == bool(encrypted)
+            if same and not encrypted and bytes(latest['content_hash']) == stored_hash:
+                return None
+            if same and encrypted and latest['hash_keyed']:
+                if bytes(latest['content_hash']) == self._content_hash(body, password, bytes(latest['seal_salt'])):
+                    return None
+                same = False
+
+            if encrypted and latest is not None and not latest['encrypted']:
+                # The note was just encrypted; its history must not stay readable
+                self.seal_history(note_id, password)
+
+            kind, base_revision, payload = SNAPSHOT, revision, body
+            previous = self._previous_body(conn, note_id, latest, encrypted, password)
+            if same and previous == body:
+                return None
+            if previous is not None:
+                chain = conn.execute(
+                    "SELECT COUNT(*), SUM(CASE WHEN kind = ? THEN length(data) ELSE 0 END), "
+                    "MAX(CASE WHEN kind != ? THEN length(data) END) "
+                    "FROM note_revisions WHERE note_id = ? AND base_revision = ?",
+                    (DELTA, DELTA, note_id, latest['base_revision'])
+                ).fetchone()
+                chain_length, delta_bytes, snapshot_bytes = chain[0], chain[1] or 0, chain[2] or 0
+                if chain_length <= MAX_CHAIN_LENGTH:
+                    delta = json.dumps(make_delta(previous, body), separators=(",", ":"))
+                    if len(delta) < len(body):
+                        kind, base_revision, payload = DELTA, latest['base_revision'], delta
+
+            data = self._encode(payload, note_id, revision, seal_password, salt)
+            if kind == DELTA and delta_bytes + len(data) > snapshot_bytes * SNAPSHOT_RATIO:
+                # The chain now costs more than starting a new one
+                kind, base_revision = SNAPSHOT, revision
+                data = self._encode(body, note_id, revision, seal_password, salt)
+
+            conn.execute(
+                "INSERT INTO note_revisions (note_id, revision, base_revision, kind, encrypted, title, "
+                "created_date, size, content_hash, data, hash_keyed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (note_id, revision, base_revision, kind, 1 if encrypted else 0, title, now,
+                 len(body), stored_hash, data, 1 if encrypted else 0)
+            )
+
+            if not encrypted:
+                self._cache_latest(note_id, revision, body)
+            if revision % COMPACT_EVERY == 0:
+                self.compact(note_id, password=password)
+        return revision
+
+    @staticmethod
+    def initial_revision(note_id, title, content, encrypted, created_date):
+        """
+        Row for the first revision of a note inserted in bulk (see add_initial_revisions)
+
+        Thread-safe; importers build the rows (and compress the body) on
+        worker threads.
+        """
+        content = content or ""
+        stored_hash = hashlib.sha256(content.encode("utf-8")).digest()
+        if encrypted:
+            kind, data = ENVELOPE, envelope_data(content)
+        else:
+            kind, data = SNAPSHOT, zlib.compress(content.encode("utf-8"), COMPRESSION_LEVEL)
+        return (note_id, 1, 1, kind, 1 if encrypted else 0, title, created_date, len(content), stored_hash, data)
+
+    def add_initial_revisions(self, rows):
+        """Insert rows from initial_revision(); notes that already have history are skipped"""
+        self.db.executemany(
+            "INSERT OR IGNORE INTO note_revisions (note_id, revision, base_revision, kind, encrypted, title, "
+            "created_date, size, content_hash, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+    def _previous_body(self, conn, note_id, latest, encrypted, password):
+        """Body of the latest revision if the next one can be a delta of it"""
+        if latest is None or bool(latest['encrypted']) != bool(encrypted):
+            return None
+        if not encrypted:
+            cached = self._cached_latest(note_id, latest['revision'])
+            if cached is not None:
+                return cached
+        try:
+            body = None
+            for _, body in self._replay(note_id, latest['base_revision'], latest['revision'], password):
+                pass
+            return body
+        except Exception:
+            # E.g. the password changed; start a new chain
+            return None
+
+    def seal_history(self, note_id, password):
+        """Re-encode the plaintext revisions of a note sealed with its password"""
+        with self.db.transaction():
+            rows = self.db.fetchall(
+                "SELECT revision, base_revision FROM note_revisions WHERE note_id = ? AND encrypted = 0 "
+                "ORDER BY revision",
+                (note_id,)
+            )
+            chains = OrderedDict()
+            for row in rows:
+                chains.setdefault(row['base_revision'], []).append(row['revision'])
+            for base_revision, revisions in chains.items():
+                bodies = {
+                    row['revision']: (row, body)
+                    for row, body in self._replay(note_id, base_revision, revisions[-1], None)
+                }
+                self._rewrite_chain(note_id, base_revision, revisions, bodies, password)
+
+    def drop_plaintext(self, note_ids):
+        """Delete the plaintext history of notes encrypted without their password at hand"""
+        self.db.executemany(
+            "DELETE FROM note_revisions WHERE note_id = ? AND encrypted = 0",
+            ((note_id,) for note_id in note_ids)
+        )
+        with self._latest_lock:
+            for note_id in note_ids:
+                self._latest.pop(note_id, None)
+
+    def drop_encrypted(self, note_ids):
+        """
+        Delete the encrypted history of notes that were re-keyed
+
+        Their sealed and envelope revisions would otherwise stay readable with
+        the old password; re-sealing them would take a key derivation for
+        every salt they were sealed under.
+        """
+        self.db.executemany(
+            "DELETE FROM note_revisions WHERE note_id = ? AND encrypted = 1",
+            ((note_id,) for note_id in note_ids)
+        )
+
+    # Reading
+
+    def list_revisions(self, note_id):
+        """Revisions of a note, newest first, without their bodies"""
+        rows = self.db.fetchall(
+            "SELECT revision, title, created_date, size, encrypted, kind, length(data) AS stored_size "
+            "FROM note_revisions WHERE note_id = ? ORDER BY revision DESC",
+            (note_id,)
+        )
+        return [dict(row) for row in rows]
+
+    def get_revision(self, note_id, revision, password=None):
+        """
+        Rebuild one revision of a note
+
+        Returns:
+            Dict with revision, title, created_date and the plaintext content,
+            or None if the revision does not exist
+        """
+        row = self.db.fetchone(
+            "SELECT base_revision FROM note_revisions WHERE note_id = ? AND revision = ?",
+            (note_id, revision)
+        )
+        if row is None:
+            return None
+
+        result = None
+        for chain_row, body in self._replay(note_id, row['base_revision'], revision, password):
+            result = chain_row, body
+        chain_row, body = result
+        return {
+            'revision': chain_row['revision'],
+            'title': chain_row['title'],
+            'created_date': chain_row['created_date'],
+            'encrypted': bool(chain_row['encrypted']),
+            'content': body,
+        }
+
+    def diff(self, note_id, old_revision, new_revision, password=None):
+        """Unified diff between two revisions of a note"""
+        old = self.get_revision(note_id, old_revision, password) if old_revision else None
+        new = self.get_revision(note_id, new_revision, password)
+        return unified_diff(
+            old['content'] if old else "", new['content'],
+            f"revision {old_revision}" if old else "empty", f"revision {new_revision}"
+        )
+
+    def stats(self):
+        """Revision count and stored bytes over all notes"""
+        row = self.db.fetchone(
+            "SELECT COUNT(*) AS revisions, COUNT(DISTINCT note_id) AS notes, "
+            "COALESCE(SUM(length(data)), 0) AS stored_bytes, COALESCE(SUM(size), 0) AS content_bytes "
+            "FROM note_revisions"
+        )
+        return dict(row)
+
+    # Retention
+
+    def compact(self, note_id=None, password=None, now=None):
+        """
+        Drop revisions outside the retention policy
+
+        Chains that lose revisions are re-encoded from the revisions that
+        remain. Chains of encrypted notes can only be re-encoded with the
+        password; without it they are kept whole unless none of their
+        revisions is retained.
+
+        Args:
+            note_id: Note to compact, or None for all notes
+            password: Password of an encrypted note
+            now: Reference time for the retention policy
+
+        Returns:
+            Number of revisions removed
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        if note_id is None:
+            note_ids = [row['note_id'] for row in self.db.fetchall("SELECT DISTINCT note_id FROM note_revisions")]
+        else:
+            note_ids = [note_id]
+
+        removed = 0
+        for current_id in note_ids:
+            with self.db.transaction():
+                removed += self._compact_note(current_id, password, now)
+        return removed
+
+    def _compact_note(self, note_id, password, now):
+        rows = self.db.fetchall(
+            "SELECT revision, base_revision, encrypted, created_date FROM note_revisions "
+            "WHERE note_id = ? ORDER BY revision",
+            (note_id,)
+        )
+        keep = retained_revisions(
+            [(row['revision'], datetime.datetime.fromisoformat(row['created_date'])) for row in rows], now
+        )
+
+        chains = OrderedDict()
+        for row in rows:
+            chains.setdefault(row['base_revision'], []).append(row)
+
+        removed = 0
+        for base_revision, chain in chains.items():
+            revisions = [row['revision'] for row in chain]
+            kept = [revision for revision in revisions if revision in keep]
+            if len(kept) == len(revisions):
+                continue
+
+            if not kept:
+                self.db.execute(
+                    "DELETE FROM note_revisions WHERE note_id = ? AND base_revision = ?",
+                    (note_id, base_revision)
+                )
+                removed += len(revisions)
+                continue
+
+            encrypted = any(row['encrypted'] for row in chain)
+            if encrypted and password is None:
+                continue
+            try:
+                bodies = {
+                    row['revision']: (row, body)
+                    for row, body in self._replay(note_id, base_revision, revisions[-1], password)
+                    if row['revision'] in keep
+                }
+            except Exception:
+                # Sealed with another password; leave the chain as it is
+                continue
+            self._rewrite_chain(note_id, base_revision, kept, bodies, password if encrypted else None)
+            removed += len(revisions) - len(kept)
+        return removed
+
+    def _rewrite_chain(self, note_id, base_revision, kept, bodies, password):
+        salt = self.encryption_handler.new_salt() if password is not None else None
+        self.db.execute(
+            "DELETE FROM note_revisions WHERE note_id = ? AND base_revision = ?",
+            (note_id, base_revision)
+        )
+
+        new_base = kept[0]
+        previous = None
+        for revision in kept:
+            row, body = bodies[revision]
+            if previous is None:
+                kind, payload = SNAPSHOT, body
+            else:
+                kind, payload = DELTA, json.dumps(make_delta(previous, body), separators=(",", ":"))
+            self.db.execute(
+                "INSERT INTO note_revisions (note_id, revision, base_revision, kind, encrypted, title, "
+                "created_date, size, content_hash, data, hash_keyed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (note_id, revision, new_base, kind, 1 if password is not None else 0, row['title'],
+                 row['created_date'], len(body), self._content_hash(body, password, salt),
+                 self._encode(payload, note_id, revision, password, salt), 1 if password is not None else 0)
+            )
+            previous = body
+        with self._latest_lock:
+            self._latest.pop(note_id, None)
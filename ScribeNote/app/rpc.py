@@ -0,0 +1,372 @@
+import asyncio
+import contextvars
+import functools
+import hmac
+import inspect
+import itertools
+import json
+import os
+
+from .note_manager import DEFAULT_ORDER
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+UNAUTHORIZED = -32001
+
+# Requests of one connection being handled at once; reading stops (and the
+# client's writes back up) until one finishes
+MAX_IN_FLIGHT = 256
+# Longest request or response line
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+# Items per stream.items notification
+STREAM_PAGE_SIZE = 500
+
+# SyncEndpoint methods served as sync.<name>, by the store's thread they run on
+SYNC_METHODS = {
+    'info': 'run_read', 'received': 'run_read', 'changes': 'run_read', 'note_versions': 'run_read',
+    'records': 'run_read', 'missing_blobs': 'run_read', 'read_blob': 'run_files',
+    'write_blob': 'run_files', 'finish_blob': 'run_files', 'set_received': 'run_write', 'apply': 'run_write',
+}
+
+# (connection, request id) of the request being handled
+_request = contextvars.ContextVar("rpc_request")
+
+
+class RPCError(Exception):
+    def __init__(self, code, message, data=None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.data = data
+
+    def to_dict(self):
+        error = {'code': self.code, 'message': self.message}
+        if self.data is not None:
+            error['data'] = self.data
+        return error
+
+
+def encode(message):
+    return (json.dumps(message, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+class RPCServer:
+    """
+    JSON-RPC 2.0 server for a NoteStore, one JSON message per line
+
+    Listens on a Unix socket (readable by this user only) or on a localhost
+    TCP port. Over TCP, a connection has to call "auth" with the token
+    before anything else.
+
+    Requests are handled concurrently, so a client can send many without
+    waiting (responses can come back in any order; match them by id), and
+    batches (arrays of requests) are accepted. notes.list and notes.export
+    stream their results as "stream.items" notifications carrying the
+    request id, followed by the response {"count": n}. The sync.* methods
+    are those of the store's SyncEndpoint, for `cli.py sync` on another
+    store.
+
+    Args:
+        store: An open NoteStore
+        path: Unix socket to listen on
+        host, port: TCP address to listen on when no path is given
+        token: Secret TCP clients authenticate with
+    """
+
+    def __init__(self, store, path=None, host="127.0.0.1", port=0, token=None):
+        if path is None and not token:
+            raise ValueError("A token is required to listen on TCP")
+        self.store = store
+        self.path = path
+        self.host = host
+        self.port = port
+        self.token = token
+        self.server = None
+        self.methods = {
+            'auth': self.auth,
+            'note.get': store.get_note,
+            'note.get_many': store.get_notes,
+            'note.summary': store.get_summary,
+            'note.create': store.create_note,
+            'note.update': store.update_note,
+            'note.delete': store.delete_note,
+            'note.set_tags': store.set_tags,
+            'note.move': store.move_note,
+            'notes.list': self.list_notes,
+            'notes.export': self.export_notes,
+            'notes.search': store.search,
+            'notes.count': store.count_notes,
+            'tags.counts': store.tag_counts,
+            'attachments.list': store.get_attachments,
+            'attachments.add': store.attach_files,
+        }
+        for name, run in SYNC_METHODS.items():
+            self.methods['sync.' + name] = self._run_on(getattr(store, run), getattr(store.sync_endpoint, name))
+
+    async def start(self):
+        if self.path is not None:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            # Created unreadable to others from the start
+            umask = os.umask(0o177)
+            try:
+                self.server = await asyncio.start_unix_server(self._serve, path=self.path, limit=MAX_MESSAGE_SIZE)
+            finally:
+                os.umask(umask)
+        else:
+            self.server = await asyncio.start_server(self._serve, self.host, self.port, limit=MAX_MESSAGE_SIZE)
+            self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def _serve(self, reader, writer):
+        connection = {'authenticated': self.path is not None, 'writer': writer}
+        slots = asyncio.Semaphore(MAX_IN_FLIGHT)
+        tasks = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError):
+                    writer.write(encode(self._error(None, RPCError(PARSE_ERROR, "Message too long"))))
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                await slots.acquire()
+                task = asyncio.ensure_future(self._handle_line(connection, line))
+                tasks.add(task)
+                task.add_done_callback(lambda task: (tasks.discard(task), slots.release()))
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except ConnectionError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _handle_line(self, connection, line):
+        writer = connection['writer']
+        try:
+            message = json.loads(line)
+        except ValueError:
+            response = self._error(None, RPCError(PARSE_ERROR, "Parse error"))
+        else:
+            if isinstance(message, list):
+                if message:
+                    responses = await asyncio.gather(*(self._handle(connection, item) for item in message))
+                    response = [item for item in responses if item is not None] or None
+                else:
+                    response = self._error(None, RPCError(INVALID_REQUEST, "Empty batch"))
+            else:
+                response = await self._handle(connection, message)
+        if response is not None:
+            writer.write(encode(response))
+            await writer.drain()
+
+    async def _handle(self, connection, message):
+        """Handle one request; returns its response, or None for a notification"""
+        if not isinstance(message, dict) or message.get('jsonrpc') != "2.0" or not isinstance(message.get('method'), str):
+            return self._error(message.get('id') if isinstance(message, dict) else None,
+                               RPCError(INVALID_REQUEST, "Invalid request"))
+        request_id = message.get('id')
+        try:
+            result = await self._call(connection, request_id, message['method'], message.get('params', {}))
+        except RPCError as e:
+            response = self._error(request_id, e)
+        except Exception as e:
+            response = self._error(request_id, RPCError(SERVER_ERROR, str(e) or type(e).__name__, type(e).__name__))
+        else:
+            response = {'jsonrpc': "2.0", 'id': request_id, 'result': result}
+        # Notifications get no response, not even an error
+        return response if 'id' in message else None
+
+    async def _call(self, connection, request_id, method, params):
+        fn = self.methods.get(method)
+        if fn is None:
+            raise RPCError(METHOD_NOT_FOUND, f"Method not found: {method}")
+        if not connection['authenticated'] and method != 'auth':
+            raise RPCError(UNAUTHORIZED, "Call auth with the server's token first")
+        _request.set((connection, request_id))
+        try:
+            if isinstance(params, dict):
+                inspect.signature(fn).bind(**params)
+            elif isinstance(params, list):
+                inspect.signature(fn).bind(*params)
+            else:
+                raise TypeError("params must be an object or an array")
+        except TypeError as e:
+            raise RPCError(INVALID_PARAMS, str(e))
+        return await (fn(**params) if isinstance(params, dict) else fn(*params))
+
+    @staticmethod
+    def _run_on(run, fn):
+        """Coroutine running a blocking function with one of the store's run_* methods"""
+        @functools.wraps(fn)
+        async def call(*args, **kwargs):
+            return await run(functools.partial(fn, *args, **kwargs))
+        return call
+
+    @staticmethod
+    def _error(request_id, error):
+        return {'jsonrpc': "2.0", 'id': request_id, 'error': error.to_dict()}
+
+    # Methods that are not a NoteStore method as is
+
+    async def auth(self, token):
+        connection, _ = _request.get()
+        if not self.token or not hmac.compare_digest(str(token).encode(), self.token.encode()):
+            raise RPCError(UNAUTHORIZED, "Wrong token")
+        connection['authenticated'] = True
+        return True
+
+    async def list_notes(self, order=DEFAULT_ORDER, filters=None, page_size=STREAM_PAGE_SIZE):
+        return await self._stream(self.store.iter_notes(order, filters, page_size))
+
+    async def export_notes(self, page_size=STREAM_PAGE_SIZE):
+        return await self._stream(self.store.export_notes(page_size))
+
+    @staticmethod
+    async def _stream(pages):
+        connection, request_id = _request.get()
+        writer = connection['writer']
+        count = 0
+        async for page in pages:
+            writer.write(encode({'jsonrpc': "2.0", 'method': "stream.items",
+                                 'params': {'id': request_id, 'items': page}}))
+            # Waits while the client is slower than the database
+            await writer.drain()
+            count += len(page)
+        return {'count': count}
+
+
+class RPCClient:
+    """
+    asyncio client for RPCServer
+
+        client = await RPCClient.connect(path=socket_path)
+        note_id = await client.call("note.create", title="Title", content="Body")
+        async for summary in client.stream("notes.list"):
+            ...
+
+    Calls can be made concurrently; they are sent without waiting for the
+    previous responses.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._streams = {}
+        self._reading = asyncio.ensure_future(self._read())
+
+    @classmethod
+    async def connect(cls, path=None, host="127.0.0.1", port=None, token=None):
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path, limit=MAX_MESSAGE_SIZE)
+        else:
+            reader, writer = await asyncio.open_connection(host, port, limit=MAX_MESSAGE_SIZE)
+        client = cls(reader, writer)
+        if token is not None:
+            await client.call("auth", token=token)
+        return client
+
+    async def close(self):
+        self.writer.close()
+        self._reading.cancel()
+        try:
+            await self._reading
+        except asyncio.CancelledError:
+            pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _send(self, method, params, queue=None):
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        if queue is not None:
+            self._streams[request_id] = queue
+        self.writer.write(encode({'jsonrpc': "2.0", 'id': request_id, 'method': method, 'params': params}))
+        return request_id, future
+
+    async def call(self, method, *args, **kwargs):
+        """Call a method with positional or keyword parameters and return its result"""
+        _, future = self._send(method, list(args) if args else kwargs)
+        await self.writer.drain()
+        return await future
+
+    async def stream(self, method, **kwargs):
+        """Call a streaming method and yield its items"""
+        queue = asyncio.Queue()
+        request_id, future = self._send(method, kwargs, queue)
+        await self.writer.drain()
+        try:
+            while True:
+                items = await queue.get()
+                if items is None:
+                    break
+                for item in items:
+                    yield item
+            # Raises the error the stream ended with
+            await future
+        finally:
+            self._streams.pop(request_id, None)
+
+    async def _read(self):
+        error = ConnectionError("Connection closed")
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                for item in message if isinstance(message, list) else [message]:
+                    self._dispatch(item)
+        except Exception as e:
+            error = e
+        for request_id, future in self._pending.items():
+            if not future.done():
+                future.set_exception(error)
+            queue = self._streams.get(request_id)
+            if queue is not None:
+                queue.put_nowait(None)
+        self._pending.clear()
+
+    def _dispatch(self, message):
+        if message.get('method') == "stream.items":
+            queue = self._streams.get(message['params']['id'])
+            if queue is not None:
+                queue.put_nowait(message['params']['items'])
+            return
+        future = self._pending.pop(message.get('id'), None)
+        if future is None or future.done():
+            return
+        queue = self._streams.get(message['id'])
+        if queue is not None:
+            queue.put_nowait(None)
+        if 'error' in message:
+            error = message['error']
+            future.set_exception(RPCError(error['code'], error['message'], error.get('data')))
+        else:
+            future.set_result(message['result'])
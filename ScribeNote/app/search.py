@@ -0,0 +1,235 @@
+import html
+import json
+import re
+
+from .compression import BODY_CHANGED
+from .database import split_statements
+
+# Snippets are HTML, since Qt renders tooltips and labels as rich text: the
+# note text is escaped and matched terms are put in bold tags. snippet()
+# marks them with control characters first, which escaping leaves alone
+HIGHLIGHT_START = "<b>"
+HIGHLIGHT_END = "</b>"
+_MARK_START = "\x02"
+_MARK_END = "\x03"
+SNIPPET_ELLIPSIS = "…"
+SNIPPET_TOKENS = 12
+
+# bm25 column weights for (title, content, metadata)
+RANK_WEIGHTS = (10.0, 1.0, 0.5)
+# Matches in attachments (see AttachmentTextIndex) rank below the same match
+# in a note body
+ATTACHMENT_RANK_WEIGHT = 0.5
+
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+# The index stores only its tokens: title, body and metadata are read from
+# notes_fts_source, a view that decodes stored bodies (see BodyCodec) with
+# the note_text() SQL function, when snippets are built. Since the index
+# cannot read the old values back, the triggers pass them in to remove them.
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS notes_fts_ids (
+    id INTEGER PRIMARY KEY,
+    note_id TEXT NOT NULL UNIQUE
+);
+
+CREATE VIEW IF NOT EXISTS notes_fts_source AS
+SELECT m.id AS fts_id, n.title, CASE WHEN n.encrypted THEN '' ELSE note_text(n.content) END AS content, n.metadata
+FROM notes_fts_ids m JOIN notes n ON n.id = m.note_id;
+
+CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5 (
+    title,
+    content,
+    metadata,
+    content = 'notes_fts_source',
+    content_rowid = 'fts_id',
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+);
+
+CREATE TRIGGER IF NOT EXISTS notes_fts_after_insert AFTER INSERT ON notes BEGIN
+    INSERT INTO notes_fts_ids (note_id) VALUES (new.id);
+    INSERT INTO notes_fts (rowid, title, content, metadata) VALUES (
+        (SELECT id FROM notes_fts_ids WHERE note_id = new.id),
+        new.title,
+        CASE WHEN new.encrypted THEN '' ELSE note_text(new.content) END,
+        new.metadata
+    );
+END;
+
+CREATE TRIGGER IF NOT EXISTS notes_fts_after_update
+AFTER UPDATE OF title, content, metadata, encrypted ON notes
+WHEN old.title IS NOT new.title OR old.metadata IS NOT new.metadata OR old.encrypted IS NOT new.encrypted
+    OR {BODY_CHANGED}
+BEGIN
+    INSERT INTO notes_fts (notes_fts, rowid, title, content, metadata) VALUES (
+        'delete',
+        (SELECT id FROM notes_fts_ids WHERE note_id = old.id),
+        old.title,
+        CASE WHEN old.encrypted THEN '' ELSE note_text(old.content) END,
+        old.metadata
+    );
+    INSERT INTO notes_fts (rowid, title, content, metadata) VALUES (
+        (SELECT id FROM notes_fts_ids WHERE note_id = new.id),
+        new.title,
+        CASE WHEN new.encrypted THEN '' ELSE note_text(new.content) END,
+        new.metadata
+    );
+END;
+
+CREATE TRIGGER IF NOT EXISTS notes_fts_after_delete AFTER DELETE ON notes BEGIN
+    INSERT INTO notes_fts (notes_fts, rowid, title, content, metadata) VALUES (
+        'delete',
+        (SELECT id FROM notes_fts_ids WHERE note_id = old.id),
+        old.title,
+        CASE WHEN old.encrypted THEN '' ELSE note_text(old.content) END,
+        old.metadata
+    );
+    DELETE FROM notes_fts_ids WHERE note_id = old.id;
+END;
+'''
+
+# Objects of the index from before it moved to external content, when it
+# kept its own copy of every body
+LEGACY_OBJECTS = (
+    ("TRIGGER", "notes_fts_after_insert"),
+    ("TRIGGER", "notes_fts_after_update"),
+    ("TRIGGER", "notes_fts_after_delete"),
+    ("TABLE", "notes_fts"),
+)
+
+
+def snippet_html(text):
+    """HTML of a snippet from snippet(): the text escaped, the marked matches in bold"""
+    return html.escape(text, quote=False).replace(_MARK_START, HIGHLIGHT_START).replace(_MARK_END, HIGHLIGHT_END)
+
+
+def build_match_query(search_text):
+    """
+    Turn free text typed by the user into an FTS5 MATCH expression
+
+    Every word becomes a quoted prefix term and all terms must match, so
+    "meet not" finds "meeting notes". Returns None when there is nothing to
+    search for.
+    """
+    terms = _TERM_RE.findall(search_text or "")
+    if not terms:
+        return None
+    return " ".join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+
+
+class SearchIndex:
+    """Full-text index over note titles, plaintext bodies and metadata"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def initialize(self, conn):
+        """Create the index and its triggers, backfilling existing notes once"""
+        existing = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'notes_fts'"
+        ).fetchone()
+        if existing is not None and "content_rowid" not in existing['sql']:
+            # Built by an older version with its own copy of the bodies
+            for kind, name in LEGACY_OBJECTS:
+                conn.execute(f"DROP {kind} IF EXISTS {name}")
+            existing = None
+
+        for statement in split_statements(SCHEMA):
+            conn.execute(statement)
+
+        if existing is None:
+            self._backfill(conn)
+
+    def _backfill(self, conn):
+        conn.execute("DELETE FROM notes_fts_ids WHERE note_id NOT IN (SELECT id FROM notes)")
+        conn.execute("INSERT OR IGNORE INTO notes_fts_ids (note_id) SELECT id FROM notes")
+        conn.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+
+    def rebuild(self):
+        """Repopulate the index from the notes table"""
+        with self.db.transaction() as conn:
+            self._backfill(conn)
+            conn.execute("INSERT INTO notes_fts (notes_fts) VALUES ('optimize')")
+
+    def search(self, search_text, limit=50, offset=0, also=None):
+        """
+        Search notes by title, body, metadata and attachment text
+
+        Args:
+            search_text: Text typed by the user; each word is prefix-matched
+            limit: Maximum number of results, or None for all matches
+            offset: Number of ranked results to skip
+            also: Index ids (notes_fts_ids.id) of notes matched some other
+                way, such as by BlindIndex; they follow the ranked matches,
+                without a snippet
+
+        Returns:
+            List of dictionaries with id, title, modified_date, encrypted,
+            snippet (HTML, see snippet_html) and score (lower is better),
+            best match first; notes found by an attachment name it as their
+            snippet
+        """
+        match = build_match_query(search_text)
+        if match is None:
+            return []
+
+        # Each note once, with its best score; with MIN() SQLite takes the
+        # other columns from that row. Only the page is joined to the notes
+        # and given snippets, so the cost of a page does not grow with the
+        # number of matches
+        sql = '''
+            SELECT note_id, fts_id, attachment, MIN(score) AS score FROM (
+            SELECT m.note_id, m.id AS fts_id, NULL AS attachment, bm25(notes_fts, ?, ?, ?) AS score
+            FROM notes_fts
+            JOIN notes_fts_ids m ON m.id = notes_fts.rowid
+            WHERE notes_fts MATCH ?
+            UNION ALL
+            SELECT a.note_id, NULL AS fts_id, a.filename AS attachment, bm25(attachments_fts) * ? AS score
+            FROM attachments_fts
+            JOIN attachments_fts_ids m ON m.id = attachments_fts.rowid
+            JOIN attachments a ON a.id = m.attachment_id
+            WHERE attachments_fts MATCH ?
+            '''
+        params = RANK_WEIGHTS + (match, ATTACHMENT_RANK_WEIGHT, match)
+        if also:
+            # bm25() is negative, so a score of 0 sorts after every ranked match
+            sql += '''
+            UNION ALL
+            SELECT m.note_id, NULL AS fts_id, NULL AS attachment, 0.0 AS score
+            FROM notes_fts_ids m
+            WHERE m.id IN (SELECT value FROM json_each(?))
+            '''
+            params += (json.dumps(sorted(also)),)
+
+        rows = self.db.fetchall(
+            "SELECT n.id, n.title, n.modified_date, n.encrypted, r.fts_id, r.attachment, r.score FROM ("
+            + sql + ") GROUP BY note_id ORDER BY score LIMIT ? OFFSET ?"
+            ") r JOIN notes n ON n.id = r.note_id ORDER BY r.score",
+            params + (-1 if limit is None else limit, offset)
+        )
+
+        fts_ids = [row['fts_id'] for row in rows if row['fts_id'] is not None]
+        snippets = {}
+        if fts_ids:
+            snippets = {
+                row['rowid']: snippet_html(row['snippet']) for row in self.db.fetchall(
+                    "SELECT rowid, snippet(notes_fts, -1, ?, ?, ?, ?) AS snippet FROM notes_fts "
+                    "WHERE notes_fts MATCH ? AND rowid IN (SELECT value FROM json_each(?))",
+                    (_MARK_START, _MARK_END, SNIPPET_ELLIPSIS, SNIPPET_TOKENS, match, json.dumps(fts_ids))
+                )
+            }
+
+        results = []
+        for row in rows:
+            if row['fts_id'] is not None:
+                snippet = snippets.get(row['fts_id'], "")
+            elif row['attachment'] is not None:
+                snippet = html.escape(f"[Attachment: {row['attachment']}]", quote=False)
+            else:
+                snippet = ""
+            results.append({
+                'id': row['id'], 'title': row['title'], 'modified_date': row['modified_date'],
+                'encrypted': row['encrypted'], 'snippet': snippet, 'score': row['score'],
+            })
+        return results
@@ -0,0 +1,131 @@
+import json
+import os
+import sys
+import time
+
+from .instrumentation import instrumentation
+
+SNAPSHOT_NAME = "list_snapshot.json"
+SNAPSHOT_VERSION = 1
+
+# Rows kept in the snapshot: enough to fill the list on first paint
+SNAPSHOT_ROWS = 100
+
+# Summary fields kept per row; never note bodies
+SNAPSHOT_FIELDS = ("id", "title", "created_date", "modified_date", "encrypted", "position", "tags")
+
+# Modules that are only imported once they are needed; --measure-startup
+# reports whether any of them were loaded anyway
+LAZY_MODULES = ("cryptography", "PIL", "multiprocessing", "concurrent.futures")
+
+
+class ListSnapshot:
+    """
+    The note list as it was when the window was last closed
+
+    The first rows of the list (titles and the fields the list shows),
+    with their order, filter and the selected note, are written on close
+    and read at startup before any query runs, so the list is filled on the
+    window's first paint. The real first page replaces them once it is in.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """The saved state, or None if there is none or it cannot be read"""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+            return None
+        return snapshot
+
+    def save(self, rows, order, filters=None, selected_id=None):
+        """
+        Write the list state
+
+        Args:
+            rows: Note summaries in list order (only the first SNAPSHOT_ROWS
+                are kept)
+            order: Name of the list's sort order
+            filters: The list's filter (see MetadataIndex.filter_clause)
+            selected_id: Id of the selected note
+        """
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'order': order,
+            'filters': filters,
+            'selected_id': selected_id,
+            'rows': [{field: row.get(field) for field in SNAPSHOT_FIELDS} for row in rows[:SNAPSHOT_ROWS]],
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.path)
+
+
+class StartupTimer:
+    """
+    Milestones of one application start, for `main.py --measure-startup`
+
+    Times are milliseconds since `started` (a perf_counter() value taken
+    as main.py began). While tracing is on, every milestone is also
+    recorded as a "startup.<name>" span.
+    """
+
+    def __init__(self, started):
+        self.started = started
+        self.marks = {}
+        self.details = {}
+
+    def mark(self, name, **details):
+        """Record a milestone the first time it is reached"""
+        if name in self.marks:
+            return
+        now = time.perf_counter()
+        self.marks[name] = round((now - self.started) * 1000, 1)
+        self.details.update(details)
+        if instrumentation.enabled:
+            instrumentation.record("startup." + name, "startup", self.started, now - self.started)
+
+    def watch(self, window, done, timeout=30.0):
+        """
+        Mark the first paint, first page of notes and first displayed note
+
+        Calls done() once the list is loaded and a note is shown (or the
+        list is empty), or after timeout seconds.
+        """
+        from PyQt5.QtCore import QTimer
+
+        QTimer.singleShot(0, lambda: self.mark("first_paint", rows_at_first_paint=window.note_model.rowCount()))
+        window.note_model.reloaded.connect(lambda: self.mark("first_page"))
+
+        deadline = time.perf_counter() + timeout
+        poll = QTimer(window)
+        poll.setInterval(1)
+
+        def check():
+            if window.current_note_id is not None:
+                self.mark("note_displayed")
+            loaded = "first_page" in self.marks and (
+                "note_displayed" in self.marks or not window.note_model.rowCount()
+            )
+            if loaded or time.perf_counter() > deadline:
+                poll.stop()
+                done()
+
+        poll.timeout.connect(check)
+        poll.start()
+
+    def report(self, **extra):
+        report = {
+            'milestones_ms': dict(self.marks),
+            'lazy_modules_loaded': sorted(name for name in LAZY_MODULES if name in sys.modules),
+        }
+        report.update(self.details)
+        report.update(extra)
+        return report
@@ -0,0 +1,334 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .database import RECLAIM_FREE_PAGES
+from .note_manager import NoteManager, DEFAULT_ORDER
+
+# Reads run in parallel on their own connections; SQLite has one writer, so
+# writes go through a single thread
+DEFAULT_READERS = min(8, (os.cpu_count() or 1) + 2)
+DEFAULT_CRYPTO_WORKERS = os.cpu_count() or 1
+# Calls waiting for a pool before callers are made to wait too
+MAX_PENDING = 1024
+# Writes committed together at most
+WRITE_BATCH_SIZE = 500
+# Ids looked up per query by batched reads
+READ_BATCH_SIZE = 500
+PAGE_SIZE = 500
+
+
+class _Pool:
+    """A thread pool with a bound on the calls queued for it"""
+
+    def __init__(self, workers, name, max_pending=MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.slots = asyncio.Semaphore(max_pending)
+
+    async def run(self, fn, *args):
+        async with self.slots:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class _ReadBatcher:
+    """
+    Turns lookups by id made in the same event loop iteration into one query
+
+    fetch(ids) runs on the reader pool and returns dictionaries with an 'id'
+    key; ids it does not return resolve to None.
+    """
+
+    def __init__(self, pool, fetch):
+        self.pool = pool
+        self.fetch = fetch
+        self._pending = {}
+        self._tasks = set()
+
+    def get(self, key):
+        future = self._pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            if not self._pending:
+                loop.call_soon(self._flush)
+            future = self._pending[key] = loop.create_future()
+        return future
+
+    def _flush(self):
+        pending, self._pending = self._pending, {}
+        keys = list(pending)
+        for start in range(0, len(keys), READ_BATCH_SIZE):
+            part = {key: pending[key] for key in keys[start:start + READ_BATCH_SIZE]}
+            task = asyncio.ensure_future(self._load(part))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _load(self, pending):
+        try:
+            rows = await self.pool.run(self.fetch, list(pending))
+        except Exception as e:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        found = {row['id']: row for row in rows}
+        for key, future in pending.items():
+            if not future.done():
+                future.set_result(found.get(key))
+
+
+class NoteStore:
+    """
+    asyncio interface to the notes, for scripts and the JSON-RPC server
+
+    Blocking work runs on bounded thread pools: reads on several threads,
+    each with its own connection; writes on one thread; encryption and file
+    copies on pools of their own. Lookups of single notes made while a batch
+    is pending are answered by one query, and writes queued while the
+    previous batch commits are committed together, each in a savepoint so a
+    failing write does not undo the others.
+
+        async with NoteStore(db_path, storage_dir) as store:
+            note_id = await store.create_note("Title", "Body")
+            note = await store.get_note(note_id)
+    """
+
+    def __init__(self, db_path=None, storage_dir=None, readers=DEFAULT_READERS,
+                 crypto_workers=DEFAULT_CRYPTO_WORKERS, batch_size=WRITE_BATCH_SIZE):
+        self.db_path = db_path
+        self.storage_dir = storage_dir
+        self.readers = readers
+        self.crypto_workers = crypto_workers
+        self.batch_size = batch_size
+        self.note_manager = None
+        self._file_handler = None
+        self._encryption_handler = None
+        self._sync_endpoint = None
+        self._writes = []
+        self._write_task = None
+        self._deleted = False
+        self._collect_garbage = False
+
+    async def open(self):
+        """Create the pools and open (or create) the database"""
+        self._read_pool = _Pool(self.readers, "store-read")
+        self._write_pool = _Pool(1, "store-write")
+        self._crypto_pool = _Pool(self.crypto_workers, "store-crypto")
+        self._file_pool = _Pool(1, "store-files")
+        self.note_manager = await self._write_pool.run(self._open)
+        self._notes = _ReadBatcher(self._read_pool, self.note_manager.get_notes_by_ids)
+        self._summaries = _ReadBatcher(self._read_pool, self.note_manager.get_note_summaries_by_ids)
+        return self
+
+    def _open(self):
+        from .encryption import EncryptionHandler
+        self._encryption_handler = EncryptionHandler()
+        return NoteManager(self.db_path, self._encryption_handler)
+
+    async def close(self):
+        """Wait for queued writes, stop the pools and close their threads' connections"""
+        if self._write_task is not None:
+            await self._write_task
+        for pool in (self._read_pool, self._write_pool, self._crypto_pool, self._file_pool):
+            pool.shutdown()
+        # The pools' threads have ended
+        self.note_manager.db.close_finished()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def encryption_handler(self):
+        return self._encryption_handler
+
+    @property
+    def file_handler(self):
+        if self._file_handler is None:
+            from .file_handler import FileHandler
+            self._file_handler = FileHandler(self.storage_dir, self.note_manager.db.db_path,
+                                             self._encryption_handler)
+        return self._file_handler
+
+    @property
+    def sync_endpoint(self):
+        if self._sync_endpoint is None:
+            from .sync import SyncEndpoint
+            self._sync_endpoint = SyncEndpoint(self.note_manager, self.file_handler)
+        return self._sync_endpoint
+
+    async def run_read(self, fn, *args):
+        """Run a blocking read on the reader threads"""
+        return await self._read_pool.run(fn, *args)
+
+    async def run_write(self, fn, *args):
+        """Run a blocking write on the writer thread, between write batches"""
+        return await self._write_pool.run(fn, *args)
+
+    async def run_files(self, fn, *args):
+        """Run blocking file work on the file thread"""
+        return await self._file_pool.run(fn, *args)
+
+    # Reading
+
+    async def get_note(self, note_id, password=None):
+        """
+        Get a note, or None if there is none with this id
+
+        With a password, the content of an encrypted note is decrypted.
+        """
+        note = await self._notes.get(note_id)
+        if note is None:
+            return None
+        note = dict(note)
+        if password and note['encrypted']:
+            note['content'] = await self._crypto_pool.run(self._encryption_handler.decrypt, note['content'], password)
+        return note
+
+    async def get_notes(self, note_ids, password=None):
+        """Get several notes, in the order of note_ids (None for missing ones)"""
+        return list(await asyncio.gather(*(self.get_note(note_id, password) for note_id in note_ids)))
+
+    async def get_summary(self, note_id):
+        """Get a note's list columns, without its body"""
+        summary = await self._summaries.get(note_id)
+        return dict(summary) if summary is not None else None
+
+    async def list_notes(self, limit=PAGE_SIZE, after=None, order=DEFAULT_ORDER, filters=None):
+        """One page of summaries, as dictionaries (see NoteManager.get_note_summaries)"""
+        page = await self._read_pool.run(self.note_manager.get_note_summaries, limit, after, order, filters)
+        return [summary.to_dict() for summary in page]
+
+    async def iter_notes(self, order=DEFAULT_ORDER, filters=None, page_size=PAGE_SIZE):
+        """Every matching note's summary, read a page at a time; yields lists of summaries"""
+        after = None
+        while True:
+            page = await self.list_notes(page_size, after, order, filters)
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            after = NoteManager.summary_cursor(page[-1], order)
+
+    async def export_notes(self, page_size=PAGE_SIZE):
+        """Every note as an export record (see NoteExporter), oldest first; yields lists of records"""
+        from .transfer import NoteExporter
+        exporter = NoteExporter(self.note_manager)
+        after = None
+        while True:
+            page = await self._read_pool.run(exporter.records_after, after, page_size)
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            after = (page[-1]['created_date'], page[-1]['id'])
+
+    async def search(self, search_text, limit=50, offset=0):
+        return await self._read_pool.run(self.note_manager.search_notes, search_text, limit, offset)
+
+    async def count_notes(self, filters=None):
+        return await self._read_pool.run(self.note_manager.count_notes, filters)
+
+    async def tag_counts(self):
+        return await self._read_pool.run(self.note_manager.tag_counts)
+
+    async def get_attachments(self, note_id):
+        attachments = await self._read_pool.run(self.note_manager.get_attachments, note_id)
+        return [attachment.to_dict() for attachment in attachments]
+
+    # Writing
+
+    async def create_note(self, title, content, metadata=None, password=None):
+        """Create a note, encrypted if a password is given; returns its id"""
+        if password:
+            content = await self._crypto_pool.run(self._encryption_handler.encrypt, content, password)
+        return await self._write(self.note_manager.create_note, title, content, metadata, bool(password))
+
+    async def update_note(self, note_id, title, content, metadata=None, password=None):
+        """
+        Save a note's title and content (and metadata, if given)
+
+        With a password the note is stored encrypted, under its old salt if
+        it was encrypted already.
+        """
+        if password:
+            stored = await self._notes.get(note_id)
+            if stored is None:
+                raise ValueError(f"Note not found: {note_id}")
+            salt = self._encryption_handler.salt_of(stored['content']) if stored['encrypted'] else None
+            content = await self._crypto_pool.run(self._encryption_handler.encrypt, content, password, salt)
+        await self._write(self.note_manager.update_note, note_id, title, content, metadata, bool(password), password)
+
+    async def delete_note(self, note_id):
+        await self._write(self._delete_note, note_id)
+
+    def _delete_note(self, note_id):
+        # Writer thread
+        self._deleted = True
+        if self.note_manager.get_attachments(note_id):
+            self._collect_garbage = True
+        self.note_manager.delete_note(note_id)
+
+    async def set_tags(self, note_id, tags):
+        await self._write(self.note_manager.set_tags, note_id, tags)
+
+    async def move_note(self, note_id, after_id=None):
+        await self._write(self.note_manager.move_note, note_id, after_id)
+
+    async def attach_files(self, note_id, paths, password=None):
+        """Attach files and folders to a note (see FileHandler.attach_files)"""
+        return await self._file_pool.run(self.file_handler.attach_files, note_id, paths, password)
+
+    async def _write(self, fn, *args):
+        """Queue fn(*args) for the writer thread; it commits with the writes queued alongside it"""
+        future = asyncio.get_running_loop().create_future()
+        self._writes.append((fn, args, future))
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.ensure_future(self._write_loop())
+        return await future
+
+    async def _write_loop(self):
+        while self._writes:
+            batch = self._writes[:self.batch_size]
+            del self._writes[:self.batch_size]
+            try:
+                results = await self._write_pool.run(self._write_batch, [(fn, args) for fn, args, _ in batch])
+            except Exception as e:
+                # The commit itself failed: none of the batch was written
+                results = [(False, e)] * len(batch)
+            for (_, _, future), (ok, value) in zip(batch, results):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _write_batch(self, batch):
+        # Writer thread
+        results = []
+        with self.note_manager.transaction() as conn:
+            for fn, args in batch:
+                conn.execute("SAVEPOINT store_write")
+                try:
+                    value = fn(*args)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO store_write")
+                    results.append((False, e))
+                else:
+                    results.append((True, value))
+                conn.execute("RELEASE store_write")
+        # What delete_note leaves for after the commit, once per batch
+        if self._collect_garbage:
+            self._collect_garbage = False
+            self.file_handler.collect_garbage()
+        if self._deleted:
+            self._deleted = False
+            self.note_manager.db.reclaim_space(min_free_pages=RECLAIM_FREE_PAGES)
+        return results
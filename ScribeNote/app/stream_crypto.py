@@ -0,0 +1,213 @@
+import os
+import struct
+import tempfile
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from .instrumentation import traced
+
+# File layout:
+#   header: magic, version, salt, chunk size, nonce prefix (32 bytes)
+#   chunks: AES-256-GCM(chunk plaintext), each chunk_size + 16 bytes except
+#           possibly the last one
+# Each chunk's nonce is the nonce prefix, the chunk index and a "last chunk"
+# flag, and the header is authenticated with every chunk. Chunks therefore
+# cannot be reordered, dropped, truncated or moved to another file, and any
+# chunk can be decrypted on its own.
+MAGIC = b"SNSE"
+VERSION = 1
+HEADER_FORMAT = ">4sB16sI7s"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Context for deriving the stream key from the password-derived key, so the
+# same password and salt never give the same key as Fernet
+HKDF_INFO = b"scribenote stream v1"
+
+
+def _nonce(prefix, index, last):
+    return prefix + struct.pack(">IB", index, 1 if last else 0)
+
+
+class StreamHeader:
+    """Parsed header of an encrypted stream"""
+
+    def __init__(self, salt, chunk_size, nonce_prefix, version=VERSION):
+        self.version = version
+        self.salt = salt
+        self.chunk_size = chunk_size
+        self.nonce_prefix = nonce_prefix
+
+    def pack(self):
+        return struct.pack(HEADER_FORMAT, MAGIC, self.version, self.salt, self.chunk_size, self.nonce_prefix)
+
+    @classmethod
+    def unpack(cls, data):
+        if len(data) < HEADER_SIZE:
+            raise ValueError("Not a ScribeNote encrypted stream")
+        magic, version, salt, chunk_size, nonce_prefix = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+        if magic != MAGIC:
+            raise ValueError("Not a ScribeNote encrypted stream")
+        if version != VERSION:
+            raise ValueError(f"Unsupported encrypted stream version: {version}")
+        return cls(salt, chunk_size, nonce_prefix, version)
+
+    @property
+    def encrypted_chunk_size(self):
+        return self.chunk_size + TAG_SIZE
+
+
+class StreamCipher:
+    """
+    Chunked, authenticated file encryption in constant memory
+
+    Keys come from the EncryptionHandler, so the PBKDF2 result for a
+    (password, salt) pair is shared with note encryption and cached for the
+    session.
+    """
+
+    def __init__(self, encryption_handler, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.encryption_handler = encryption_handler
+        self.chunk_size = chunk_size
+
+    def _aead(self, password, salt):
+        master_key = self.encryption_handler.derive_key_bytes(password, salt)
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=HKDF_INFO).derive(master_key)
+        return AESGCM(key)
+
+    # File objects
+
+    @traced("crypto.encrypt_stream", "crypto")
+    def encrypt_stream(self, src, dst, password, salt=None):
+        """Encrypt everything read from src into dst; returns bytes written"""
+        if salt is None:
+            salt = self.encryption_handler.new_salt()
+        header = StreamHeader(salt, self.chunk_size, os.urandom(NONCE_PREFIX_SIZE))
+        header_bytes = header.pack()
+        aead = self._aead(password, salt)
+
+        dst.write(header_bytes)
+        written = len(header_bytes)
+
+        # Read one chunk ahead so the final chunk can be flagged as such
+        index = 0
+        current = src.read(self.chunk_size)
+        while True:
+            following = src.read(self.chunk_size)
+            last = not following
+            encrypted = aead.encrypt(_nonce(header.nonce_prefix, index, last), current, header_bytes)
+            dst.write(encrypted)
+            written += len(encrypted)
+            if last:
+                return written
+            current = following
+            index += 1
+
+    @traced("crypto.decrypt_stream", "crypto")
+    def decrypt_stream(self, src, dst, password):
+        """Decrypt an encrypted stream from src into dst; returns bytes written"""
+        header_bytes = src.read(HEADER_SIZE)
+        header = StreamHeader.unpack(header_bytes)
+        aead = self._aead(password, header.salt)
+
+        written = 0
+        index = 0
+        current = src.read(header.encrypted_chunk_size)
+        while True:
+            following = src.read(header.encrypted_chunk_size)
+            last = not following
+            dst.write(self._decrypt_chunk(aead, header, header_bytes, index, current, last))
+            written += len(current) - TAG_SIZE
+            if last:
+                return written
+            current = following
+            index += 1
+
+    def _decrypt_chunk(self, aead, header, header_bytes, index, data, last):
+        try:
+            return aead.decrypt(_nonce(header.nonce_prefix, index, last), data, header_bytes)
+        except InvalidTag:
+            raise ValueError("Incorrect password or corrupted data") from None
+
+    # Paths
+
+    def encrypt_file(self, src_path, dst_path, password, salt=None):
+        """Encrypt a file; dst_path is replaced atomically once complete"""
+        with open(src_path, "rb") as src:
+            return _write_atomically(dst_path, lambda dst: self.encrypt_stream(src, dst, password, salt))
+
+    def decrypt_file(self, src_path, dst_path, password):
+        """Decrypt a file; dst_path is replaced atomically once complete"""
+        with open(src_path, "rb") as src:
+            return _write_atomically(dst_path, lambda dst: self.decrypt_stream(src, dst, password))
+
+    @staticmethod
+    def is_encrypted_file(path):
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+
+    # Random access
+
+    def plaintext_size(self, path):
+        with open(path, "rb") as f:
+            header = StreamHeader.unpack(f.read(HEADER_SIZE))
+            body = os.fstat(f.fileno()).st_size - HEADER_SIZE
+        chunk_count = max(1, -(-body // header.encrypted_chunk_size))
+        return body - chunk_count * TAG_SIZE
+
+    def read_chunk(self, path, index, password):
+        """Decrypt a single chunk without reading the rest of the file"""
+        with open(path, "rb") as f:
+            header_bytes = f.read(HEADER_SIZE)
+            header = StreamHeader.unpack(header_bytes)
+            return self._read_chunk(f, header, header_bytes, self._aead(password, header.salt), index)
+
+    def read_range(self, path, offset, length, password):
+        """Decrypt length bytes of plaintext starting at offset"""
+        with open(path, "rb") as f:
+            header_bytes = f.read(HEADER_SIZE)
+            header = StreamHeader.unpack(header_bytes)
+            aead = self._aead(password, header.salt)
+
+            parts = []
+            end = offset + length
+            index = offset // header.chunk_size
+            while offset < end:
+                chunk = self._read_chunk(f, header, header_bytes, aead, index)
+                start = offset - index * header.chunk_size
+                piece = chunk[start:start + (end - offset)]
+                if not piece:
+                    break
+                parts.append(piece)
+                offset += len(piece)
+                index += 1
+            return b"".join(parts)
+
+    def _read_chunk(self, f, header, header_bytes, aead, index):
+        body = os.fstat(f.fileno()).st_size - HEADER_SIZE
+        chunk_count = max(1, -(-body // header.encrypted_chunk_size))
+        if not 0 <= index < chunk_count:
+            raise IndexError(f"Chunk {index} out of range")
+        f.seek(HEADER_SIZE + index * header.encrypted_chunk_size)
+        data = f.read(header.encrypted_chunk_size)
+        return self._decrypt_chunk(aead, header, header_bytes, index, data, index == chunk_count - 1)
+
+
+def _write_atomically(path, write):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as dst:
+            result = write(dst)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return result
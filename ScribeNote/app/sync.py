@@ -0,0 +1,615 @@
+import base64
+import itertools
+import json
+import os
+import re
+import socket
+import uuid
+
+from .blob_store import PreparedBlob, hash_file, fast_copy
+from .compression import BODY_CHANGED
+from .database import split_statements, RECLAIM_FREE_PAGES
+
+# Bumped when stores can no longer sync with older ones
+PROTOCOL_VERSION = 1
+
+# Versions compared per round trip
+PAGE_SIZE = 500
+# Notes sent per round trip
+RECORDS_PER_CALL = 50
+# Attachment bytes sent per round trip
+BLOB_CHUNK_SIZE = 1024 * 1024
+# Sync errors kept in a result
+MAX_ERRORS = 100
+
+CONTENT_HASH = re.compile(r"^[0-9a-f]{64}$")
+
+# Stamps a note with the next Lamport clock value of this store; {note_id}
+# and {deleted} are SQL expressions
+STAMP = '''
+    UPDATE sync_clock SET clock = clock + 1, seq = seq + 1;
+    DELETE FROM note_versions WHERE note_id = {note_id};
+    INSERT INTO note_versions (note_id, clock, replica, deleted, seq)
+        SELECT {note_id}, clock, replica, {deleted}, seq FROM sync_clock;
+'''
+
+# Every note's version: the Lamport clock value and the store (replica)
+# of the last change to it, compared as (clock, replica) so all stores
+# pick the same winner. seq orders the changes of this store, for "what
+# changed since". Deleted notes keep a version (a tombstone) so an old copy
+# elsewhere does not bring them back. Changes to attachments are changes
+# to their note; changes to its position in the manual order are not.
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS sync_clock (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    replica TEXT NOT NULL,
+    clock INTEGER NOT NULL,
+    seq INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS note_versions (
+    note_id TEXT PRIMARY KEY,
+    clock INTEGER NOT NULL,
+    replica TEXT NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    seq INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_note_versions_seq ON note_versions (seq);
+
+-- Sequence number of each other store up to which its changes are here
+CREATE TABLE IF NOT EXISTS sync_peers (
+    replica TEXT PRIMARY KEY,
+    received_seq INTEGER NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS note_versions_note_insert AFTER INSERT ON notes BEGIN
+    {STAMP.format(note_id="new.id", deleted=0)}
+END;
+
+CREATE TRIGGER IF NOT EXISTS note_versions_note_update AFTER UPDATE ON notes
+WHEN old.modified_date IS NOT new.modified_date OR old.title IS NOT new.title
+    OR old.metadata IS NOT new.metadata OR old.encrypted IS NOT new.encrypted
+    OR old.created_date IS NOT new.created_date OR {BODY_CHANGED}
+BEGIN
+    {STAMP.format(note_id="new.id", deleted=0)}
+END;
+
+CREATE TRIGGER IF NOT EXISTS note_versions_note_delete AFTER DELETE ON notes BEGIN
+    {STAMP.format(note_id="old.id", deleted=1)}
+END;
+
+CREATE TRIGGER IF NOT EXISTS note_versions_attachment_insert AFTER INSERT ON attachments
+WHEN EXISTS (SELECT 1 FROM notes WHERE id = new.note_id) BEGIN
+    {STAMP.format(note_id="new.note_id", deleted=0)}
+END;
+
+CREATE TRIGGER IF NOT EXISTS note_versions_attachment_update AFTER UPDATE ON attachments
+WHEN EXISTS (SELECT 1 FROM notes WHERE id = new.note_id) BEGIN
+    {STAMP.format(note_id="new.note_id", deleted=0)}
+END;
+
+CREATE TRIGGER IF NOT EXISTS note_versions_attachment_delete AFTER DELETE ON attachments
+WHEN EXISTS (SELECT 1 FROM notes WHERE id = old.note_id) BEGIN
+    {STAMP.format(note_id="old.note_id", deleted=0)}
+END;
+'''
+
+NOTE_COLUMNS = "id, title, content, created_date, modified_date, metadata, encrypted"
+
+
+def checked_hash(content_hash):
+    """A content hash received from another store, checked before it names a file"""
+    if not isinstance(content_hash, str) or not CONTENT_HASH.match(content_hash):
+        raise ValueError(f"Not a content hash: {content_hash!r}")
+    return content_hash
+
+
+def is_newer(version, other):
+    """Whether a (clock, replica) version wins over other (None: no version)"""
+    return other is None or tuple(version) > tuple(other)
+
+
+class NoteVersions:
+    """
+    Lamport clock of a store and the version of every note in it
+
+    Kept by triggers, so every way of changing notes (any window, process
+    or import) is tracked.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def initialize(self, conn):
+        for statement in split_statements(SCHEMA):
+            conn.execute(statement)
+        if conn.execute("SELECT 1 FROM sync_clock").fetchone() is None:
+            # Notes from before versions were kept share the oldest version
+            # (stores copied from one another agree on it), in creation order
+            conn.execute(
+                "INSERT OR IGNORE INTO note_versions (note_id, clock, replica, deleted, seq) "
+                "SELECT id, 0, '', 0, ROW_NUMBER() OVER (ORDER BY created_date, id) FROM notes"
+            )
+            conn.execute(
+                "INSERT INTO sync_clock (id, replica, clock, seq) "
+                "SELECT 0, ?, 0, (SELECT COUNT(*) FROM note_versions)",
+                (uuid.uuid4().hex,)
+            )
+
+    @property
+    def replica(self):
+        return self.db.fetchone("SELECT replica FROM sync_clock")['replica']
+
+    def latest_seq(self):
+        return self.db.fetchone("SELECT seq FROM sync_clock")['seq']
+
+    def new_replica(self):
+        """
+        Give this store a new replica id, for a store copied from another one
+
+        Notes last changed here are restamped with it, so copies that both
+        changed a note after the copy still order their versions.
+        """
+        replica = uuid.uuid4().hex
+        with self.db.transaction() as conn:
+            old = conn.execute("SELECT replica FROM sync_clock").fetchone()['replica']
+            conn.execute("UPDATE sync_clock SET replica = ?", (replica,))
+            conn.execute("UPDATE note_versions SET replica = ? WHERE replica = ?", (replica, old))
+        return replica
+
+    def stamp(self, conn, note_id, clock, replica, deleted):
+        """Give a note a version received from another store; runs in the caller's transaction"""
+        conn.execute("UPDATE sync_clock SET clock = MAX(clock, ?), seq = seq + 1", (clock,))
+        conn.execute("DELETE FROM note_versions WHERE note_id = ?", (note_id,))
+        conn.execute(
+            "INSERT INTO note_versions (note_id, clock, replica, deleted, seq) "
+            "SELECT ?, ?, ?, ?, seq FROM sync_clock",
+            (note_id, clock, replica, 1 if deleted else 0)
+        )
+
+
+class SyncEndpoint:
+    """
+    One store's side of a sync
+
+    The methods take and return JSON-serializable values, so the other
+    store can call them in-process (SyncEndpoint) or over the JSON-RPC
+    server (RemoteEndpoint).
+    """
+
+    def __init__(self, note_manager, file_handler):
+        self.note_manager = note_manager
+        self.file_handler = file_handler
+        self.db = note_manager.db
+        self.versions = note_manager.versions
+        self.blob_store = file_handler.blob_store
+
+    @classmethod
+    def open(cls, data_dir):
+        """Endpoint of the store in a data directory (notes.db and attachments/)"""
+        from .note_manager import NoteManager
+        from .file_handler import FileHandler
+        db_path = os.path.join(data_dir, "notes.db")
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"No notes.db in {data_dir}")
+        return cls(NoteManager(db_path), FileHandler(os.path.join(data_dir, "attachments"), db_path))
+
+    def info(self):
+        return {'protocol': PROTOCOL_VERSION, 'replica': self.versions.replica, 'seq': self.versions.latest_seq()}
+
+    def received(self, replica):
+        """Sequence number of another store up to which its changes are here"""
+        row = self.db.fetchone("SELECT received_seq FROM sync_peers WHERE replica = ?", (replica,))
+        return row['received_seq'] if row else 0
+
+    def set_received(self, replica, seq):
+        self.db.execute("INSERT OR REPLACE INTO sync_peers (replica, received_seq) VALUES (?, ?)", (replica, seq))
+
+    def changes(self, after_seq, limit=PAGE_SIZE, exclude_replica=None):
+        """
+        Versions of the notes changed after a sequence number of this store
+
+        Args:
+            after_seq: Sequence number the caller has seen changes up to
+            limit: Number of changes to look at
+            exclude_replica: Leave out versions made by this store (the
+                caller, which has them or newer ones)
+
+        Returns:
+            {'seq': sequence number of the last change looked at (after_seq
+            if there are none), 'versions': list of dictionaries with id,
+            clock, replica and deleted}
+        """
+        rows = self.db.fetchall(
+            "SELECT note_id AS id, clock, replica, deleted, seq FROM note_versions WHERE seq > ? ORDER BY seq LIMIT ?",
+            (after_seq, limit)
+        )
+        return {
+            'seq': rows[-1]['seq'] if rows else after_seq,
+            'versions': [
+                {'id': row['id'], 'clock': row['clock'], 'replica': row['replica'], 'deleted': row['deleted']}
+                for row in rows if row['replica'] != exclude_replica
+            ],
+        }
+
+    def note_versions(self, note_ids):
+        """{note id: [clock, replica]} of the notes this store has a version of"""
+        found = {}
+        for start in range(0, len(note_ids), PAGE_SIZE):
+            part = note_ids[start:start + PAGE_SIZE]
+            rows = self.db.fetchall(
+                f"SELECT note_id, clock, replica FROM note_versions WHERE note_id IN ({', '.join('?' * len(part))})",
+                part
+            )
+            found.update((row['note_id'], [row['clock'], row['replica']]) for row in rows)
+        return found
+
+    def records(self, note_ids):
+        """
+        Current state of notes, to apply() in another store
+
+        Returns:
+            List of dictionaries with the note's id, version (clock, replica,
+            deleted) and, unless deleted, its columns (content as stored:
+            encrypted notes stay encrypted) and attachments with their
+            content hash and size. Attachments from before the blob store
+            (see `attachments migrate`) are left out.
+        """
+        if not note_ids:
+            return []
+        placeholders = ", ".join("?" * len(note_ids))
+        rows = self.db.fetchall(
+            "SELECT v.note_id AS id, v.clock, v.replica, v.deleted OR n.id IS NULL AS deleted, n.title, "
+            "n.content, n.created_date, n.modified_date, n.metadata, n.encrypted "
+            f"FROM note_versions v LEFT JOIN notes n ON n.id = v.note_id WHERE v.note_id IN ({placeholders})",
+            note_ids
+        )
+        attachments = {}
+        for row in self.db.fetchall(
+            "SELECT a.id, a.note_id, a.filename, a.file_type, a.created_date, a.encrypted, a.content_hash, b.size "
+            f"FROM attachments a JOIN blobs b ON b.hash = a.content_hash WHERE a.note_id IN ({placeholders})",
+            note_ids
+        ):
+            attachments.setdefault(row['note_id'], []).append(dict(row))
+
+        records = []
+        for row in rows:
+            record = {'id': row['id'], 'clock': row['clock'], 'replica': row['replica'], 'deleted': bool(row['deleted'])}
+            if not record['deleted']:
+                record.update(
+                    title=row['title'],
+                    content=self.note_manager.codec.decode(row['content']),
+                    created_date=row['created_date'],
+                    modified_date=row['modified_date'],
+                    metadata=row['metadata'],
+                    encrypted=bool(row['encrypted']),
+                    attachments=attachments.get(row['id'], [])
+                )
+            records.append(record)
+        return records
+
+    # Attachment contents, by content hash
+
+    def _part_path(self, content_hash):
+        return os.path.join(self.blob_store.root_dir, f".sync-{checked_hash(content_hash)}.part")
+
+    def missing_blobs(self, content_hashes):
+        """{content hash: bytes already received} of the attachment contents this store lacks"""
+        missing = {}
+        for content_hash in content_hashes:
+            part_path = self._part_path(content_hash)
+            if not self.blob_store.contains(content_hash):
+                missing[content_hash] = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        return missing
+
+    def blob_path(self, content_hash):
+        return self.blob_store.path_for(checked_hash(content_hash))
+
+    def read_blob(self, content_hash, offset, length=BLOB_CHUNK_SIZE):
+        """Part of an attachment's stored content, base64-encoded"""
+        with open(self.blob_path(content_hash), "rb") as f:
+            f.seek(offset)
+            return base64.b64encode(f.read(length)).decode("ascii")
+
+    def write_blob(self, content_hash, offset, data):
+        """
+        Append base64-encoded content to a partly received attachment
+
+        Returns:
+            Number of bytes received so far; when offset does not match it
+            (a chunk was lost or sent twice) nothing is written and the
+            sender continues from there
+        """
+        part_path = self._part_path(content_hash)
+        size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset != size:
+            return size
+        with open(part_path, "ab") as f:
+            f.write(base64.b64decode(data))
+            return f.tell()
+
+    def finish_blob(self, content_hash):
+        """Check a received attachment against its hash and add it to the blob store"""
+        part_path = self._part_path(content_hash)
+        if hash_file(part_path) != content_hash:
+            os.remove(part_path)
+            raise ValueError(f"Received attachment content does not match its hash {content_hash}")
+        blob_path = self.blob_store.path_for(content_hash)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(part_path, blob_path)
+
+    def import_blob(self, content_hash, source_path):
+        """Copy an attachment's content from another store on this machine"""
+        fast_copy(source_path, self._part_path(content_hash))
+        self.finish_blob(content_hash)
+
+    # Applying changes
+
+    def apply(self, records):
+        """
+        Apply records from another store, in one transaction
+
+        A record replaces the note only if its version is newer than the one
+        here; the replaced text stays in the note's history.
+
+        Returns:
+            Dictionary with the number of notes 'applied' and 'skipped'
+            (not newer), and of 'missing' attachments whose content was not
+            here yet (left out)
+        """
+        result = {'applied': 0, 'skipped': 0, 'missing': 0}
+        removed = 0
+        with self.db.transaction() as conn:
+            self.note_manager.codec.refresh(conn)
+            local = self.note_versions([record['id'] for record in records])
+            for record in records:
+                if not is_newer((record['clock'], record['replica']), local.get(record['id'])):
+                    result['skipped'] += 1
+                    continue
+                if record['deleted']:
+                    removed += conn.execute("DELETE FROM attachments WHERE note_id = ?", (record['id'],)).rowcount
+                    conn.execute("DELETE FROM notes WHERE id = ?", (record['id'],))
+                else:
+                    missing, removed_here = self._write_note(conn, record)
+                    result['missing'] += missing
+                    removed += removed_here
+                self.versions.stamp(conn, record['id'], record['clock'], record['replica'], record['deleted'])
+                result['applied'] += 1
+        if removed:
+            # Contents only the replaced versions referred to; files from
+            # before the blob store are left to `attachments gc`
+            self.file_handler.blob_store.collect_garbage()
+        self.db.reclaim_space(min_free_pages=RECLAIM_FREE_PAGES)
+        return result
+
+    def _write_note(self, conn, record):
+        """Insert or replace a note and its attachments; returns (attachments left out, attachments removed)"""
+        note_manager = self.note_manager
+        note_id = record['id']
+        stored = note_manager.codec.encode(record['content'], record['encrypted'])
+        values = (record['title'], stored, record['created_date'], record['modified_date'],
+                  record['metadata'], 1 if record['encrypted'] else 0)
+        if conn.execute("SELECT 1 FROM notes WHERE id = ?", (note_id,)).fetchone():
+            conn.execute(
+                "UPDATE notes SET title = ?, content = ?, created_date = ?, modified_date = ?, metadata = ?, "
+                "encrypted = ? WHERE id = ?",
+                values + (note_id,)
+            )
+        else:
+            conn.execute(f"INSERT INTO notes ({NOTE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)", (note_id,) + values)
+        note_manager.revisions.record(note_id, record['title'], record['content'], record['encrypted'])
+
+        # Attachments from before the blob store are not synced, so stay
+        wanted = {attachment['id']: attachment for attachment in record['attachments']}
+        removed = 0
+        for row in conn.execute(
+            "SELECT id FROM attachments WHERE note_id = ? AND content_hash IS NOT NULL", (note_id,)
+        ).fetchall():
+            if row['id'] not in wanted:
+                conn.execute("DELETE FROM attachments WHERE id = ?", (row['id'],))
+                removed += 1
+            else:
+                del wanted[row['id']]
+
+        missing = 0
+        for attachment in wanted.values():
+            content_hash = attachment['content_hash']
+            blob_path = self.blob_path(content_hash)
+            if not os.path.exists(blob_path):
+                missing += 1
+                continue
+            self.blob_store.commit(PreparedBlob(content_hash, attachment['size'], blob_path))
+            conn.execute(
+                "INSERT OR REPLACE INTO attachments (id, note_id, filename, file_path, file_type, created_date, "
+                "encrypted, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (attachment['id'], note_id, attachment['filename'], blob_path, attachment['file_type'],
+                 attachment['created_date'], 1 if attachment['encrypted'] else 0, content_hash)
+            )
+        return missing, removed
+
+
+class RemoteEndpoint:
+    """
+    SyncEndpoint of a store served by `cli.py serve`, called over its socket
+
+    Calls block; the engine makes one call at a time.
+    """
+
+    def __init__(self, path=None, host="127.0.0.1", port=None, token=None):
+        from .rpc import MAX_MESSAGE_SIZE
+        if path is not None:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(path)
+        else:
+            self.socket = socket.create_connection((host, port))
+        self.file = self.socket.makefile("rwb", buffering=MAX_MESSAGE_SIZE)
+        self._ids = itertools.count(1)
+        if token is not None:
+            self._call("auth", token)
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def _call(self, method, *params):
+        from .rpc import RPCError, encode
+        request_id = next(self._ids)
+        self.file.write(encode({'jsonrpc': "2.0", 'id': request_id, 'method': method, 'params': list(params)}))
+        self.file.flush()
+        while True:
+            line = self.file.readline()
+            if not line:
+                raise ConnectionError("The server closed the connection")
+            message = json.loads(line)
+            if isinstance(message, dict) and message.get('id') == request_id:
+                break
+        if 'error' in message:
+            error = message['error']
+            raise RPCError(error['code'], error['message'], error.get('data'))
+        return message['result']
+
+    def info(self):
+        return self._call("sync.info")
+
+    def received(self, replica):
+        return self._call("sync.received", replica)
+
+    def set_received(self, replica, seq):
+        return self._call("sync.set_received", replica, seq)
+
+    def changes(self, after_seq, limit=PAGE_SIZE, exclude_replica=None):
+        return self._call("sync.changes", after_seq, limit, exclude_replica)
+
+    def note_versions(self, note_ids):
+        return self._call("sync.note_versions", note_ids)
+
+    def records(self, note_ids):
+        return self._call("sync.records", note_ids)
+
+    def missing_blobs(self, content_hashes):
+        return self._call("sync.missing_blobs", content_hashes)
+
+    def read_blob(self, content_hash, offset, length=BLOB_CHUNK_SIZE):
+        return self._call("sync.read_blob", content_hash, offset, length)
+
+    def write_blob(self, content_hash, offset, data):
+        return self._call("sync.write_blob", content_hash, offset, data)
+
+    def finish_blob(self, content_hash):
+        return self._call("sync.finish_blob", content_hash)
+
+    def apply(self, records):
+        return self._call("sync.apply", records)
+
+
+def transfer(source, target, progress=None):
+    """
+    Bring the changes of source that target does not have yet over to it
+
+    Works through the source's changes since the last transfer a page at a
+    time: only versions are compared, and only notes newer than the
+    target's copy and attachment contents the target lacks are sent. After
+    each page the target remembers how far it got, and partly sent
+    attachments continue where they stopped, so an interrupted transfer
+    resumes.
+
+    A note whose attachment content could not be copied is held back and
+    the transfer stops after that page, so the next one tries again.
+
+    Args:
+        source, target: SyncEndpoint or RemoteEndpoint
+        progress: Called with (notes compared, bytes sent) after each page
+
+    Returns:
+        Dictionary with the numbers of notes 'compared', 'applied',
+        'skipped' (not newer) and 'held_back', attachment 'blobs' copied,
+        'bytes' sent (versions, notes and attachment contents), 'missing'
+        attachments left out, and 'errors'
+    """
+    source_info = source.info()
+    target_info = target.info()
+    if source_info['protocol'] != PROTOCOL_VERSION or target_info['protocol'] != PROTOCOL_VERSION:
+        raise ValueError("The stores run versions of ScribeNote that cannot sync with each other")
+    if source_info['replica'] == target_info['replica']:
+        raise ValueError("Both stores have the same sync id; one is a copy of the other. "
+                         "Run `python cli.py sync --new-id` on one of them first")
+
+    result = {'compared': 0, 'applied': 0, 'skipped': 0, 'held_back': 0, 'blobs': 0, 'bytes': 0, 'missing': 0,
+              'errors': []}
+    after = target.received(source_info['replica'])
+    while True:
+        page = source.changes(after, PAGE_SIZE, target_info['replica'])
+        if page['seq'] == after:
+            break
+        versions = page['versions']
+        result['bytes'] += len(json.dumps(page))
+        theirs = target.note_versions([change['id'] for change in versions]) if versions else {}
+        wanted = [change['id'] for change in versions
+                  if is_newer((change['clock'], change['replica']), theirs.get(change['id']))]
+        result['compared'] += len(versions)
+
+        for start in range(0, len(wanted), RECORDS_PER_CALL):
+            records = source.records(wanted[start:start + RECORDS_PER_CALL])
+            result['bytes'] += len(json.dumps(records))
+            sizes = {}
+            for record in records:
+                for attachment in record.get('attachments', ()):
+                    sizes[attachment['content_hash']] = attachment['size']
+            failed = set()
+            for content_hash, received in target.missing_blobs(list(sizes)).items():
+                try:
+                    result['bytes'] += _copy_blob(source, target, content_hash, received, sizes[content_hash])
+                    result['blobs'] += 1
+                except Exception as e:
+                    failed.add(content_hash)
+                    if len(result['errors']) < MAX_ERRORS:
+                        result['errors'].append(f"{content_hash}: {e}")
+            if failed:
+                complete = [record for record in records if not any(
+                    attachment['content_hash'] in failed for attachment in record.get('attachments', ()))]
+                result['held_back'] += len(records) - len(complete)
+                records = complete
+            applied = target.apply(records)
+            for key in ('applied', 'skipped', 'missing'):
+                result[key] += applied[key]
+
+        if result['held_back']:
+            break
+        after = page['seq']
+        target.set_received(source_info['replica'], after)
+        if progress:
+            progress(result['compared'], result['bytes'])
+    return result
+
+
+def _copy_blob(source, target, content_hash, offset, size):
+    """Copy (the rest of) an attachment's content; returns the bytes sent"""
+    if isinstance(source, SyncEndpoint) and isinstance(target, SyncEndpoint):
+        target.import_blob(content_hash, source.blob_path(content_hash))
+        return size
+    sent = 0
+    while offset < size:
+        data = source.read_blob(content_hash, offset, BLOB_CHUNK_SIZE)
+        if not data:
+            raise ValueError("Attachment content ended early")
+        written = target.write_blob(content_hash, offset, data)
+        sent += written - offset if written > offset else 0
+        offset = written
+    target.finish_blob(content_hash)
+    return sent
+
+
+def sync(local, remote, progress=None):
+    """
+    Sync two stores both ways
+
+    When both changed a note, the version with the higher (Lamport clock,
+    replica id) wins in both stores, whatever order they sync in.
+
+    Returns:
+        {'received': transfer(remote, local), 'sent': transfer(local, remote)}
+    """
+    received = transfer(remote, local, progress)
+    sent = transfer(local, remote, progress)
+    return {'received': received, 'sent': sent}
@@ -0,0 +1,193 @@
+import threading
+import time
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+from .instrumentation import instrumentation
+
+# Lanes: reads and CPU work run in parallel; writes run one at a time, in the
+# order they were submitted, so two saves of the same note cannot swap places
+READ = "read"
+WRITE = "write"
+# Long file copies (attaching a folder of photos) run one batch at a time in
+# a lane of their own, so they hold up neither note loads nor saves
+FILES = "files"
+
+
+class TaskSignals(QObject):
+    """Signals of one task; created on the UI thread so slots run there"""
+
+    result = pyqtSignal(object)
+    error = pyqtSignal(object)
+    progress = pyqtSignal(object)
+    done = pyqtSignal()
+
+
+class Task(QRunnable):
+    """
+    A unit of work for the TaskExecutor
+
+    Long-running functions can accept a `task` keyword argument (see
+    TaskExecutor.submit) to report progress and check for cancellation.
+    """
+
+    def __init__(self, fn, args, kwargs, key=None, lane=READ, pass_task=False):
+        super().__init__()
+        # The executor keeps the reference; Qt must not delete the object
+        self.setAutoDelete(False)
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.lane = lane
+        self.pass_task = pass_task
+        self.signals = TaskSignals()
+        self._cancelled = threading.Event()
+        self._superseded = threading.Event()
+        self.submitted = time.perf_counter()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def supersede(self):
+        """Still run, but without reporting back: a newer task with the same key took over"""
+        self._superseded.set()
+
+    def _reports(self):
+        return not self._cancelled.is_set() and not self._superseded.is_set()
+
+    def report_progress(self, value):
+        if self._reports():
+            self.signals.progress.emit(value)
+
+    def run(self):
+        try:
+            if self.is_cancelled():
+                return
+            kwargs = dict(self.kwargs, task=self) if self.pass_task else self.kwargs
+            started = time.perf_counter()
+            try:
+                result = instrumentation.call(self.fn, *self.args, **kwargs)
+            except Exception as e:
+                if self._reports():
+                    self.signals.error.emit(e)
+            else:
+                if self._reports():
+                    self.signals.result.emit(result)
+            finally:
+                if instrumentation.enabled:
+                    instrumentation.record(
+                        "task." + getattr(self.fn, "__name__", "task"), "task", started,
+                        time.perf_counter() - started,
+                        {'lane': self.lane, 'queued_ms': round((started - self.submitted) * 1000, 3)},
+                    )
+        finally:
+            self.signals.done.emit()
+
+
+class TaskExecutor(QObject):
+    """
+    Runs NoteManager, EncryptionHandler and FileHandler calls off the UI thread
+
+    Results and errors are delivered through Qt signals, so callbacks run on
+    the UI thread. Tasks submitted with the same key coalesce: a newer read
+    replaces an older one that has not started yet, and the result of an
+    older one that is already running is dropped. Writes are never dropped
+    once queued: an older keyed write still runs, only its callbacks are
+    skipped.
+    """
+
+    busy_changed = pyqtSignal(bool)
+
+    def __init__(self, parent=None, max_threads=None):
+        super().__init__(parent)
+        self.pools = {
+            READ: QThreadPool(self),
+            WRITE: QThreadPool(self),
+            FILES: QThreadPool(self),
+        }
+        if max_threads:
+            self.pools[READ].setMaxThreadCount(max_threads)
+        self.pools[WRITE].setMaxThreadCount(1)
+        self.pools[FILES].setMaxThreadCount(1)
+        for pool in self.pools.values():
+            # Each thread keeps a database connection (see ConnectionManager),
+            # so threads are kept rather than replaced after going idle
+            pool.setExpiryTimeout(-1)
+        self._active = set()
+        self._latest = {}
+
+    @property
+    def busy(self):
+        return bool(self._active)
+
+    def submit(self, fn, *args, on_result=None, on_error=None, on_progress=None,
+               key=None, lane=READ, pass_task=False, **kwargs):
+        """
+        Run fn(*args, **kwargs) on a worker thread
+
+        Args:
+            on_result: Called on the UI thread with the return value
+            on_error: Called on the UI thread with the exception
+            on_progress: Called on the UI thread with values passed to
+                task.report_progress()
+            key: Coalescing key; only the latest task per key reports back
+                (see the class docstring)
+            lane: READ (parallel), WRITE (serial, in submission order) or FILES
+            pass_task: Call fn with task=<Task> for progress and cancellation
+
+        Returns:
+            The Task, which can be cancelled
+        """
+        task = Task(fn, args, kwargs, key=key, lane=lane, pass_task=pass_task)
+
+        if key is not None:
+            previous = self._latest.get(key)
+            if previous is not None:
+                if previous.lane == WRITE:
+                    # Writes are never dropped once queued; only reads are replaced
+                    previous.supersede()
+                else:
+                    previous.cancel()
+                    if previous.lane == READ and self.pools[READ].tryTake(previous):
+                        self._finish(previous)
+            self._latest[key] = task
+
+        if on_result is not None:
+            task.signals.result.connect(on_result)
+        if on_error is not None:
+            task.signals.error.connect(on_error)
+        if on_progress is not None:
+            task.signals.progress.connect(on_progress)
+        task.signals.done.connect(lambda: self._finish(task))
+
+        was_busy = self.busy
+        self._active.add(task)
+        if not was_busy:
+            self.busy_changed.emit(True)
+
+        self.pools[lane].start(task)
+        return task
+
+    def cancel(self, key):
+        """Cancel the latest task submitted with a key"""
+        task = self._latest.get(key)
+        if task is not None:
+            task.cancel()
+
+    def _finish(self, task):
+        if task not in self._active:
+            return
+        self._active.discard(task)
+        if task.key is not None and self._latest.get(task.key) is task:
+            del self._latest[task.key]
+        if not self.busy:
+            self.busy_changed.emit(False)
+
+    def wait(self, msecs=-1):
+        """Block until all queued work is done (used on shutdown)"""
+        for pool in self.pools.values():
+            pool.waitForDone(msecs)
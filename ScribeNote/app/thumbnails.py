@@ -0,0 +1,191 @@
+import os
+import tempfile
+import threading
+
+from .blob_store import hash_file
+from .instrumentation import traced
+
+DEFAULT_SIZE = 128
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_WORKERS = 2
+
+IMAGE_TYPES = ("image/jpeg", "image/png", "image/gif", "image/bmp", "image/webp", "image/tiff")
+
+
+def is_image(attachment):
+    return (attachment.get('file_type') or "") in IMAGE_TYPES and not attachment.get('encrypted')
+
+
+@traced("file.thumbnail", "file")
+def render_thumbnail(source_path, destination_base, size):
+    """
+    Decode an image at reduced resolution and save a thumbnail
+
+    JPEGs are decoded with draft(), which lets libjpeg scale by 1/2, 1/4 or
+    1/8 while decoding; other formats use reduce() to cut the pixel count
+    cheaply before the final high-quality resize. Returns the written path
+    (".png" for images with transparency, ".jpg" otherwise).
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(source_path) as image:
+        if image.format == "JPEG":
+            image.draft("RGB", (size, size))
+
+        factor = min(image.width // size, image.height // size)
+        if factor >= 2:
+            image = image.reduce(factor)
+
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size), Image.LANCZOS)
+
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        if has_alpha:
+            path = destination_base + ".png"
+            image = image.convert("RGBA")
+            save = lambda f: image.save(f, "PNG", optimize=False)
+        else:
+            path = destination_base + ".jpg"
+            image = image.convert("RGB")
+            save = lambda f: image.save(f, "JPEG", quality=85)
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                save(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+
+class ThumbnailCache:
+    """
+    On-disk thumbnail cache keyed by content hash and size
+
+    Thumbnails are rendered on a thread pool. The cache directory is kept
+    under max_bytes by evicting the least recently used files; a cache hit
+    refreshes the file's mtime, which serves as the LRU timestamp.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, workers=DEFAULT_WORKERS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.workers = workers
+        # Started with the first request, so notes without images cost nothing
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._total_bytes = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _base_path(self, content_hash, size):
+        return os.path.join(self.cache_dir, content_hash[:2], f"{content_hash}-{size}")
+
+    def lookup(self, content_hash, size=DEFAULT_SIZE):
+        """Path of a cached thumbnail, or None"""
+        base = self._base_path(content_hash, size)
+        for path in (base + ".jpg", base + ".png"):
+            if os.path.exists(path):
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+                return path
+        return None
+
+    def get(self, attachment, size=DEFAULT_SIZE):
+        """
+        Get a thumbnail for an image attachment, rendering it if needed
+
+        Runs on the calling thread; use request() from the UI.
+        """
+        content_hash = attachment.get('content_hash') or hash_file(attachment['file_path'])
+        path = self.lookup(content_hash, size)
+        if path is None:
+            path = render_thumbnail(attachment['file_path'], self._base_path(content_hash, size), size)
+            self._account(os.path.getsize(path))
+        return path
+
+    def request(self, attachment, size=DEFAULT_SIZE):
+        """
+        Get a thumbnail on the worker pool
+
+        Returns a Future resolving to the thumbnail path. Concurrent requests
+        for the same attachment and size share one render.
+        """
+        key = (attachment['id'], size)
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="thumbnail")
+            future = self._executor.submit(self.get, attachment, size)
+            self._pending[key] = future
+        future.add_done_callback(lambda _: self._forget(key))
+        return future
+
+    def _forget(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def _scan(self):
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def _account(self, added_bytes):
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._scan()
+            else:
+                self._total_bytes += added_bytes
+            over = self._total_bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def evict(self, target_bytes=None):
+        """Remove least recently used thumbnails until under target_bytes"""
+        if target_bytes is None:
+            # Leave some headroom so eviction does not run on every render
+            target_bytes = int(self.max_bytes * 0.9)
+
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= target_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+        with self._lock:
+            self._total_bytes = total
+        return total
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,442 @@
+import datetime
+import json
+import mimetypes
+import os
+import shutil
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .blob_store import PreparedBlob
+from .revisions import RevisionStore
+
+NOTE_EXTENSIONS = (".txt", ".md", ".markdown")
+ARCHIVE_NOTES = "notes.jsonl"
+ARCHIVE_ATTACHMENTS = "attachments/"
+
+# Notes written per transaction
+BATCH_SIZE = 2000
+# Files parsed per worker task; keeps per-task overhead small for tiny notes
+CHUNK_SIZE = 64
+# Reading and hashing are I/O bound, so more threads than CPUs help
+DEFAULT_WORKERS = min(16, (os.cpu_count() or 1) + 4)
+# Error messages kept in an import result
+MAX_ERRORS = 100
+# Rows fetched at a time while exporting
+FETCH_SIZE = 500
+# Exported lines are buffered up to this size before being compressed
+WRITE_BUFFER_SIZE = 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+
+NOTE_COLUMNS = "id, title, content, created_date, modified_date, metadata, encrypted"
+ATTACHMENT_COLUMNS = "id, note_id, filename, file_path, file_type, created_date, encrypted, content_hash"
+# Exported notes with their attachments, oldest first; {where} narrows it to a page
+EXPORT_SQL = (
+    f"SELECT {NOTE_COLUMNS}, ("
+    "SELECT json_group_array(json_object("
+    "'id', a.id, 'filename', a.filename, 'file_type', a.file_type, 'created_date', a.created_date, "
+    "'encrypted', a.encrypted, 'content_hash', a.content_hash"
+    ")) FROM attachments a WHERE a.note_id = notes.id"
+    ") AS attachments FROM notes {where}ORDER BY created_date, id"
+)
+
+
+def note_title(text, path):
+    """A leading Markdown heading, else the file name without extension"""
+    first_line = text.lstrip("﻿").split("\n", 1)[0].strip()
+    if first_line.startswith("#"):
+        title = first_line.lstrip("#").strip()
+        if title:
+            return title
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def scan_directory(root):
+    """
+    Find note files below root
+
+    A directory next to a note with the same name as the note (without its
+    extension) holds that note's attachments: "trip.md" and "trip/".
+
+    Yields:
+        (note path, attachment directory or None)
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        stems = set()
+        for filename in sorted(filenames):
+            stem, extension = os.path.splitext(filename)
+            if extension.lower() not in NOTE_EXTENSIONS:
+                continue
+            stems.add(stem)
+            attachment_dir = os.path.join(dirpath, stem) if stem in dirnames else None
+            yield os.path.join(dirpath, filename), attachment_dir
+        # Attachment directories are not searched for notes
+        dirnames[:] = [name for name in dirnames if name not in stems]
+
+
+class ParsedNote:
+    """Rows for one note, built on a worker thread and written in a batch"""
+
+    __slots__ = ("note", "revision", "attachments")
+
+    def __init__(self, note, revision, attachments):
+        self.note = note
+        self.revision = revision
+        # (PreparedBlob, attachment row) pairs
+        self.attachments = attachments
+
+
+class NoteImporter:
+    """
+    Imports notes in bulk
+
+    Files are read, parsed, hashed and copied into the blob store on a
+    thread pool; the results are written in batches of batch_size notes,
+    each with a few executemany() calls in one transaction. Only a bounded
+    number of parsed notes is held in memory at any time.
+
+    Args:
+        note_manager: NoteManager of the target database
+        file_handler: FileHandler whose blob store receives attachments
+        workers: Worker threads (default: DEFAULT_WORKERS)
+        batch_size: Notes per transaction
+    """
+
+    def __init__(self, note_manager, file_handler, workers=None, batch_size=BATCH_SIZE):
+        self.note_manager = note_manager
+        self.db = note_manager.db
+        self.blob_store = file_handler.blob_store
+        self.workers = workers or DEFAULT_WORKERS
+        self.batch_size = batch_size
+
+    def import_path(self, path, progress=None):
+        """
+        Import a directory of .txt/.md files, or an archive written by NoteExporter
+
+        Notes from an archive keep their ids; notes that already exist are
+        skipped, so importing the same archive twice is harmless.
+
+        Returns:
+            Dict with the number of imported, skipped and failed notes, of
+            imported attachments, and the first MAX_ERRORS error messages
+        """
+        if os.path.isdir(path):
+            notes = list(scan_directory(path))
+            chunks = (notes[i:i + CHUNK_SIZE] for i in range(0, len(notes), CHUNK_SIZE))
+            return self._run(((self._parse_files, chunk) for chunk in chunks), len(notes), progress)
+
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                with archive.open(ARCHIVE_NOTES) as lines:
+                    chunks = self._chunk_lines(lines)
+                    return self._run(((self._parse_records, chunk, archive) for chunk in chunks), None, progress)
+
+        with open(path, "rb") as lines:
+            return self._run(((self._parse_records, chunk, None) for chunk in self._chunk_lines(lines)),
+                             None, progress)
+
+    @staticmethod
+    def _chunk_lines(lines):
+        chunk = []
+        for line in lines:
+            if line.strip():
+                chunk.append(line)
+            if len(chunk) >= CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    # Worker side
+
+    def _parse_files(self, chunk):
+        return self._parse_chunk(chunk, lambda item: self._parse_file(*item), lambda item: item[0])
+
+    def _parse_records(self, chunk, archive):
+        return self._parse_chunk(
+            chunk, lambda line: self._parse_record(line, archive), lambda line: line[:80].decode("utf-8", "replace")
+        )
+
+    @staticmethod
+    def _parse_chunk(chunk, parse, describe):
+        # A bad file is reported and skipped; the rest of the chunk goes on
+        parsed, errors = [], []
+        for item in chunk:
+            try:
+                parsed.append(parse(item))
+            except (OSError, ValueError, KeyError) as e:
+                errors.append(f"{describe(item)}: {e}")
+        return parsed, errors
+
+    def _parse_file(self, note_path, attachment_dir):
+        with open(note_path, "rb") as f:
+            text = f.read().decode("utf-8-sig", errors="replace")
+        modified = datetime.datetime.fromtimestamp(os.path.getmtime(note_path)).isoformat()
+        note_id = str(uuid.uuid4())
+        title = note_title(text, note_path)
+
+        attachments = []
+        if attachment_dir is not None:
+            for dirpath, dirnames, filenames in os.walk(attachment_dir):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    prepared = self.blob_store.prepare(os.path.join(dirpath, filename))
+                    attachments.append((prepared, (
+                        str(uuid.uuid4()), note_id, filename, self.blob_store.path_for(prepared.content_hash),
+                        mimetypes.guess_type(filename)[0], modified, 0, prepared.content_hash
+                    )))
+
+        return ParsedNote(
+            (note_id, title, self.note_manager.codec.encode(text), modified, modified,
+             json.dumps({'source': os.path.abspath(note_path)}), 0),
+            RevisionStore.initial_revision(note_id, title, text, False, modified),
+            attachments
+        )
+
+    def _parse_record(self, line, archive):
+        record = json.loads(line)
+        metadata = record.get('metadata')
+        metadata_json = json.dumps(metadata) if isinstance(metadata, (dict, list)) else (metadata or "{}")
+        encrypted = 1 if record.get('encrypted') else 0
+        modified = record.get('modified_date') or record['created_date']
+
+        attachments = []
+        if archive is not None:
+            for attachment in record.get('attachments') or ():
+                prepared = self._extract(archive, attachment)
+                if prepared is None:
+                    continue
+                attachments.append((prepared, (
+                    attachment['id'], record['id'], attachment['filename'],
+                    self.blob_store.path_for(prepared.content_hash), attachment.get('file_type'),
+                    attachment['created_date'], 1 if attachment.get('encrypted') else 0, prepared.content_hash
+                )))
+
+        return ParsedNote(
+            (record['id'], record['title'], self.note_manager.codec.encode(record.get('content') or "", encrypted),
+             record['created_date'], modified, metadata_json, encrypted),
+            RevisionStore.initial_revision(record['id'], record['title'], record.get('content'), encrypted, modified),
+            attachments
+        )
+
+    def _extract(self, archive, attachment):
+        content_hash = attachment.get('content_hash')
+        if content_hash and self.blob_store.contains(content_hash):
+            blob_path = self.blob_store.path_for(content_hash)
+            return PreparedBlob(content_hash, os.path.getsize(blob_path), blob_path, owned=True)
+
+        try:
+            member = archive.getinfo(attachment['path'])
+        except KeyError:
+            return None
+        tmp_path = self.blob_store.new_temporary_path()
+        try:
+            with archive.open(member) as src, open(tmp_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return self.blob_store.prepare(tmp_path, move=True)
+
+    # Writer side
+
+    def _run(self, tasks, total, progress):
+        result = {'imported': 0, 'skipped': 0, 'failed': 0, 'attachments': 0, 'errors': []}
+        processed = 0
+        batch = []
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="import") as pool:
+            pending = deque()
+
+            def collect():
+                nonlocal processed, batch
+                parsed, errors = pending.popleft().result()
+                result['failed'] += len(errors)
+                result['errors'].extend(errors[:MAX_ERRORS - len(result['errors'])])
+                batch.extend(parsed)
+                processed += len(parsed)
+                if len(batch) >= self.batch_size:
+                    self._write_batch(batch, result)
+                    batch = []
+                    if progress:
+                        progress(processed, total)
+
+            for task in tasks:
+                pending.append(pool.submit(*task))
+                # Bound the parsed notes waiting in memory
+                if len(pending) >= self.workers * 2:
+                    collect()
+            while pending:
+                collect()
+
+        if batch:
+            self._write_batch(batch, result)
+        if progress:
+            progress(processed, total)
+        return result
+
+    def _write_batch(self, batch, result):
+        try:
+            with self.db.transaction() as conn:
+                # For the notes parsed next; these were encoded with a
+                # dictionary that is at worst retired, so still readable
+                self.note_manager.codec.refresh(conn)
+                ids = [parsed.note[0] for parsed in batch]
+                existing = set()
+                for start in range(0, len(ids), 500):
+                    part = ids[start:start + 500]
+                    rows = conn.execute(
+                        f"SELECT id FROM notes WHERE id IN ({', '.join('?' * len(part))})", part
+                    ).fetchall()
+                    existing.update(row['id'] for row in rows)
+                new = [parsed for parsed in batch if parsed.note[0] not in existing]
+
+                conn.executemany(
+                    f"INSERT OR IGNORE INTO notes ({NOTE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [parsed.note for parsed in new]
+                )
+                self.note_manager.revisions.add_initial_revisions([parsed.revision for parsed in new])
+
+                attachment_rows = []
+                for parsed in new:
+                    for prepared, row in parsed.attachments:
+                        self.blob_store.commit(prepared)
+                        attachment_rows.append(row)
+                conn.executemany(
+                    f"INSERT OR IGNORE INTO attachments ({ATTACHMENT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    attachment_rows
+                )
+        finally:
+            for parsed in batch:
+                for prepared, _ in parsed.attachments:
+                    if not prepared.owned:
+                        self.blob_store.discard(prepared)
+
+        result['imported'] += len(new)
+        result['skipped'] += len(batch) - len(new)
+        result['attachments'] += len(attachment_rows)
+
+
+class NoteExporter:
+    """
+    Streams all notes to a JSONL file or a zip archive
+
+    Notes are read with a cursor, FETCH_SIZE rows at a time, and written as
+    one JSON object per line, so memory use does not grow with the number
+    of notes. A zip archive also holds every distinct attachment file once,
+    copied in chunks; encrypted notes and attachments are exported as they
+    are stored.
+    """
+
+    def __init__(self, note_manager):
+        self.note_manager = note_manager
+        self.db = note_manager.db
+
+    def export(self, destination, progress=None):
+        """
+        Write notes to destination (".jsonl" for notes only, else a zip archive)
+
+        The file is written under a temporary name and renamed when complete.
+
+        Returns:
+            Dict with the number of exported notes and attachment files, and
+            of attachment files that were missing from disk
+        """
+        tmp_path = destination + ".tmp"
+        try:
+            if destination.lower().endswith(".jsonl"):
+                with open(tmp_path, "wb") as out:
+                    result = {'notes': self._write_notes(out, progress), 'attachments': 0, 'missing': 0}
+            else:
+                with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+                    with archive.open(ARCHIVE_NOTES, "w", force_zip64=True) as out:
+                        notes = self._write_notes(out, progress)
+                    attachments, missing = self._write_attachments(archive)
+                    result = {'notes': notes, 'attachments': attachments, 'missing': missing}
+            os.replace(tmp_path, destination)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return result
+
+    def _iter_rows(self, sql):
+        cursor = self.db.connection.execute(sql)
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    def records_after(self, after=None, limit=FETCH_SIZE):
+        """
+        One page of export records, in the order export() writes them
+
+        Args:
+            after: (created_date, id) of the last record of the previous
+                page, or None for the first page
+            limit: Maximum number of records
+
+        Returns:
+            List of dictionaries as written to notes.jsonl
+        """
+        where = ""
+        params = []
+        if after is not None:
+            where = "WHERE created_date >= ? AND (created_date > ? OR id > ?) "
+            params = [after[0], after[0], after[1]]
+        rows = self.db.fetchall(EXPORT_SQL.format(where=where) + " LIMIT ?", params + [limit])
+        return [self._record(row) for row in rows]
+
+    def _record(self, row):
+        record = dict(row)
+        record['content'] = self.note_manager.codec.decode(record['content'])
+        try:
+            record['metadata'] = json.loads(record['metadata']) if record['metadata'] else {}
+        except ValueError:
+            pass
+        record['encrypted'] = bool(record['encrypted'])
+        attachments = json.loads(record['attachments'])
+        for attachment in attachments:
+            attachment['encrypted'] = bool(attachment['encrypted'])
+            attachment['path'] = ARCHIVE_ATTACHMENTS + (attachment['content_hash'] or attachment['id'])
+        record['attachments'] = attachments
+        return record
+
+    def _write_notes(self, out, progress):
+        count = 0
+        buffer = []
+        buffered = 0
+        for row in self._iter_rows(EXPORT_SQL.format(where="")):
+            record = self._record(row)
+
+            line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+            buffer.append(line)
+            buffered += len(line)
+            if buffered >= WRITE_BUFFER_SIZE:
+                out.write(b"".join(buffer))
+                buffer, buffered = [], 0
+
+            count += 1
+            if progress and count % FETCH_SIZE == 0:
+                progress(count, None)
+        out.write(b"".join(buffer))
+        if progress:
+            progress(count, None)
+        return count
+
+    def _write_attachments(self, archive):
+        written = missing = 0
+        rows = self._iter_rows(
+            "SELECT COALESCE(content_hash, id) AS name, MIN(file_path) AS file_path FROM attachments "
+            "GROUP BY COALESCE(content_hash, id)"
+        )
+        for row in rows:
+            if not os.path.exists(row['file_path']):
+                missing += 1
+                continue
+            # Attachment files are mostly compressed already
+            archive.write(row['file_path'], ARCHIVE_ATTACHMENTS + row['name'], compress_type=zipfile.ZIP_STORED)
+            written += 1
+        return written, missing
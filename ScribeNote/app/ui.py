@@ -1,31 +1,76 @@
 import os
+import threading
+import time
 from PyQt5.QtWidgets import (QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
-                            QTextEdit, QListWidget, QPushButton, QFileDialog,
+                            QTextEdit, QListView, QPushButton, QFileDialog,
                             QInputDialog, QMessageBox, QSplitter, QLabel, 
-                            QLineEdit, QComboBox, QToolBar, QAction, QMenu)
-from PyQt5.QtCore import Qt, QSize
-from PyQt5.QtGui import QIcon, QPixmap, QFont
+                            QLineEdit, QComboBox, QToolBar, QAction, QMenu,
+                            QProgressDialog, QProgressBar, QAbstractItemView,
+                            QListWidget, QListWidgetItem)
+from PyQt5.QtCore import Qt, QSize, QTimer, QEvent
+from PyQt5.QtGui import QIcon, QPixmap, QFont, QTextCursor
 
 from .note_manager import NoteManager
 from .encryption import EncryptionHandler
 from .file_handler import FileHandler
+from .note_list_model import NoteListModel
+from .bulk_crypto import BulkCrypto, DECRYPT, REKEY
+from .dialogs import BulkCryptoDialog, RevisionHistoryDialog, InstrumentationDialog
+from .attachment_panel import AttachmentPanel
+from .tasks import TaskExecutor, WRITE, FILES
+from .autosave import AutosaveController
+from .change_watcher import ChangeWatcher
+from .instrumentation import instrumentation, traced
+from .metadata import parse_tags, tags_of
+from .startup import ListSnapshot, SNAPSHOT_NAME, SNAPSHOT_ROWS
+
+# Delay between the last keystroke in the search box and running the query
+SEARCH_DEBOUNCE_MS = 250
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, data_dir=None):
         super().__init__()
         self.setWindowTitle("SecureNotes")
         self.setMinimumSize(1000, 700)
         
-        # Initialize components
-        self.note_manager = NoteManager()
+        # Initialize components (data_dir holds notes.db and attachments/;
+        # by default the application's data directory is used)
+        db_path = os.path.join(data_dir, "notes.db") if data_dir else None
+        storage_dir = os.path.join(data_dir, "attachments") if data_dir else None
         self.encryption_handler = EncryptionHandler()
-        self.file_handler = FileHandler()
+        self.note_manager = NoteManager(db_path, encryption_handler=self.encryption_handler)
+        self.file_handler = FileHandler(storage_dir, db_path, encryption_handler=self.encryption_handler)
+        
+        # Database, crypto and file work runs here instead of on the UI thread
+        self.executor = TaskExecutor(self)
+        
+        # Edits are written in the background once typing pauses
+        self.autosave = AutosaveController(self.note_manager, self.executor, self.autosave_snapshot, parent=self)
+        self.autosave.saved.connect(self.note_autosaved)
+        self.autosave.failed.connect(
+            lambda note_id, error: self.statusBar().showMessage(f"Autosave failed: {str(error)}")
+        )
         
         # Setup UI
         self.setup_ui()
         
-        # Load notes
-        self.load_notes()
+        # Changes made by other windows and processes are applied row by row;
+        # started before the list loads so nothing committed in between is missed
+        self.change_watcher = ChangeWatcher(self.note_manager, self.executor, parent=self)
+        self.change_watcher.notes_changed.connect(self.apply_note_changes)
+        self.change_watcher.attachments_changed.connect(self.apply_attachment_changes)
+        self.change_watcher.reset.connect(self.reload_all)
+        self.change_watcher.start()
+        
+        # Load notes in the background; until the first page is in, the list
+        # shows the rows it had when the app was last closed
+        cache_dir = os.path.join(os.path.dirname(self.file_handler.storage_dir), "cache")
+        self.list_snapshot = ListSnapshot(os.path.join(cache_dir, SNAPSHOT_NAME))
+        self.restore_list_snapshot()
+        self.refresh_tags()
+        
+        # Attachments added since the last run (or by an import) become searchable
+        self.index_attachments()
 
     def setup_ui(self):
         # Main widget and layout
@@ -44,23 +89,48 @@ class MainWindow(QMainWindow):
         # Search box
         self.search_box = QLineEdit()
         self.search_box.setPlaceholderText("Search notes...")
-        self.search_box.textChanged.connect(self.filter_notes)
+        self.search_box.textChanged.connect(self.schedule_search)
         self.left_layout.addWidget(self.search_box)
         
+        # Search runs once typing pauses instead of on every keystroke
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DEBOUNCE_MS)
+        self.search_timer.timeout.connect(lambda: self.filter_notes(self.search_box.text()))
+        
         # Sort options
         self.sort_layout = QHBoxLayout()
         self.sort_label = QLabel("Sort by:")
         self.sort_combo = QComboBox()
-        self.sort_combo.addItems(["Date (newest)", "Date (oldest)", "Title (A-Z)", "Title (Z-A)"])
+        for label, order in (("Date (newest)", "modified_desc"), ("Date (oldest)", "modified_asc"),
+                             ("Title (A-Z)", "title_asc"), ("Title (Z-A)", "title_desc"),
+                             ("Created (newest)", "created_desc"), ("Created (oldest)", "created_asc"),
+                             ("Manual (drag to reorder)", "manual")):
+            self.sort_combo.addItem(label, order)
         self.sort_combo.currentIndexChanged.connect(self.sort_notes)
         self.sort_layout.addWidget(self.sort_label)
         self.sort_layout.addWidget(self.sort_combo)
         self.left_layout.addLayout(self.sort_layout)
         
-        # Note list
-        self.note_list = QListWidget()
+        # Tags with their note counts; choosing one filters the list
+        self.tag_list = QListWidget()
+        self.tag_list.setMaximumHeight(120)
+        self.tag_list.currentItemChanged.connect(self.filter_by_tag)
+        self.left_layout.addWidget(self.tag_list)
+        
+        # Note list (virtualized: rows are fetched page by page as it scrolls)
+        self.note_model = NoteListModel(self.note_manager, parent=self, executor=self.executor)
+        self.note_model.reloaded.connect(self.restore_selection)
+        self.note_list = QListView()
+        self.note_list.setModel(self.note_model)
+        self.note_list.setUniformItemSizes(True)
+        # Rows can only be dragged in the manual order (see NoteListModel.flags)
+        self.note_list.setDragDropMode(QAbstractItemView.InternalMove)
+        self.note_list.setDefaultDropAction(Qt.MoveAction)
         self.note_list.setMinimumWidth(250)
-        self.note_list.currentRowChanged.connect(self.display_note)
+        self.note_list.selectionModel().currentRowChanged.connect(
+            lambda current, previous: self.display_note(current.row())
+        )
         self.left_layout.addWidget(self.note_list)
         
         # Button controls
@@ -86,16 +156,33 @@ class MainWindow(QMainWindow):
         self.title_edit.textChanged.connect(self.update_note_title)
         self.right_layout.addWidget(self.title_edit)
         
+        # Note tags, saved when editing the field is finished
+        self.tags_edit = QLineEdit()
+        self.tags_edit.setPlaceholderText("Tags, separated by commas")
+        self.tags_edit.editingFinished.connect(self.save_tags)
+        self.right_layout.addWidget(self.tags_edit)
+        
         # Note editor
         self.note_editor = QTextEdit()
         self.note_editor.setFontPointSize(12)
         self.note_editor.textChanged.connect(self.update_note_content)
         self.right_layout.addWidget(self.note_editor)
         
+        # Files and folders dropped anywhere on the window are attached; the
+        # editor would otherwise paste their paths
+        self.setAcceptDrops(True)
+        self.note_editor.viewport().installEventFilter(self)
+        
+        # Attachments of the current note, with image previews
+        thumbnail_dir = os.path.join(os.path.dirname(self.file_handler.storage_dir), "cache", "thumbnails")
+        self.attachment_panel = AttachmentPanel(self.file_handler, thumbnail_dir)
+        self.attachment_panel.hide()
+        self.right_layout.addWidget(self.attachment_panel)
+        
         # Attachment and encryption controls
         self.control_layout = QHBoxLayout()
         
-        self.attach_btn = QPushButton("Attach File")
+        self.attach_btn = QPushButton("Attach Files")
         self.attach_btn.clicked.connect(self.attach_file)
         
         self.encrypt_btn = QPushButton("Encrypt Note")
@@ -104,8 +191,12 @@ class MainWindow(QMainWindow):
         self.save_btn = QPushButton("Save Note")
         self.save_btn.clicked.connect(self.save_note)
         
+        self.history_btn = QPushButton("History")
+        self.history_btn.clicked.connect(self.show_history)
+        
         self.control_layout.addWidget(self.attach_btn)
         self.control_layout.addWidget(self.encrypt_btn)
+        self.control_layout.addWidget(self.history_btn)
         self.control_layout.addWidget(self.save_btn)
         self.right_layout.addLayout(self.control_layout)
         
@@ -114,67 +205,234 @@ class MainWindow(QMainWindow):
         self.splitter.addWidget(self.right_panel)
         self.splitter.setSizes([300, 700])
         
-        # Status bar
+        # Toolbar
+        self.toolbar = QToolBar("Main")
+        self.addToolBar(self.toolbar)
+        
+        self.lock_action = QAction("Lock", self)
+        self.lock_action.setToolTip("Forget all cached encryption keys")
+        self.lock_action.triggered.connect(self.lock_session)
+        self.toolbar.addAction(self.lock_action)
+        
+        self.bulk_crypto_action = QAction("Bulk Encryption...", self)
+        self.bulk_crypto_action.setToolTip("Encrypt, decrypt or change the password of many notes")
+        self.bulk_crypto_action.triggered.connect(self.bulk_encryption)
+        self.toolbar.addAction(self.bulk_crypto_action)
+        
+        # Debug panel with timings and slow operations; not on the toolbar
+        self.instrumentation_action = QAction("Performance...", self)
+        self.instrumentation_action.setShortcut("Ctrl+Shift+D")
+        self.instrumentation_action.triggered.connect(self.show_instrumentation)
+        self.addAction(self.instrumentation_action)
+        
+        # Status bar, with an indicator shown while background work runs
+        self.busy_indicator = QProgressBar()
+        self.busy_indicator.setRange(0, 0)
+        self.busy_indicator.setMaximumWidth(120)
+        self.busy_indicator.hide()
+        self.statusBar().addPermanentWidget(self.busy_indicator)
+        self.executor.busy_changed.connect(self.busy_indicator.setVisible)
         self.statusBar().showMessage("Ready")
         
         # Current note tracking
         self.current_note_id = None
         self.is_encrypted = False
+        # Whether the current note is stored encrypted (is_encrypted is the editor state)
+        self.current_note_encrypted = False
+        self.current_tags = []
+        # Note to select once the list has been (re)loaded in the background
+        self._pending_selection = None
+        # When the note being loaded was selected, for the ui.display_note timing
+        self._display_started = None
+        # Cancel flags of attachment copying and indexing still running
+        self._attach_stops = set()
 
-    def load_notes(self):
-        notes = self.note_manager.get_all_notes()
-        self.note_list.clear()
-        for note in notes:
-            self.note_list.addItem(note['title'])
-        
-        if self.note_list.count() > 0:
-            self.note_list.setCurrentRow(0)
+    def closeEvent(self, event):
+        # Save pending edits and let queued saves finish before the window goes away
+        self.change_watcher.stop()
+        for stop in self._attach_stops:
+            stop.set()
+        self.autosave.flush()
+        self.executor.wait()
+        self.attachment_panel.shutdown()
+        self.save_list_snapshot()
+        super().closeEvent(event)
+    
+    def restore_list_snapshot(self):
+        """Show the list as it was saved on close, and load the real first page"""
+        snapshot = self.list_snapshot.load()
+        if snapshot is None:
+            self.load_notes()
+            return
+        
+        order = self.sort_combo.itemData(0)
+        index = self.sort_combo.findData(snapshot.get('order'))
+        if index >= 0:
+            order = snapshot['order']
+            self.sort_combo.blockSignals(True)
+            self.sort_combo.setCurrentIndex(index)
+            self.sort_combo.blockSignals(False)
+        
+        self._pending_selection = snapshot.get('selected_id')
+        self.note_model.show_snapshot(snapshot.get('rows') or [], order, snapshot.get('filters'))
+        row = self.note_model.row_for_id(self._pending_selection)
+        if row >= 0:
+            # Only highlighted; the note is loaded once the real rows are in
+            selection_model = self.note_list.selectionModel()
+            selection_model.blockSignals(True)
+            self.select_row(row)
+            selection_model.blockSignals(False)
+    
+    def save_list_snapshot(self):
+        model = self.note_model
+        # Search results are not the list; only its order and filter are kept
+        rows = [] if model.search_text else model.loaded_rows(SNAPSHOT_ROWS)
+        try:
+            self.list_snapshot.save(rows, model.order, model.filters, self.current_note_id)
+        except OSError:
+            # The snapshot only speeds up the next start
+            pass
+    
+    def load_notes(self, select_note_id=None):
+        """Reload the list; restore_selection() runs once the first page is in"""
+        self._pending_selection = select_note_id
+        self.note_model.reload()
+        
+    def restore_selection(self):
+        note_id, self._pending_selection = self._pending_selection, None
+        if note_id and self.select_note(note_id):
+            return
+        if self.note_model.rowCount() > 0:
+            self.select_row(0)
         else:
             self.clear_editor()
     
+    def select_row(self, row):
+        self.note_list.setCurrentIndex(self.note_model.index(row))
+    
+    def select_note(self, note_id):
+        """Select a note in the list if it is loaded, returning whether it was"""
+        row = self.note_model.row_for_id(note_id)
+        if row >= 0:
+            self.select_row(row)
+            return True
+        return False
+    
+    def selected_note_id(self):
+        return self.note_model.note_id(self.note_list.currentIndex().row())
+    
+    def show_error(self, title, message):
+        return lambda error: QMessageBox.critical(self, title, f"{message}: {str(error)}")
+    
     def display_note(self, row):
+        # Save edits of the note being left before its editor is replaced
+        self.autosave.flush()
+        
         if row < 0:
+            self.executor.cancel("display")
             self.clear_editor()
             return
             
-        notes = self.note_manager.get_all_notes()
-        if row < len(notes):
-            note = notes[row]
-            self.current_note_id = note['id']
+        # Only the selected note's body is loaded, by id, off the UI thread;
+        # quickly moving through the list only loads the note it stops at
+        note_id = self.note_model.note_id(row)
+        if note_id and self.note_model.showing_snapshot:
+            # Picked from the snapshot rows; keep it selected once they are replaced
+            self._pending_selection = note_id
+        if note_id:
+            self._display_started = time.perf_counter()
+            self.executor.submit(
+                self._load_note, note_id,
+                on_result=self.show_loaded_note,
+                on_error=self.show_error("Error", "Could not load note"),
+                key="display"
+            )
             
-            self.title_edit.setText(note['title'])
+    def _load_note(self, note_id):
+        # Worker thread
+        note = self.note_manager.get_note(note_id)
+        attachments = self.note_manager.get_attachments(note_id) if note else []
+        return note, attachments
             
-            content = note['content']
-            if note.get('encrypted', False):
-                self.is_encrypted = True
-                self.encrypt_btn.setText("Decrypt Note")
-                self.note_editor.setReadOnly(True)
-                self.note_editor.setText("[Encrypted Note - Click 'Decrypt Note' to view]")
-            else:
-                self.is_encrypted = False
-                self.encrypt_btn.setText("Encrypt Note")
-                self.note_editor.setReadOnly(False)
-                self.note_editor.setText(content)
+    @traced("ui.show_note", "ui")
+    def show_loaded_note(self, loaded):
+        note, attachments = loaded
+        if not note or note['id'] != self.selected_note_id():
+            return
+            
+        self.current_note_id = note['id']
+        self.current_note_encrypted = bool(note['encrypted'])
             
-            self.statusBar().showMessage(f"Note last modified: {note['modified_date']}")
+        self.title_edit.setText(note['title'])
+        self.current_tags = tags_of(note['metadata'])
+        self.tags_edit.setText(", ".join(self.current_tags))
+        
+        content = note['content']
+        if note.get('encrypted', False):
+            self.is_encrypted = True
+            self.encrypt_btn.setText("Decrypt Note")
+            self.note_editor.setReadOnly(True)
+            self.note_editor.setText("[Encrypted Note - Click 'Decrypt Note' to view]")
+        else:
+            self.is_encrypted = False
+            self.encrypt_btn.setText("Encrypt Note")
+            self.note_editor.setReadOnly(False)
+            self.note_editor.setText(content)
+        
+        # Loading the note is not an edit
+        if self.current_note_encrypted:
+            self.autosave.cancel()
+        else:
+            self.autosave.track(note['id'], note['title'], content)
+        
+        self.attachment_panel.show_note(note['id'], attachments)
+        
+        self.statusBar().showMessage(f"Note last modified: {note['modified_date']}")
+        
+        # Time from selecting the note to seeing it, including the queue
+        if instrumentation.enabled and self._display_started is not None:
+            instrumentation.record("ui.display_note", "ui", self._display_started,
+                                   time.perf_counter() - self._display_started, {'note_id': note['id']})
+        self._display_started = None
     
     def clear_editor(self):
         self.current_note_id = None
+        self.current_note_encrypted = False
+        self.autosave.cancel()
+        self.attachment_panel.show_note(None, [])
         self.title_edit.clear()
+        self.current_tags = []
+        self.tags_edit.clear()
         self.note_editor.clear()
         self.encrypt_btn.setText("Encrypt Note")
         self.note_editor.setReadOnly(False)
         self.is_encrypted = False
     
     def create_new_note(self):
-        note_id = self.note_manager.create_note("New Note", "")
-        self.load_notes()
+        # A note created while a tag is chosen gets that tag, so it stays listed
+        self.executor.submit(
+            self._create_note, self.selected_tag(),
+            on_result=self._note_created,
+            on_error=self.show_error("Error", "Could not create note"),
+            lane=WRITE
+        )
+    
+    def _create_note(self, tag):
+        # Worker thread
+        note_id = self.note_manager.create_note("New Note", "", {'tags': [tag]} if tag else None)
+        return note_id, self.note_manager.get_note_summary(note_id)
+    
+    def _note_created(self, created):
+        note_id, summary = created
+        self.refresh_tags()
         
-        # Find and select the new note
-        for i in range(self.note_list.count()):
-            if self.note_manager.get_note(note_id)['title'] == self.note_list.item(i).text():
-                self.note_list.setCurrentRow(i)
-                break
+        # Clear any search so the new note is visible, then select it
+        if self.note_model.search_text:
+            self.search_box.clear()
+            self.filter_notes("", select_note_id=note_id)
+            return
+        self.note_model.refresh_note(note_id, summary)
+        self.select_note(note_id)
     
     def delete_note(self):
         if self.current_note_id is None:
@@ -189,16 +447,48 @@ class MainWindow(QMainWindow):
         )
         
         if reply == QMessageBox.Yes:
-            self.note_manager.delete_note(self.current_note_id)
-            self.load_notes()
+            note_id = self.current_note_id
+            self.autosave.cancel()
+            self.autosave.forget(note_id)
+            self.executor.submit(
+                self._delete_note, note_id,
+                on_result=lambda _: self._note_deleted(note_id),
+                on_error=self.show_error("Error", "Could not delete note"),
+                lane=WRITE
+            )
+            
+    def _delete_note(self, note_id):
+        # Worker thread
+        self.note_manager.delete_note(note_id)
+        self.file_handler.collect_garbage()
+    
+    def _note_deleted(self, note_id):
+        self.refresh_tags()
+        row = self.note_model.row_for_id(note_id)
+        was_current = note_id == self.selected_note_id()
+        self.note_model.remove_note(note_id)
+        if not was_current:
+            return
+        
+        if self.note_model.rowCount() > 0:
+            self.select_row(min(max(row, 0), self.note_model.rowCount() - 1))
+        else:
+            self.clear_editor()
     
     def save_note(self):
         if self.current_note_id is None:
             return
             
+        # Plaintext notes are saved like autosave does: only what changed, if anything
+        if not self.is_encrypted and not self.current_note_encrypted:
+            if not self.autosave.flush():
+                self.statusBar().showMessage("No changes to save")
+            return
+        
         title = self.title_edit.text()
         content = self.note_editor.toPlainText()
         
+        password = None
         if self.is_encrypted:
             password, ok = QInputDialog.getText(
                 self, 
@@ -206,46 +496,188 @@ class MainWindow(QMainWindow):
                 "Enter encryption password:",
                 QLineEdit.Password
             )
-            if ok and password:
-                try:
-                    content = self.encryption_handler.encrypt(content, password)
-                    self.note_manager.update_note(
-                        self.current_note_id, 
-                        title, 
-                        content, 
-                        encrypted=True
-                    )
-                    QMessageBox.information(self, "Success", "Note encrypted successfully!")
-                    self.load_notes()
-                except Exception as e:
-                    QMessageBox.critical(self, "Encryption Error", f"Could not encrypt note: {str(e)}")
+            if not ok or not password:
+                return
+                    
+        note_id = self.current_note_id
+        self.autosave.cancel()
+        if password:
+            on_error = self.show_error("Encryption Error", "Could not encrypt note")
+        else:
+            on_error = self.show_error("Error", "Could not save note")
+        
+        # Saves run one at a time, in order, on the write lane
+        self.executor.submit(
+            self._save_note, note_id, title, content, password,
+            on_result=lambda summary: self._note_saved(note_id, title, content, summary, encrypted=bool(password)),
+            on_error=on_error,
+            lane=WRITE
+        )
+    
+    def _save_note(self, note_id, title, content, password):
+        # Worker thread
+        if password:
+            # Re-use the note's salt so its cached key is reused too
+            note = self.note_manager.get_note(note_id)
+            salt = self.encryption_handler.salt_of(note['content']) if note and note['encrypted'] else None
+            content = self.encryption_handler.encrypt(content, password, salt=salt)
+            # Searches now include the notes under this password (if the blind index is on)
+            self.note_manager.blind_index.unlock(password)
+        self.note_manager.update_note(note_id, title, content, encrypted=bool(password), password=password or None)
+        return self.note_manager.get_note_summary(note_id)
+    
+    def _note_saved(self, note_id, title, content, summary, encrypted):
+        if encrypted:
+            self.autosave.forget(note_id)
+        else:
+            self.autosave.mark_saved(note_id, title, content)
+        
+        if note_id != self.current_note_id:
+            # The user moved on; only the list needs updating
+            self.note_model.refresh_note(note_id, summary)
+            return
+        
+        self.current_note_encrypted = encrypted
+        if encrypted:
+            QMessageBox.information(self, "Success", "Note encrypted successfully!")
+            self.refresh_current_note(summary)
+        
+            # Show the encrypted placeholder again
+            self.display_note(self.note_model.row_for_id(self.current_note_id))
         else:
-            self.note_manager.update_note(
-                self.current_note_id,
-                title,
-                content,
-                encrypted=False
-            )
             self.statusBar().showMessage("Note saved successfully")
+            self.refresh_current_note(summary)
+    
+    def note_autosaved(self, note_id, summary):
+        # Only the saved note's row is updated; the list is not reloaded
+        self.note_model.refresh_note(note_id, summary)
+        if note_id == self.current_note_id:
+            self.statusBar().showMessage("Note saved successfully")
+    
+    def autosave_snapshot(self):
+        """The edited note for autosave, or None if it must be saved with a password"""
+        if self.current_note_id is None or self.is_encrypted or self.current_note_encrypted:
+            return None
+        return self.current_note_id, self.title_edit.text(), self.note_editor.toPlainText()
+    
+    def refresh_current_note(self, summary=None):
+        """Update the saved note's row in place instead of reloading the list"""
+        note_id = self.current_note_id
+        self.note_model.refresh_note(note_id, summary)
+        if not self.select_note(note_id):
             self.load_notes()
     
+    def apply_note_changes(self, summaries):
+        """Apply notes changed elsewhere (see ChangeWatcher) to the list and the editor"""
+        if self.note_model.showing_snapshot:
+            # The first page may have been read before these changes
+            self.load_notes(self._pending_selection)
+            return
+        
+        for note_id, summary in summaries.items():
+            if summary is not None:
+                self.note_model.refresh_note(note_id, summary)
+            elif note_id == self.selected_note_id():
+                self.autosave.forget(note_id)
+                self._note_deleted(note_id)
+            else:
+                self.note_model.remove_note(note_id)
+        self.refresh_tags()
+        
+        note_id = self.current_note_id
+        if summaries.get(note_id) is not None and not self.autosave.dirty:
+            self.executor.submit(
+                self._load_note, note_id,
+                on_result=self._current_note_changed,
+                key="display"
+            )
+    
+    def _current_note_changed(self, loaded):
+        note, attachments = loaded
+        if not note or note['id'] != self.current_note_id or self.autosave.dirty:
+            return
+        
+        unchanged = bool(note['encrypted']) == self.current_note_encrypted and (
+            # Our own save coming back, or a decrypted note being read
+            self.autosave.is_saved(note['id'], note['title'], note['content'])
+            or (self.current_note_encrypted and not self.is_encrypted)
+        )
+        if not unchanged:
+            self.show_loaded_note(loaded)
+            return
+        
+        tags = tags_of(note['metadata'])
+        if tags != self.current_tags:
+            self.current_tags = tags
+            self.tags_edit.setText(", ".join(tags))
+    
+    def apply_attachment_changes(self, note_ids):
+        note_id = self.current_note_id
+        if note_id not in note_ids:
+            return
+        self.executor.submit(
+            self.note_manager.get_attachments, note_id,
+            on_result=lambda attachments: self._attachments_changed(note_id, attachments),
+            key="attachments-changed"
+        )
+    
+    def _attachments_changed(self, note_id, attachments):
+        if note_id == self.current_note_id:
+            self.attachment_panel.show_note(note_id, attachments)
+    
+    def reload_all(self):
+        """Reload the list and tag counts, e.g. after changes too many to apply one by one"""
+        self.load_notes(self.current_note_id)
+        self.refresh_tags()
+    
     def update_note_title(self):
         if self.current_note_id is not None:
-            current_row = self.note_list.currentRow()
+            current_row = self.note_model.row_for_id(self.current_note_id)
             if current_row >= 0:
-                self.note_list.item(current_row).setText(self.title_edit.text())
+                self.note_model.set_title(current_row, self.title_edit.text())
+            self.autosave.note_changed()
     
     def update_note_content(self):
-        # This will be used for auto-save functionality if implemented
-        pass
+        if self.current_note_id is not None:
+            self.autosave.note_changed()
+    
+    def show_history(self):
+        if self.current_note_id is None:
+            return
+        
+        # Record pending edits first so they show up as the latest revision
+        self.autosave.flush()
+        
+        password = None
+        if self.current_note_encrypted:
+            password, ok = QInputDialog.getText(
+                self,
+                "Decryption Password",
+                "Enter the note's password to view its history:",
+                QLineEdit.Password
+            )
+            if not ok or not password:
+                return
+        
+        dialog = RevisionHistoryDialog(
+            self.note_manager.revisions, self.current_note_id, self.executor, password=password, parent=self
+        )
+        if dialog.exec_() != RevisionHistoryDialog.Accepted:
+            return
+        
+        revision = dialog.restored_revision()
+        if revision is not None:
+            # Restoring is an edit like any other: autosaved, or saved with the password
+            self.title_edit.setText(revision['title'])
+            self.note_editor.setReadOnly(False)
+            self.note_editor.setText(revision['content'])
+            self.statusBar().showMessage(f"Restored revision {revision['revision']}")
     
     def toggle_encryption(self):
         if self.current_note_id is None:
             return
             
-        note = self.note_manager.get_note(self.current_note_id)
-        
-        if note.get('encrypted', False):
+        if self.current_note_encrypted:
             # Decrypt the note
             password, ok = QInputDialog.getText(
                 self, 
@@ -254,16 +686,17 @@ class MainWindow(QMainWindow):
                 QLineEdit.Password
             )
             if ok and password:
-                try:
-                    decrypted_content = self.encryption_handler.decrypt(note['content'], password)
-                    self.note_editor.setText(decrypted_content)
-                    self.note_editor.setReadOnly(False)
-                    self.encrypt_btn.setText("Encrypt Note")
-                    self.is_encrypted = False
-                except Exception as e:
-                    QMessageBox.critical(self, "Decryption Error", f"Incorrect password or corrupted data: {str(e)}")
+                note_id = self.current_note_id
+                self.executor.submit(
+                    self._decrypt_note, note_id, password,
+                    on_result=lambda content: self._note_decrypted(note_id, content),
+                    on_error=self.show_error("Decryption Error", "Incorrect password or corrupted data"),
+                    key="decrypt"
+                )
         else:
-            # Mark for encryption (actual encryption happens on save)
+            # Mark for encryption (actual encryption happens on save); edits
+            # made so far are saved first, as autosave stops for the note now
+            self.autosave.flush()
             self.is_encrypted = True
             self.encrypt_btn.setText("Decrypt Note")
             QMessageBox.information(
@@ -272,63 +705,378 @@ class MainWindow(QMainWindow):
                 "Note marked for encryption. Click 'Save Note' to encrypt with a password."
             )
     
+    def _decrypt_note(self, note_id, password):
+        # Worker thread
+        note = self.note_manager.get_note(note_id)
+        if note is None:
+            raise ValueError("Note no longer exists")
+        content = self.encryption_handler.decrypt(note['content'], password)
+        self.note_manager.blind_index.unlock(password)
+        return content
+    
+    def _note_decrypted(self, note_id, content):
+        if note_id != self.current_note_id:
+            return
+        self.note_editor.setText(content)
+        self.note_editor.setReadOnly(False)
+        self.encrypt_btn.setText("Encrypt Note")
+        self.is_encrypted = False
+    
+    def lock_session(self):
+        self.encryption_handler.lock()
+        self.note_manager.blind_index.lock()
+        self.executor.cancel("decrypt")
+        
+        # Search results can no longer include encrypted notes
+        if self.note_model.search_text:
+            self.load_notes(self.current_note_id)
+        
+        # Hide a decrypted note again
+        if self.current_note_id is not None and self.current_note_encrypted:
+            self.display_note(self.note_model.row_for_id(self.current_note_id))
+        
+        self.statusBar().showMessage("Session locked")
+    
+    def show_instrumentation(self):
+        dialog = InstrumentationDialog(self)
+        dialog.setAttribute(Qt.WA_DeleteOnClose)
+        dialog.show()
+    
+    def bulk_encryption(self):
+        bulk = BulkCrypto(self.note_manager)
+        
+        # Offer to finish an interrupted job before starting a new one
+        unfinished = bulk.get_unfinished_jobs()
+        if unfinished:
+            job = unfinished[-1]
+            reply = QMessageBox.question(
+                self,
+                "Resume Bulk Encryption",
+                f"A bulk '{job['operation']}' job stopped with {job['pending']} of {job['total']} notes "
+                "remaining. Resume it?",
+                QMessageBox.Yes | QMessageBox.No,
+                QMessageBox.Yes
+            )
+            if reply == QMessageBox.Yes:
+                password, ok = QInputDialog.getText(self, "Resume", "Enter password:", QLineEdit.Password)
+                if not ok or not password:
+                    return
+                new_password = None
+                if job['operation'] == REKEY:
+                    new_password, ok = QInputDialog.getText(self, "Resume", "Enter new password:", QLineEdit.Password)
+                    if not ok or not new_password:
+                        return
+                self.run_bulk_crypto(lambda progress, cancelled: bulk.resume(
+                    job['id'], password, new_password, progress=progress, cancelled=cancelled
+                ))
+                return
+        
+        dialog = BulkCryptoDialog(self, has_current_note=self.current_note_id is not None)
+        if dialog.exec_() != BulkCryptoDialog.Accepted:
+            return
+        
+        operation = dialog.operation()
+        password, new_password = dialog.passwords()
+        tag = dialog.tag() if dialog.scope() == BulkCryptoDialog.SCOPE_TAG else None
+        note_ids = [self.current_note_id] if dialog.scope() == BulkCryptoDialog.SCOPE_CURRENT else None
+        
+        def run(progress, cancelled):
+            job = bulk.run(operation, password, new_password, tag=tag, note_ids=note_ids,
+                           progress=progress, cancelled=cancelled)
+            if operation != DECRYPT:
+                self.note_manager.blind_index.unlock(new_password or password)
+            return job
+        self.run_bulk_crypto(run)
+    
+    def run_bulk_crypto(self, run):
+        progress_dialog = QProgressDialog("Processing notes...", "Cancel", 0, 0, self)
+        progress_dialog.setWindowTitle("Bulk Encryption")
+        progress_dialog.setWindowModality(Qt.WindowModal)
+        progress_dialog.setAutoClose(False)
+        progress_dialog.setAutoReset(False)
+        progress_dialog.setMinimumDuration(0)
+        
+        # Cancelling stops the job between batches; the job still reports back
+        stop = threading.Event()
+        progress_dialog.canceled.connect(stop.set)
+    
+        def update_progress(value):
+            processed, total = value
+            progress_dialog.setMaximum(total)
+            progress_dialog.setValue(processed)
+        
+        def finished(job):
+            progress_dialog.close()
+            self.load_notes(self.current_note_id)
+            summary = f"{job['done']} notes changed, {job['skipped']} skipped, {job['failed']} failed."
+            if job['pending']:
+                summary += f" {job['pending']} notes remaining; run Bulk Encryption again to resume."
+            QMessageBox.information(self, "Bulk Encryption", summary)
+        
+        def failed(error):
+            progress_dialog.close()
+            QMessageBox.critical(self, "Bulk Encryption", f"Bulk operation failed: {str(error)}")
+        
+        self.executor.submit(
+            lambda task: run(lambda processed, total: task.report_progress((processed, total)), stop.is_set),
+            on_result=finished,
+            on_error=failed,
+            on_progress=update_progress,
+            lane=WRITE,
+            pass_task=True
+        )
+        progress_dialog.show()
+    
     def attach_file(self):
         if self.current_note_id is None:
             return
             
-        file_path, _ = QFileDialog.getOpenFileName(
+        file_paths, _ = QFileDialog.getOpenFileNames(
             self,
-            "Attach File",
+            "Attach Files",
             "",
             "All Files (*)"
         )
         
-        if file_path:
-            try:
-                attachment_info = self.file_handler.attach_file(self.current_note_id, file_path)
-                current_text = self.note_editor.toPlainText()
-                
-                # Add attachment reference to note
-                attachment_text = f"\n[Attachment: {os.path.basename(file_path)}]\n"
+        if file_paths:
+            self.attach_paths(file_paths)
+    
+    def attach_paths(self, paths):
+        """Attach files and folders to the current note in the background, with progress"""
+        if self.current_note_id is None:
+            return
+        
+        # Attachments of encrypted notes are encrypted at rest as well
+        password = None
+        if self.is_encrypted:
+            password, ok = QInputDialog.getText(
+                self,
+                "Encryption Password",
+                "Enter the note's password to encrypt the attachments:",
+                QLineEdit.Password
+            )
+            if not ok or not password:
+                return
+        
+        progress_dialog = QProgressDialog("Attaching files...", "Cancel", 0, 100, self)
+        progress_dialog.setWindowTitle("Attach Files")
+        progress_dialog.setAutoClose(False)
+        progress_dialog.setAutoReset(False)
+        # Not shown at all for a few small files
+        progress_dialog.setMinimumDuration(500)
+        
+        # Cancelling stops copying; nothing is attached then
+        stop = threading.Event()
+        progress_dialog.canceled.connect(stop.set)
+        self._attach_stops.add(stop)
+        
+        def update_progress(value):
+            file_path, files_done, files_total, bytes_done, bytes_total = value
+            progress_dialog.setLabelText(
+                f"Attached {files_done} of {files_total} files "
+                f"({bytes_done / 1e6:.1f} of {bytes_total / 1e6:.1f} MB)\n{os.path.basename(file_path)}"
+            )
+            progress_dialog.setValue(bytes_done * 100 // bytes_total if bytes_total else files_done * 100 // files_total)
+        
+        def finished(attached):
+            self._attach_stops.discard(stop)
+            progress_dialog.close()
+            self._files_attached(note_id, *attached)
+            self.index_attachments()
+        
+        def failed(error):
+            self._attach_stops.discard(stop)
+            progress_dialog.close()
+            QMessageBox.critical(self, "Error", f"Could not attach files: {str(error)}")
+        
+        # Hashing, copying and encrypting the files happen off the UI thread,
+        # in a lane of their own so saves do not wait for the copies
+        note_id = self.current_note_id
+        self.executor.submit(
+            self._attach_files, note_id, paths, password, stop,
+            on_result=finished,
+            on_error=failed,
+            on_progress=update_progress,
+            lane=FILES,
+            pass_task=True
+        )
                 
-                if current_text:
-                    self.note_editor.setText(current_text + attachment_text)
-                else:
-                    self.note_editor.setText(attachment_text)
+    def _attach_files(self, note_id, paths, password, stop, task):
+        # Worker thread
+        result = self.file_handler.attach_files(
+            note_id, paths, password=password,
+            progress=lambda *value: task.report_progress(value),
+            cancelled=stop.is_set
+        )
+        return result, self.note_manager.get_attachments(note_id)
                 
-                QMessageBox.information(self, "Success", "File attached successfully!")
-            except Exception as e:
-                QMessageBox.critical(self, "Error", f"Could not attach file: {str(e)}")
+    def _files_attached(self, note_id, result, attachments):
+        if result['cancelled']:
+            self.statusBar().showMessage("Attaching cancelled; no files were attached")
+            return
+        
+        attached = result['attachments']
+        if attached and note_id == self.current_note_id:
+            # Add attachment references at the end of the note, as one edit
+            cursor = QTextCursor(self.note_editor.document())
+            cursor.movePosition(QTextCursor.End)
+            cursor.insertText("".join(f"\n[Attachment: {attachment['filename']}]\n" for attachment in attached))
+        
+            self.attachment_panel.show_note(note_id, attachments)
+        
+        if result['failed']:
+            errors = "\n".join(result['errors'][:10])
+            QMessageBox.warning(
+                self, "Attach Files",
+                f"{len(attached)} files attached, {result['failed']} could not be read:\n{errors}"
+            )
+        elif len(attached) == 1:
+            QMessageBox.information(self, "Success", "File attached successfully!")
+        else:
+            QMessageBox.information(self, "Success", f"{len(attached)} files attached successfully!")
+    
+    def index_attachments(self):
+        """Extract and index the text of attachments not indexed yet, in the background"""
+        stop = threading.Event()
+        self._attach_stops.add(stop)
+        
+        def finished(indexed):
+            self._attach_stops.discard(stop)
+            if indexed and self.note_model.search_text:
+                # Notes may now also be found by their attachments
+                self.note_model.reload()
+        
+        self.executor.submit(
+            self.note_manager.attachment_text.index_pending,
+            cancelled=stop.is_set,
+            on_result=finished,
+            on_error=lambda error: self._attach_stops.discard(stop),
+            lane=FILES
+        )
+    
+    def _dragged_paths(self, event):
+        """Local files and folders being dragged, if there is a note to attach them to"""
+        mime_data = event.mimeData()
+        if self.current_note_id is None or not mime_data.hasUrls():
+            return []
+        return [url.toLocalFile() for url in mime_data.urls() if url.isLocalFile()]
     
-    def filter_notes(self, search_text):
-        for i in range(self.note_list.count()):
-            item = self.note_list.item(i)
-            item.setHidden(search_text.lower() not in item.text().lower())
+    def _file_drop(self, event):
+        """Accept a drag of files and attach them when dropped; returns whether it was one"""
+        paths = self._dragged_paths(event)
+        if not paths:
+            return False
+        event.acceptProposedAction()
+        if event.type() == QEvent.Drop:
+            self.attach_paths(paths)
+        return True
     
+    def dragEnterEvent(self, event):
+        if not self._file_drop(event):
+            super().dragEnterEvent(event)
+    
+    def dragMoveEvent(self, event):
+        if not self._file_drop(event):
+            super().dragMoveEvent(event)
+    
+    def dropEvent(self, event):
+        if not self._file_drop(event):
+            super().dropEvent(event)
+    
+    def eventFilter(self, watched, event):
+        if (event.type() in (QEvent.DragEnter, QEvent.DragMove, QEvent.Drop)
+                and watched is self.note_editor.viewport()
+                and self._file_drop(event)):
+            return True
+        return super().eventFilter(watched, event)
+    
+    def save_tags(self):
+        if self.current_note_id is None:
+            return
+        tags = parse_tags(self.tags_edit.text())
+        if tags == self.current_tags:
+            return
+        self.current_tags = tags
+        self.executor.submit(
+            self._save_tags, self.current_note_id, tags,
+            on_result=self._tags_saved,
+            on_error=self.show_error("Error", "Could not save tags"),
+            lane=WRITE
+        )
+    
+    def _save_tags(self, note_id, tags):
+        # Worker thread
+        self.note_manager.set_tags(note_id, tags)
+        return note_id, self.note_manager.get_note_summary(note_id)
+    
+    def _tags_saved(self, saved):
+        note_id, summary = saved
+        # Drops the note from the list if it no longer has the chosen tag
+        self.note_model.refresh_note(note_id, summary)
+        self.refresh_tags()
+    
+    def refresh_tags(self):
+        """Recount notes per tag in the background and update the tag list"""
+        self.executor.submit(
+            self._load_tags,
+            on_result=self.show_tags,
+            key="tags"
+        )
+    
+    def _load_tags(self):
+        # Worker thread
+        return self.note_manager.count_notes(), self.note_manager.tag_counts()
+    
+    def show_tags(self, loaded):
+        total, counts = loaded
+        # The list's filter, which may have been restored from the snapshot
+        selected = ((self.note_model.filters or {}).get('tags') or [None])[0]
+        
+        self.tag_list.blockSignals(True)
+        self.tag_list.clear()
+        item = QListWidgetItem(f"All notes ({total})")
+        item.setData(Qt.UserRole, None)
+        self.tag_list.addItem(item)
+        current_row = 0 if selected is None else None
+        for tag, count in counts:
+            item = QListWidgetItem(f"{tag} ({count})")
+            item.setData(Qt.UserRole, tag)
+            self.tag_list.addItem(item)
+            if tag == selected:
+                current_row = self.tag_list.count() - 1
+        if current_row is not None:
+            self.tag_list.setCurrentRow(current_row)
+        self.tag_list.blockSignals(False)
+        
+        if current_row is None:
+            # The chosen tag is gone; show all notes again
+            self.tag_list.setCurrentRow(0)
+    
+    def selected_tag(self):
+        item = self.tag_list.currentItem()
+        return item.data(Qt.UserRole) if item is not None else None
+    
+    def filter_by_tag(self, current, previous=None):
+        tag = current.data(Qt.UserRole) if current is not None else None
+        self._pending_selection = self.current_note_id
+        if not self.note_model.set_filters({'tags': [tag]} if tag else None):
+            self._pending_selection = None
+    
+    def schedule_search(self, search_text):
+        self.search_timer.start()
+    
+    def filter_notes(self, search_text, select_note_id=None):
+        # The model shows ranked full-text results (with snippets as tooltips)
+        if search_text.strip() == self.note_model.search_text:
+            return
+        
+        # Reselect the current note if it is among the results, else the first row
+        self._pending_selection = select_note_id or self.current_note_id
+        self.note_model.set_search(search_text)
+        
     def sort_notes(self, index):
-        current_note_id = self.current_note_id
-        notes = self.note_manager.get_all_notes()
-        
-        # Sort based on selection
-        if index == 0:  # Date (newest)
-            notes.sort(key=lambda x: x['modified_date'], reverse=True)
-        elif index == 1:  # Date (oldest)
-            notes.sort(key=lambda x: x['modified_date'])
-        elif index == 2:  # Title (A-Z)
-            notes.sort(key=lambda x: x['title'].lower())
-        elif index == 3:  # Title (Z-A)
-            notes.sort(key=lambda x: x['title'].lower(), reverse=True)
-        
-        # Update the note manager
-        self.note_manager.sort_notes(notes)
-        
-        # Reload the list
-        self.load_notes()
-        
-        # Try to reselect the previously selected note
-        if current_note_id:
-            for i in range(self.note_list.count()):
-                note = self.note_manager.get_note_by_index(i)
-                if note and note['id'] == current_note_id:
-                    self.note_list.setCurrentRow(i)
-                    break
+        # One indexed query in the new order, reselecting the current note
+        self._pending_selection = self.current_note_id
+        if not self.note_model.set_order(self.sort_combo.itemData(index)):
+            self._pending_selection = None
+    
\ No newline at end of file
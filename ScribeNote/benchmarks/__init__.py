@@ -0,0 +1 @@
+# Reproducible benchmarks for storage, search, encryption, attachments and the UI
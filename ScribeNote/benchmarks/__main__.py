@@ -0,0 +1,133 @@
+"""
+ScribeNote benchmark suite
+
+Run from the ScribeNote directory:
+
+    python -m benchmarks --notes 5000 --output results.json
+    python -m benchmarks --notes 5000 --compare results.json
+
+Every run uses a fresh database generated from a seeded corpus, so runs
+with the same options are comparable. --compare exits with status 1 if a
+benchmark's p50 or p90 latency got worse than --threshold allows.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+from .corpus import CorpusConfig, parse_sizes
+from .suite import BenchmarkSuite, peak_rss_mb
+
+# Latency changes below this many milliseconds are treated as noise
+NOISE_FLOOR_MS = 0.05
+
+
+def compare(baseline, results, threshold):
+    """
+    Compare two result sets
+
+    Returns:
+        List of (name, metric, old ms, new ms) for every regression
+    """
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for metric in ("p50", "p90"):
+            old_ms = old['latency_ms'].get(metric)
+            new_ms = result['latency_ms'].get(metric)
+            if old_ms is None or new_ms is None:
+                continue
+            if new_ms > old_ms * (1 + threshold) and new_ms - old_ms > NOISE_FLOOR_MS:
+                regressions.append((name, metric, old_ms, new_ms))
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="ScribeNote benchmark suite")
+    parser.add_argument("--notes", type=int, default=1000, help="Notes in the corpus")
+    parser.add_argument("--body-sizes", default="512:6,4096:3,65536:1",
+                        help="Note body sizes as size:weight pairs")
+    parser.add_argument("--encrypted-ratio", type=float, default=0.1, help="Fraction of encrypted notes")
+    parser.add_argument("--tags", type=int, default=3, help="Maximum tags per note")
+    parser.add_argument("--attachment-ratio", type=float, default=0.05, help="Fraction of notes with an attachment")
+    parser.add_argument("--attachment-sizes", default="16384:3,524288:1",
+                        help="Attachment sizes in bytes as size:weight pairs")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.25,
+                        help="Fraction of attachments that repeat an earlier file")
+    parser.add_argument("--seed", type=int, default=1, help="Corpus random seed")
+    parser.add_argument("--iterations", type=int, default=200, help="Samples per operation benchmark")
+    parser.add_argument("--no-ui", action="store_true", help="Skip the MainWindow benchmarks")
+    parser.add_argument("--workdir", help="Directory for the generated data (default: a temporary one, removed)")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON report of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Allowed latency increase over the baseline (0.2 = 20%%)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    config = CorpusConfig(
+        notes=args.notes,
+        body_sizes=parse_sizes(args.body_sizes),
+        encrypted_ratio=args.encrypted_ratio,
+        tags_per_note=args.tags,
+        attachment_ratio=args.attachment_ratio,
+        attachment_sizes=parse_sizes(args.attachment_sizes),
+        duplicate_ratio=args.duplicate_ratio,
+        seed=args.seed,
+    )
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="scribenote-bench-")
+    try:
+        suite = BenchmarkSuite(config, workdir, iterations=args.iterations, ui=not args.no_ui,
+                               log=lambda message: print(f"running {message}", file=sys.stderr))
+        results = suite.run()
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'corpus': config.to_dict(),
+            'iterations': args.iterations,
+        },
+        'results': results,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('corpus') != report['meta']['corpus']:
+            print("warning: the baseline was run with a different corpus", file=sys.stderr)
+        regressions = compare(baseline['results'], results, args.threshold)
+        for name, metric, old_ms, new_ms in regressions:
+            print(f"REGRESSION {name} {metric}: {old_ms:.3f} ms -> {new_ms:.3f} ms", file=sys.stderr)
+        if regressions:
+            return 1
+        print("No regressions", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+import os
+import random
+
+# Words are drawn from a fixed vocabulary with a skewed distribution, so
+# some search terms are common and others rare, as in real notes
+VOCABULARY_SIZE = 5000
+TAGS = ("work", "personal", "ideas", "todo", "travel", "reading", "recipes", "projects", "journal", "archive")
+PASSWORD = "benchmark password"
+
+
+class CorpusConfig:
+    """
+    Shape of a synthetic corpus
+
+    Args:
+        notes: Number of notes
+        body_sizes: (size in characters, weight) pairs for note bodies
+        encrypted_ratio: Fraction of notes stored encrypted
+        tags_per_note: Maximum number of tags in a note's metadata
+        attachment_ratio: Fraction of notes with an attachment
+        attachment_sizes: (size in bytes, weight) pairs for attachments
+        duplicate_ratio: Fraction of attachments that repeat an earlier file
+        seed: Random seed; the same config always produces the same corpus
+    """
+
+    def __init__(self, notes=1000, body_sizes=((512, 6), (4096, 3), (65536, 1)), encrypted_ratio=0.1,
+                 tags_per_note=3, attachment_ratio=0.05, attachment_sizes=((16 * 1024, 3), (512 * 1024, 1)),
+                 duplicate_ratio=0.25, seed=1):
+        self.notes = notes
+        self.body_sizes = tuple(body_sizes)
+        self.encrypted_ratio = encrypted_ratio
+        self.tags_per_note = tags_per_note
+        self.attachment_ratio = attachment_ratio
+        self.attachment_sizes = tuple(attachment_sizes)
+        self.duplicate_ratio = duplicate_ratio
+        self.seed = seed
+
+    def to_dict(self):
+        return {
+            'notes': self.notes,
+            'body_sizes': [list(size) for size in self.body_sizes],
+            'encrypted_ratio': self.encrypted_ratio,
+            'tags_per_note': self.tags_per_note,
+            'attachment_ratio': self.attachment_ratio,
+            'attachment_sizes': [list(size) for size in self.attachment_sizes],
+            'duplicate_ratio': self.duplicate_ratio,
+            'seed': self.seed,
+        }
+
+
+def parse_sizes(text):
+    """Parse "512:6,4096:3,65536" into ((512, 6), (4096, 3), (65536, 1))"""
+    sizes = []
+    for part in text.split(","):
+        size, _, weight = part.partition(":")
+        sizes.append((int(size), int(weight or 1)))
+    return tuple(sizes)
+
+
+class CorpusGenerator:
+    """Deterministic generator of note titles, bodies, metadata and attachment files"""
+
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.vocabulary = self._make_vocabulary()
+        # Zipf-like weights: word i is about 1/(i+1) as frequent as the first
+        self._cumulative = []
+        total = 0.0
+        for i in range(len(self.vocabulary)):
+            total += 1.0 / (i + 1)
+            self._cumulative.append(total)
+        self._attachments = []
+
+    def _make_vocabulary(self):
+        letters = "abcdefghijklmnopqrstuvwxyz"
+        words = set()
+        while len(words) < VOCABULARY_SIZE:
+            words.add("".join(self.random.choice(letters) for _ in range(self.random.randint(3, 10))))
+        return sorted(words)
+
+    def _pick(self, pairs):
+        return self.random.choices([value for value, _ in pairs], weights=[weight for _, weight in pairs])[0]
+
+    def words(self, count):
+        return self.random.choices(self.vocabulary, cum_weights=self._cumulative, k=count)
+
+    def search_terms(self, count):
+        """Terms for search benchmarks, a mix of frequent and rare words"""
+        return self.words(count)
+
+    def title(self):
+        return " ".join(self.words(self.random.randint(2, 6))).capitalize()
+
+    def body(self, size=None):
+        if size is None:
+            size = self._pick(self.config.body_sizes)
+        lines = []
+        length = 0
+        while length < size:
+            line = " ".join(self.words(self.random.randint(4, 16))) + "\n"
+            lines.append(line)
+            length += len(line)
+        return "".join(lines)[:size]
+
+    def metadata(self):
+        count = self.random.randint(0, self.config.tags_per_note)
+        return {'tags': sorted(self.random.sample(TAGS, count))}
+
+    def notes(self):
+        """
+        Yield the corpus' notes
+
+        Yields:
+            Dicts with title, content, metadata, encrypted and attachment
+            (a (filename, size) pair, or None)
+        """
+        for _ in range(self.config.notes):
+            attachment = None
+            if self.random.random() < self.config.attachment_ratio:
+                attachment = (f"file{self.random.randrange(10 ** 6)}.bin", self._pick(self.config.attachment_sizes))
+            yield {
+                'title': self.title(),
+                'content': self.body(),
+                'metadata': self.metadata(),
+                'encrypted': self.random.random() < self.config.encrypted_ratio,
+                'attachment': attachment,
+            }
+
+    def attachment_file(self, directory, name, size):
+        """
+        Write an attachment file, or return an earlier one (duplicate_ratio)
+
+        Contents come from a seeded generator, so repeated runs hash alike.
+        """
+        if self._attachments and self.random.random() < self.config.duplicate_ratio:
+            return self.random.choice(self._attachments)
+        path = os.path.join(directory, name)
+        with open(path, "wb") as f:
+            remaining = size
+            while remaining > 0:
+                chunk = min(remaining, 1024 * 1024)
+                f.write(self.random.randbytes(chunk))
+                remaining -= chunk
+        self._attachments.append(path)
+        return path
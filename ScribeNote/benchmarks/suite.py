@@ -0,0 +1,323 @@
+import math
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is then not reported
+    resource = None
+
+from app.note_manager import NoteManager
+from app.encryption import EncryptionHandler
+from app.file_handler import FileHandler
+
+from .corpus import CorpusGenerator, PASSWORD, TAGS
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentile(sorted_samples, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_samples:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_samples)))
+    return sorted_samples[rank - 1]
+
+
+class Measurement:
+    """Latency samples of one benchmark"""
+
+    def __init__(self, name):
+        self.name = name
+        self.samples = []
+        self.bytes = 0
+        self._started = time.perf_counter()
+
+    def time(self, fn, *args, size=0, **kwargs):
+        """Call fn once as a sample; size is the number of bytes it processed"""
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.samples.append(time.perf_counter() - start)
+        self.bytes += size
+        return result
+
+    def add(self, seconds, size=0):
+        self.samples.append(seconds)
+        self.bytes += size
+
+    def summary(self):
+        samples = sorted(self.samples)
+        busy = sum(samples)
+        result = {
+            'count': len(samples),
+            'total_s': round(busy, 6),
+            'wall_s': round(time.perf_counter() - self._started, 6),
+            'ops_per_s': round(len(samples) / busy, 2) if busy else None,
+            'latency_ms': {
+                'mean': round(busy / len(samples) * 1000, 4) if samples else None,
+                'p50': round(percentile(samples, 0.50) * 1000, 4) if samples else None,
+                'p90': round(percentile(samples, 0.90) * 1000, 4) if samples else None,
+                'p99': round(percentile(samples, 0.99) * 1000, 4) if samples else None,
+                'max': round(samples[-1] * 1000, 4) if samples else None,
+            },
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        if self.bytes:
+            result['throughput_mb_s'] = round(self.bytes / busy / (1024 * 1024), 2) if busy else None
+        return result
+
+
+class BenchmarkSuite:
+    """
+    Runs every benchmark against a fresh database in workdir
+
+    Args:
+        config: CorpusConfig of the generated corpus
+        workdir: Empty directory for the database, attachments and files
+        iterations: Samples taken by the per-operation benchmarks
+        ui: Also benchmark MainWindow flows (needs PyQt5; runs offscreen)
+        log: Called with a progress message before each benchmark
+    """
+
+    def __init__(self, config, workdir, iterations=200, ui=True, log=None):
+        self.config = config
+        self.workdir = workdir
+        self.iterations = iterations
+        self.ui = ui
+        self.log = log or (lambda message: None)
+        self.generator = CorpusGenerator(config)
+        self.results = {}
+
+        self.data_dir = os.path.join(workdir, "data")
+        self.files_dir = os.path.join(workdir, "files")
+        os.makedirs(self.data_dir, exist_ok=True)
+        os.makedirs(self.files_dir, exist_ok=True)
+        self.db_path = os.path.join(self.data_dir, "notes.db")
+        self.encryption_handler = EncryptionHandler()
+        self.note_manager = NoteManager(self.db_path, encryption_handler=self.encryption_handler)
+        self.file_handler = FileHandler(os.path.join(self.data_dir, "attachments"), self.db_path,
+                                        encryption_handler=self.encryption_handler)
+
+        self.note_ids = []
+        self.plaintext_ids = []
+        self.planned_attachments = []
+
+    def measurement(self, name):
+        self.log(name)
+        return Measurement(name)
+
+    def record(self, measurement):
+        self.results[measurement.name] = measurement.summary()
+
+    def run(self):
+        self.bench_create()
+        self.bench_get()
+        self.bench_update()
+        self.bench_get_all()
+        self.bench_summaries()
+        self.bench_search()
+        self.bench_tag_filter()
+        self.bench_crypto()
+        self.bench_attach()
+        if self.ui:
+            self.bench_ui()
+        return self.results
+
+    def sample_ids(self, ids):
+        return [self.generator.random.choice(ids) for _ in range(self.iterations)] if ids else []
+
+    # Storage
+
+    def bench_create(self):
+        measurement = self.measurement("notes.create")
+        # One salt for the corpus so the KDF runs once, not per note
+        salt = self.encryption_handler.new_salt()
+        for note in self.generator.notes():
+            content = note['content']
+            if note['encrypted']:
+                content = self.encryption_handler.encrypt(content, PASSWORD, salt=salt)
+            note_id = measurement.time(
+                self.note_manager.create_note, note['title'], content, note['metadata'], note['encrypted'],
+                size=len(content)
+            )
+            self.note_ids.append(note_id)
+            if not note['encrypted']:
+                self.plaintext_ids.append(note_id)
+            if note['attachment']:
+                self.planned_attachments.append((note_id, note['encrypted'], note['attachment']))
+        self.record(measurement)
+
+    def bench_get(self):
+        measurement = self.measurement("notes.get")
+        for note_id in self.sample_ids(self.note_ids):
+            measurement.time(self.note_manager.get_note, note_id)
+        self.record(measurement)
+
+    def bench_update(self):
+        measurement = self.measurement("notes.update")
+        for note_id in self.sample_ids(self.plaintext_ids):
+            content = self.generator.body()
+            measurement.time(self.note_manager.update_note, note_id, self.generator.title(), content,
+                             size=len(content))
+        self.record(measurement)
+
+    def bench_get_all(self):
+        measurement = self.measurement("notes.get_all")
+        for _ in range(max(3, self.iterations // 40)):
+            measurement.time(self.note_manager.get_all_notes)
+        self.record(measurement)
+
+    def bench_summaries(self):
+        measurement = self.measurement("notes.page_summaries")
+        after = None
+        while True:
+            page = measurement.time(self.note_manager.get_note_summaries, after=after)
+            if not page:
+                break
+            after = self.note_manager.summary_cursor(page[-1])
+        self.record(measurement)
+
+    def bench_search(self):
+        measurement = self.measurement("search.full_text")
+        for term in self.generator.search_terms(self.iterations):
+            measurement.time(self.note_manager.search_notes, term)
+        self.record(measurement)
+
+    def bench_tag_filter(self):
+        measurement = self.measurement("search.tag_filter")
+        for _ in range(max(len(TAGS), self.iterations // 10)):
+            measurement.time(self.note_manager.get_note_ids, self.generator.random.choice(TAGS))
+        self.record(measurement)
+
+        measurement = self.measurement("search.tag_counts")
+        for _ in range(max(3, self.iterations // 20)):
+            measurement.time(self.note_manager.tag_counts)
+        self.record(measurement)
+
+    # Encryption
+
+    def bench_crypto(self):
+        handler = self.encryption_handler
+
+        # Every call derives a key: a new salt each time
+        measurement = self.measurement("crypto.encrypt_new_key")
+        content = self.generator.body(4096)
+        for _ in range(max(5, self.iterations // 20)):
+            measurement.time(handler.encrypt, content, PASSWORD, size=len(content))
+        self.record(measurement)
+
+        salt = handler.new_salt()
+        for size, _ in sorted(set(self.config.body_sizes)):
+            content = self.generator.body(size)
+            encrypted = handler.encrypt(content, PASSWORD, salt=salt)
+
+            measurement = self.measurement(f"crypto.encrypt.{size}")
+            for _ in range(self.iterations):
+                measurement.time(handler.encrypt, content, PASSWORD, salt=salt, size=len(content))
+            self.record(measurement)
+
+            measurement = self.measurement(f"crypto.decrypt.{size}")
+            for _ in range(self.iterations):
+                measurement.time(handler.decrypt, encrypted, PASSWORD, size=len(content))
+            self.record(measurement)
+
+    # Attachments
+
+    def bench_attach(self):
+        measurement = self.measurement("attachments.attach")
+        for note_id, encrypted, (name, size) in self.planned_attachments:
+            path = self.generator.attachment_file(self.files_dir, name, size)
+            password = PASSWORD if encrypted else None
+            measurement.time(self.file_handler.attach_file, note_id, path, password=password,
+                             size=os.path.getsize(path))
+        self.record(measurement)
+
+        # As many new files again, attached to one note in a single batch
+        if not self.planned_attachments:
+            return
+        batch_dir = os.path.join(self.files_dir, "batch")
+        os.makedirs(batch_dir, exist_ok=True)
+        paths = [self.generator.attachment_file(batch_dir, name, size)
+                 for _, _, (name, size) in self.planned_attachments]
+        measurement = self.measurement("attachments.attach_batch")
+        measurement.time(self.file_handler.attach_files, self.planned_attachments[0][0], paths,
+                         size=sum(os.path.getsize(path) for path in paths))
+        self.record(measurement)
+
+    # MainWindow flows
+
+    def bench_ui(self):
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        try:
+            from PyQt5.QtWidgets import QApplication
+        except ImportError:
+            self.log("PyQt5 is not available; skipping UI benchmarks")
+            return
+        from app.ui import MainWindow
+
+        app = QApplication.instance() or QApplication([])
+        reloads = []
+
+        def wait_until(predicate, timeout=30.0):
+            deadline = time.perf_counter() + timeout
+            while not predicate():
+                if time.perf_counter() > deadline:
+                    raise TimeoutError("UI did not respond in time")
+                app.processEvents()
+                time.sleep(0.0002)
+
+        measurement = self.measurement("ui.startup")
+        start = time.perf_counter()
+        window = MainWindow(data_dir=self.data_dir)
+        window.note_model.reloaded.connect(lambda: reloads.append(True))
+        wait_until(lambda: window.current_note_id is not None or not self.note_ids)
+        measurement.add(time.perf_counter() - start)
+        self.record(measurement)
+
+        try:
+            measurement = self.measurement("ui.display_note")
+            for _ in range(self.iterations):
+                rows = window.note_model.rowCount()
+                row = self.generator.random.randrange(rows)
+                note_id = window.note_model.note_id(row)
+                if note_id == window.current_note_id:
+                    continue
+                start = time.perf_counter()
+                window.select_row(row)
+                wait_until(lambda: window.current_note_id == note_id)
+                measurement.add(time.perf_counter() - start)
+            self.record(measurement)
+
+            measurement = self.measurement("ui.sort_notes")
+            for i in range(1, max(4, self.iterations // 20) + 1):
+                del reloads[:]
+                start = time.perf_counter()
+                window.sort_combo.setCurrentIndex(i % window.sort_combo.count())
+                wait_until(lambda: reloads)
+                measurement.add(time.perf_counter() - start)
+            self.record(measurement)
+
+            measurement = self.measurement("ui.search")
+            previous = None
+            for term in self.generator.search_terms(max(10, self.iterations // 4)):
+                if term == previous:
+                    continue
+                previous = term
+                del reloads[:]
+                start = time.perf_counter()
+                window.filter_notes(term)
+                wait_until(lambda: reloads)
+                measurement.add(time.perf_counter() - start)
+            self.record(measurement)
+        finally:
+            window.close()
+            window.deleteLater()
+            app.processEvents()
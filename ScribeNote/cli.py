@@ -0,0 +1,363 @@
+import argparse
+import getpass
+import os
+import sys
+import time
+
+from app.note_manager import NoteManager
+from app.instrumentation import instrumentation
+
+
+def default_db_path():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "notes.db")
+
+
+def print_progress(processed, total):
+    count = f"{processed}/{total}" if total is not None else str(processed)
+    print(f"\r{count} notes", end="", file=sys.stderr, flush=True)
+
+
+def ask_password(prompt, confirm=False):
+    password = getpass.getpass(prompt)
+    if confirm and getpass.getpass("Repeat " + prompt[0].lower() + prompt[1:]) != password:
+        raise SystemExit("Passwords do not match")
+    if not password:
+        raise SystemExit("A password is required")
+    return password
+
+
+def print_job(job):
+    print(
+        f"{job['id']}  {job['operation']:<8} {job['status']:<9} "
+        f"done={job['done']} skipped={job['skipped']} failed={job['failed']} pending={job['pending']}"
+    )
+
+
+def cmd_crypto(args):
+    from app.bulk_crypto import BulkCrypto, ENCRYPT, REKEY
+
+    note_manager = NoteManager(args.db)
+    bulk = BulkCrypto(note_manager, workers=args.workers)
+
+    if args.operation == "jobs":
+        for job in bulk.get_unfinished_jobs():
+            print_job(job)
+        return 0
+
+    if args.operation == "unindex":
+        note_manager.blind_index.disable()
+        print("Blind index deleted")
+        return 0
+
+    if args.operation == "resume":
+        job = bulk.get_job(args.job_id)
+        if job is None:
+            raise SystemExit(f"Unknown job: {args.job_id}")
+        password = ask_password("Password: " if job['operation'] != REKEY else "Current password: ")
+        new_password = ask_password("New password: ", confirm=True) if job['operation'] == REKEY else None
+        job = bulk.resume(args.job_id, password, new_password, progress=print_progress,
+                          retry_failed=args.retry_failed)
+    else:
+        if not (args.all or args.tag or args.ids):
+            raise SystemExit("Choose the notes with --all, --tag or --id")
+        if args.operation == REKEY:
+            password = ask_password("Current password: ")
+            new_password = ask_password("New password: ", confirm=True)
+        else:
+            password = ask_password("Password: ", confirm=args.operation == ENCRYPT)
+            new_password = None
+        job = bulk.run(args.operation, password, new_password, tag=args.tag,
+                       note_ids=args.ids or None, progress=print_progress)
+
+    print(file=sys.stderr)
+    print_job(job)
+    return 1 if job['failed'] else 0
+
+
+def cmd_attachments(args):
+    from app.file_handler import FileHandler
+
+    note_manager = NoteManager(args.db)
+    file_handler = FileHandler(attachment_dir(args.db), args.db)
+
+    if args.operation == "migrate":
+        print(f"Moved {file_handler.migrate_legacy_attachments()} attachments into the blob store")
+    elif args.operation == "index":
+        started = time.perf_counter()
+        indexed = note_manager.attachment_text.index_pending(
+            progress=lambda done, total: print(f"\r{done}/{total} files", end="", file=sys.stderr, flush=True)
+        )
+        print(file=sys.stderr)
+        stats = note_manager.attachment_text.stats()
+        print(f"Indexed the text of {indexed} attachments in {time.perf_counter() - started:.1f}s; "
+              f"{stats['attachments']} attachments and {stats['chars']} characters indexed in total")
+    elif args.operation == "gc":
+        removed, freed = file_handler.collect_garbage()
+        print(f"Removed {removed} unreferenced files ({freed} bytes)")
+    else:
+        stats = file_handler.blob_store.stats()
+        print(f"{stats['blobs']} blobs, {stats['bytes']} bytes stored for {stats['logical_bytes']} bytes attached")
+    return 0
+
+
+def attachment_dir(db_path):
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), "attachments")
+
+
+def cmd_import(args):
+    from app.file_handler import FileHandler
+    from app.transfer import NoteImporter
+
+    if not os.path.exists(args.source):
+        raise SystemExit(f"Not found: {args.source}")
+    note_manager = NoteManager(args.db)
+    importer = NoteImporter(note_manager, FileHandler(attachment_dir(args.db), args.db),
+                            workers=args.workers, batch_size=args.batch_size)
+
+    started = time.perf_counter()
+    result = importer.import_path(args.source, progress=print_progress)
+    print(file=sys.stderr)
+    for error in result['errors']:
+        print(f"error: {error}", file=sys.stderr)
+    print(
+        f"Imported {result['imported']} notes and {result['attachments']} attachments in "
+        f"{time.perf_counter() - started:.1f}s ({result['skipped']} already present, {result['failed']} failed)"
+    )
+    return 1 if result['failed'] else 0
+
+
+def cmd_export(args):
+    from app.transfer import NoteExporter
+
+    started = time.perf_counter()
+    result = NoteExporter(NoteManager(args.db)).export(args.destination, progress=print_progress)
+    print(file=sys.stderr)
+    print(
+        f"Exported {result['notes']} notes and {result['attachments']} attachment files to {args.destination} "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+    if result['missing']:
+        print(f"{result['missing']} attachment files were missing and not exported", file=sys.stderr)
+    return 0
+
+
+def cmd_history(args):
+    revisions = NoteManager(args.db).revisions
+
+    if args.operation == "compact":
+        # Encrypted chains need their password to be re-encoded and are
+        # otherwise only dropped whole
+        print(f"Removed {revisions.compact()} revisions")
+    stats = revisions.stats()
+    print(
+        f"{stats['revisions']} revisions of {stats['notes']} notes, {stats['stored_bytes']} bytes stored "
+        f"for {stats['content_bytes']} bytes of content"
+    )
+    return 0
+
+
+def cmd_storage(args):
+    note_manager = NoteManager(args.db)
+
+    if args.operation == "compact":
+        result = note_manager.compact_storage(retrain=args.retrain, progress=print_progress)
+        print(file=sys.stderr)
+        print(
+            f"Re-encoded {result['reencoded']} notes, retired {result['retired_dictionaries']} dictionaries; "
+            f"{result['bytes_before']} -> {result['bytes_after']} bytes"
+        )
+    stats = note_manager.storage_stats()
+    print(
+        f"{stats['file_bytes']} bytes ({stats['free_bytes']} free), {stats['body_bytes']} bytes of bodies "
+        f"stored for {stats['notes']} notes, {stats['uncompressed_bodies']} not yet compressed"
+    )
+    if not stats['incremental_vacuum']:
+        print("Free space is only given back by `storage compact`")
+    return 0
+
+
+def cmd_serve(args):
+    import asyncio
+    import secrets
+    from app.rpc import RPCServer
+    from app.store import NoteStore
+
+    token = None
+    if args.port is not None:
+        # Only processes that can read this file can connect
+        token = secrets.token_urlsafe(32)
+        token_path = args.token_file or os.path.join(os.path.dirname(os.path.abspath(args.db)), "rpc.token")
+        fd = os.open(token_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(token)
+    elif not args.socket:
+        args.socket = os.path.join(os.path.dirname(os.path.abspath(args.db)), "rpc.sock")
+
+    async def serve():
+        async with NoteStore(args.db, attachment_dir(args.db)) as store:
+            server = await RPCServer(store, path=args.socket if args.port is None else None,
+                                     port=args.port, token=token).start()
+            if args.port is None:
+                print(f"Listening on {args.socket}", file=sys.stderr)
+            else:
+                print(f"Listening on 127.0.0.1:{server.port}; token in {token_path}", file=sys.stderr)
+            try:
+                await server.serve_forever()
+            finally:
+                await server.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def sync_peer(peer, token_file):
+    import stat
+    from app.sync import SyncEndpoint, RemoteEndpoint
+
+    if os.path.isdir(peer):
+        return SyncEndpoint.open(peer)
+    if os.path.exists(peer) and stat.S_ISSOCK(os.stat(peer).st_mode):
+        return RemoteEndpoint(path=peer)
+    host, _, port = peer.rpartition(":")
+    if not port.isdigit():
+        raise SystemExit(f"Not a data directory, socket or host:port: {peer}")
+    if not token_file:
+        raise SystemExit("--token-file is required to sync over TCP")
+    with open(token_file) as f:
+        token = f.read().strip()
+    return RemoteEndpoint(host=host or "127.0.0.1", port=int(port), token=token)
+
+
+def cmd_sync(args):
+    from app.file_handler import FileHandler
+    from app.sync import SyncEndpoint, sync
+
+    note_manager = NoteManager(args.db)
+    if args.new_id:
+        note_manager.versions.new_replica()
+        print("This store has a new sync id")
+    if not args.peer:
+        return 0
+    local = SyncEndpoint(note_manager, FileHandler(attachment_dir(args.db), args.db))
+    remote = sync_peer(args.peer, args.token_file)
+
+    started = time.perf_counter()
+    try:
+        result = sync(local, remote, progress=lambda compared, sent: print_progress(compared, None))
+    except ValueError as e:
+        raise SystemExit(str(e))
+    finally:
+        if hasattr(remote, "close"):
+            remote.close()
+    print(file=sys.stderr)
+    failed = 0
+    for direction in ("received", "sent"):
+        part = result[direction]
+        print(
+            f"{direction.capitalize()} {part['applied']} notes and {part['blobs']} attachment files "
+            f"({part['bytes']} bytes; {part['compared']} changes compared, {part['skipped']} older versions ignored)"
+        )
+        if part['held_back']:
+            print(f"{part['held_back']} notes were held back because their attachments could not be copied; "
+                  "syncing again continues from there", file=sys.stderr)
+        if part['missing']:
+            print(f"{part['missing']} attachments were left out: their files could not be copied", file=sys.stderr)
+        for error in part['errors']:
+            print(f"error: {error}", file=sys.stderr)
+        failed += len(part['errors'])
+    print(f"Synced in {time.perf_counter() - started:.1f}s")
+    return 1 if failed else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="ScribeNote command line tools")
+    parser.add_argument("--db", default=default_db_path(), help="Path to notes.db")
+    parser.add_argument("--trace", metavar="FILE", help="Record timings and write a Chrome trace (JSON) here")
+    parser.add_argument("--profile", metavar="FILE", help="Write cProfile stats of the command here")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    crypto = commands.add_parser("crypto", help="Encrypt, decrypt or re-key many notes")
+    crypto.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    operations = crypto.add_subparsers(dest="operation", required=True)
+    for name, help_text in (
+        ("encrypt", "Encrypt unencrypted notes"),
+        ("decrypt", "Decrypt encrypted notes"),
+        ("rekey", "Change the password of encrypted notes"),
+        ("index", "Make encrypted notes searchable with their password (turns the blind index on)"),
+    ):
+        operation = operations.add_parser(name, help=help_text)
+        operation.add_argument("--all", action="store_true", help="All notes")
+        operation.add_argument("--tag", help="Only notes with this tag")
+        operation.add_argument("--id", dest="ids", action="append", help="Only this note (repeatable)")
+    resume = operations.add_parser("resume", help="Resume an interrupted job")
+    resume.add_argument("job_id")
+    resume.add_argument("--retry-failed", action="store_true", help="Also retry notes that failed")
+    operations.add_parser("jobs", help="List unfinished jobs")
+    operations.add_parser("unindex", help="Turn the blind index off and delete its tokens")
+    crypto.set_defaults(func=cmd_crypto)
+
+    attachments = commands.add_parser("attachments", help="Maintain the attachment store")
+    attachments.add_argument("operation", choices=("stats", "gc", "migrate", "index"))
+    attachments.set_defaults(func=cmd_attachments)
+
+    import_parser = commands.add_parser(
+        "import", help="Import a directory of .txt/.md files, or an archive made by export"
+    )
+    import_parser.add_argument("source", help="Directory, .zip or .jsonl file")
+    import_parser.add_argument("--workers", type=int, default=None, help="Reader threads")
+    import_parser.add_argument("--batch-size", type=int, default=2000, help="Notes per transaction")
+    import_parser.set_defaults(func=cmd_import)
+
+    export = commands.add_parser("export", help="Export all notes (and attachments) for backup or migration")
+    export.add_argument("destination", help="Archive to write: .zip with attachments, .jsonl for notes only")
+    export.set_defaults(func=cmd_export)
+
+    history = commands.add_parser("history", help="Maintain note revision history")
+    history.add_argument("operation", choices=("stats", "compact"))
+    history.set_defaults(func=cmd_history)
+
+    storage = commands.add_parser("storage", help="Compress note bodies and shrink the database")
+    storage.add_argument("operation", choices=("stats", "compact"))
+    storage.add_argument("--retrain", action="store_true", help="Train a new compression dictionary")
+    storage.set_defaults(func=cmd_storage)
+
+    serve = commands.add_parser("serve", help="Serve the notes over JSON-RPC to local scripts")
+    serve.add_argument("--socket", help="Unix socket to listen on (default: rpc.sock next to the database)")
+    serve.add_argument("--port", type=int, help="Listen on this localhost TCP port instead (0: any free port)")
+    serve.add_argument("--token-file", help="Where to write the TCP token (default: rpc.token next to the database)")
+    serve.set_defaults(func=cmd_serve)
+
+    sync_parser = commands.add_parser("sync", help="Exchange changed notes and attachments with another store")
+    sync_parser.add_argument("peer", nargs="?",
+                             help="Data directory of the other store, or the socket or host:port of its `serve`")
+    sync_parser.add_argument("--token-file", help="Token of the other store's server, to sync over TCP")
+    sync_parser.add_argument("--new-id", action="store_true",
+                             help="Give this store a new sync id first (for a store copied from another one)")
+    sync_parser.set_defaults(func=cmd_sync)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.trace:
+        instrumentation.set_enabled(True)
+    if args.profile:
+        instrumentation.start_profile()
+    try:
+        return args.func(args)
+    finally:
+        if args.profile:
+            instrumentation.stop_profile(args.profile)
+        if args.trace:
+            instrumentation.dump(args.trace)
+            slow = instrumentation.snapshot()['slow_operations']
+            if slow:
+                print(f"{len(slow)} slow operations recorded in {args.trace}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
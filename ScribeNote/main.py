@@ -1,13 +1,50 @@
-import sys
-from PyQt5.QtWidgets import QApplication
-from app.ui import MainWindow
+import time
+
+# Taken first, so --measure-startup includes the time spent importing
+STARTED = time.perf_counter()
+
+import argparse
+import json
 import os
+import sys
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="ScribeNote")
+    parser.add_argument("--data-dir", help="Directory holding notes.db and attachments/ (default: ./data)")
+    parser.add_argument("--measure-startup", action="store_true",
+                        help="Start, wait until the notes and the first note are shown, "
+                             "print the startup timings as JSON and exit")
+    # Anything else is left for Qt (-style, -platform, ...)
+    return parser.parse_known_args(argv)
+
 
 if __name__ == "__main__":
+    args, qt_args = parse_args(sys.argv[1:])
+
     # Create data directory if it doesn't exist
-    os.makedirs(os.path.join(os.path.dirname(__file__), "data"), exist_ok=True)
-    
-    app = QApplication(sys.argv)
-    window = MainWindow()
+    os.makedirs(args.data_dir or os.path.join(os.path.dirname(__file__), "data"), exist_ok=True)
+
+    # Qt and the UI are imported here rather than at the top so the import
+    # time shows up in the measurement
+    from app.startup import StartupTimer
+    timer = StartupTimer(STARTED)
+    from PyQt5.QtWidgets import QApplication
+    from app.ui import MainWindow
+    timer.mark("imports")
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    timer.mark("qapplication")
+    window = MainWindow(data_dir=args.data_dir)
+    timer.mark("window_created")
     window.show()
+    timer.mark("window_shown")
+
+    if args.measure_startup:
+        def report():
+            print(json.dumps(timer.report(), indent=2))
+            window.close()
+            app.quit()
+        timer.watch(window, report)
+
     sys.exit(app.exec_())
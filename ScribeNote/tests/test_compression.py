@@ -0,0 +1,104 @@
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app.database import ConnectionManager
+from app.note_manager import NoteManager
+
+FIRST_WORDS = ["meeting", "agenda", "budget", "quarter", "review", "project", "deadline", "client"]
+SECOND_WORDS = ["recipe", "garlic", "simmer", "oregano", "saucepan", "tomatoes", "basil", "onion"]
+
+# Runs in another process, like `cli.py storage compact --retrain` would
+COMPACT = """
+import sys
+sys.path.insert(0, sys.argv[1])
+from app.note_manager import NoteManager
+result = NoteManager(sys.argv[2]).compact_storage(retrain=True)
+print(result['dictionary_id'])
+"""
+
+READ = """
+import sys
+sys.path.insert(0, sys.argv[1])
+from app.note_manager import NoteManager
+print(NoteManager(sys.argv[2]).get_note(sys.argv[3])['content'], end="")
+"""
+
+
+def body(words, rng):
+    return " ".join(rng.choice(words) + " " + rng.choice(words) for _ in range(40))
+
+
+class StaleCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, "notes.db")
+        self.rng = random.Random(1)
+
+    def tearDown(self):
+        ConnectionManager.for_path(self.db_path).close_all()
+        self.tmp.cleanup()
+
+    def run_script(self, script, *args):
+        return subprocess.run(
+            [sys.executable, "-c", script, ROOT, self.db_path, *args],
+            check=True, capture_output=True, text=True
+        ).stdout
+
+    def test_write_after_another_process_retrains(self):
+        note_manager = NoteManager(self.db_path)
+        for i in range(100):
+            note_manager.create_note(f"Work {i}", body(FIRST_WORDS, self.rng))
+        note_manager.compact_storage()
+        stale_id = note_manager.codec.dictionary_id
+        self.assertIsNotNone(stale_id)
+
+        # Another process retrains on different notes and re-encodes them all
+        with note_manager.transaction() as conn:
+            conn.execute("DELETE FROM notes")
+        for i in range(200):
+            note_manager.create_note(f"Recipe {i}", body(SECOND_WORDS, self.rng))
+        new_id = int(self.run_script(COMPACT))
+        self.assertNotEqual(new_id, stale_id)
+        # Still loaded here as the current dictionary
+        self.assertEqual(note_manager.codec.dictionary_id, stale_id)
+
+        text = body(SECOND_WORDS, self.rng)
+        note_id = note_manager.create_note("Written by the stale process", text)
+        self.assertEqual(note_manager.codec.dictionary_id, new_id)
+        note_manager.update_note(note_id, "Updated", text + " more")
+
+        # Readable from a process that starts afresh
+        self.assertEqual(self.run_script(READ, note_id), text + " more")
+        # The old dictionary is retired, not deleted
+        row = note_manager.db.fetchone(
+            "SELECT retired_date FROM compression_dictionaries WHERE id = ?", (stale_id,)
+        )
+        self.assertIsNotNone(row)
+        self.assertIsNotNone(row['retired_date'])
+
+    def test_retired_dictionary_still_decodes(self):
+        note_manager = NoteManager(self.db_path)
+        for i in range(100):
+            note_manager.create_note(f"Work {i}", body(FIRST_WORDS, self.rng))
+        note_manager.compact_storage()
+        note = note_manager.db.fetchone("SELECT content FROM notes LIMIT 1")
+
+        for i in range(200):
+            note_manager.create_note(f"Recipe {i}", body(SECOND_WORDS, self.rng))
+        with note_manager.transaction() as conn:
+            conn.execute("DELETE FROM notes WHERE title LIKE 'Work %'")
+        note_manager.compact_storage(retrain=True)
+
+        # Read before the retrain (e.g. a record not decoded yet), decoded after
+        self.assertTrue(note_manager.codec.decode(note['content']).startswith(tuple(FIRST_WORDS)))
+
+
+if __name__ == "__main__":
+    unittest.main()